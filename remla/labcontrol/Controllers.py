@@ -1,7 +1,13 @@
+import asyncio
+import concurrent.futures
+import copy
+import functools
 import inspect
+import logging
 import os
 import subprocess
 import sys
+import threading
 import time
 from abc import ABC, ABCMeta, abstractmethod
 from warnings import warn
@@ -12,13 +18,21 @@ import pyvisa as visa
 import RPi.GPIO as gpio
 import RPistepper as stp
 import tplink_smarthome as tp
-import typer
 from adafruit_motor import stepper
 from adafruit_motorkit import MotorKit
 
+from remla.labcontrol.gateway import RemoteError, connectionFor
+from remla.labcontrol.steptiming import StepScheduler
+
+# One pigpio connection and one VISA manager per process, shared by every
+# controller of every experiment the process hosts.
 pi = pigpio.pi()
 gpio.setmode(gpio.BCM)
 visaManager = visa.ResourceManager("@py")
+# For constructors whose `pi` argument hides the module-level connection.
+sharedPi = pi
+
+logger = logging.getLogger(__name__)
 
 
 class InitialAttributeTracker:
@@ -26,7 +40,7 @@ class InitialAttributeTracker:
         self.name = name
 
     def __get__(self, obj, objtype=None):
-        print("Getting Called")
+        logger.debug("Getting %s", self.name)
         return obj.__dict__.get(self.name)
 
     def __set__(self, obj, value):
@@ -65,13 +79,87 @@ class CombinedMetaClass(AutoTrackMeta, ABCMeta):
     pass
 
 
+class CancelToken:
+    """
+    Handed to a controller for the duration of one command. Step and transfer
+    loops check `cancelled` and stop early once the experiment cancels it.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+
+def nonblocking(method):
+    """
+    Mark a controller method as finishing in microseconds (a GPIO write, a PWM
+    change). The experiment runs such commands straight on the event loop instead
+    of handing them to a worker thread. Coroutine methods are always run there.
+    """
+    method.nonblocking = True
+    return method
+
+
+class Command:
+    """A device command resolved once when the device is added to an experiment."""
+
+    def __init__(self, name, method, parser=None, arity=None):
+        self.name = name
+        self.method = method
+        self.parser = parser
+        # Number of params the command takes. None accepts anything, 0 calls the
+        # method without arguments.
+        self.arity = arity
+        # Inline commands run on the event loop, everything else in an executor.
+        self.inline = getattr(method, "nonblocking", False) or inspect.iscoroutinefunction(
+            method
+        )
+
+    def checkArity(self, params):
+        if self.arity is None:
+            return
+        # The slash format sends "device/cmd/" as a single empty param.
+        count = 0 if params == [""] else len(params)
+        if count != self.arity:
+            raise ArgumentNumberError(count, self.arity, self.name)
+
+    def __call__(self, params):
+        if self.arity == 0:
+            return self.method()
+        if self.parser is not None:
+            params = self.parser(params)
+        return self.method(params)
+
+
 class BaseController(ABC, metaclass=CombinedMetaClass):
+    # Devices whose commands finish in microseconds (plain GPIO/PWM writes) run on
+    # the experiment's shared GPIO pool instead of their lock group's pool.
+    fastIO = False
+    # Commands that only set a target value (speed, duty cycle, angle). When several
+    # are queued for the same device only the newest one is run.
+    coalescable = ()
+    # The public commands of the device, mapped to how many params they take
+    # (None for any number). Controllers that leave this as None fall back to
+    # cmdHandler, which will run any attribute.
+    commands = None
+    # Devices whose state outlives the server, like motor positions, the absorber
+    # layout or power outlets. Their state is journaled and restored on startup.
+    persistState = False
+
     def __init__(self, name):
         self.initParameters = {}
         self.name = name
         self.experiment = None
         self.state = {}
-        typer.echo(f"Initialized {name} base controller")
+        self._nextProgress = 0.0
+        self.cancelToken = CancelToken()
+        logger.info("Initialized %s base controller", name)
 
     @property
     @abstractmethod
@@ -79,7 +167,9 @@ class BaseController(ABC, metaclass=CombinedMetaClass):
         """Subclasses must have a 'deviceType' class attribute"""
         pass
 
-    def cmdHandler(self, cmd, params, deviceName):
+    def cmdHandler(self, cmd, params, deviceName, cancelToken=None):
+        if cancelToken is not None:
+            self.cancelToken = cancelToken
         # Make the parser name, it should follow the naming convention <cmd>_parser. If there is no parser return None.
         parser_name = f"{cmd}_parser"
         parser = getattr(self, parser_name, None)
@@ -89,32 +179,111 @@ class BaseController(ABC, metaclass=CombinedMetaClass):
             params = parser(params)
         # If there is no parser print this statement for user.
         else:
-            print("No Parser Found. Will just pass params to command.")
+            logger.debug("No parser found for %s, passing params straight to it", cmd)
 
         # Now get the command method. If there isn't a method, it should throw an AttributeError.
         try:
             method = getattr(self, cmd)
-            print(method)
+            logger.debug("%s calling %s", self.name, cmd)
             if callable(method):
                 response = method(params)
+                if inspect.iscoroutine(response):
+                    # cmdHandler runs in a worker thread, so it can drive async commands itself.
+                    response = asyncio.run(response)
                 return response
         except Exception as e:
-            print(f"{self.__class__.__name__} does not have <{cmd}> cmd")
+            logger.error("%s does not have <%s> cmd", self.__class__.__name__, cmd)
             raise e
 
     @abstractmethod
     def reset(self):
         pass
 
+    def dependencies(self):
+        """Other devices this one drives, e.g. an absorber's stepper, actuator and magnet."""
+        return [
+            value
+            for value in vars(self).values()
+            if isinstance(value, BaseController) and value is not self
+        ]
+
+    def commandTable(self):
+        """Bind every public command to its method and <cmd>_parser."""
+        table = {}
+        for cmd, arity in self.commands.items():
+            method = getattr(self, cmd)
+            parser = getattr(self, f"{cmd}_parser", None)
+            table[cmd] = Command(cmd, method, parser, arity)
+        return table
+
+    def abort(self):
+        """
+        Interrupt whatever the hardware is doing right now. Called from the event
+        loop right after the running command's token is cancelled, so it must not
+        block. Most devices have nothing to interrupt.
+        """
+        pass
+
+    def progressInterval(self):
+        if self.experiment is None:
+            return 0.1
+        return self.experiment.progressInterval
+
+    def reportProgress(self, **progress):
+        """
+        Publish a progress event from inside a long running command. Safe to call
+        on every step from an executor thread; events are rate limited to the
+        experiment's progressInterval.
+        """
+        if self.experiment is None:
+            return
+        now = time.monotonic()
+        if now < self._nextProgress:
+            return
+        self._nextProgress = now + self.experiment.progressInterval
+        self.experiment.publishProgress(self.name, progress)
+
     def getState(self):
         return self.state
 
     def setState(self, state):
         self.state = state
 
+    def restoreState(self, state):
+        """
+        Adopt state saved by a previous run of the server. Only the bookkeeping
+        changes; the hardware is assumed to still be where it was left.
+        """
+        if isinstance(self.state, dict) and isinstance(state, dict):
+            self.state.update(state)
+        else:
+            self.state = state
+
+    def stateChanged(self, reason):
+        """
+        Publish a state change that did not come from a command, e.g. a limit switch
+        firing on a pigpio callback thread, so clients hear about it right away.
+        """
+        if self.experiment is not None:
+            self.experiment.publishState(self.name, reason)
+
+    def markClean(self):
+        """
+        Remember the current state as the device's starting state. The experiment
+        calls this once, when the device is added, so reset() must put ``state``
+        back the way it was then.
+        """
+        self.cleanState = copy.deepcopy(self.getState())
+
+    def isDirty(self):
+        """True if the state differs from the starting state, or markClean was never called."""
+        return getattr(self, "cleanState", None) is None or self.getState() != self.cleanState
+
 
 class PDUOutlet(dlipower.PowerSwitch, BaseController):
     deviceType = "controller"
+    commands = {"on": 1, "off": 1}
+    persistState = True
 
     def __init__(
         self,
@@ -193,6 +362,10 @@ class PDUOutlet(dlipower.PowerSwitch, BaseController):
             )
         return outlet
 
+    def restoreState(self, state):
+        # Saved state comes back from JSON with the outlet numbers as strings.
+        super().restoreState({int(outlet): value for outlet, value in state.items()})
+
     def reset(self):
         for outlet in self.outlets:
             self.off(outlet)
@@ -200,15 +373,17 @@ class PDUOutlet(dlipower.PowerSwitch, BaseController):
 
 class Plug(tp.TPLinkSmartDevice, BaseController):
     deviceType = "controller"
+    commands = {"setRelay": 1}
+    persistState = True
 
     def __init__(self, name, host, port=9999, timeout=10, connect=True):
-        print(host, port, timeout, connect)
+        logger.debug("Power strip at %s:%s, timeout %s, connect %s", host, port, timeout, connect)
         super().__init__(host=host, port=port, connect=connect)
         super().__init__(name)
         self.state = {"relayState": "OFF"}
 
     def setRelay(self, newRelay):
-        print(newRelay)
+        logger.debug("Setting relay %s", newRelay)
         if newRelay == "OFF":
             super().send({"system": {"set_relay_state": {"state": 0}}})
         elif newRelay == "ON":
@@ -226,10 +401,13 @@ class Plug(tp.TPLinkSmartDevice, BaseController):
     def reset(self):
         super().send({"system": {"set_relay_state": {"state": 0}}})
         super().close()
+        self.state["relayState"] = "OFF"
 
 
 class StepperSimple(stp.Motor, BaseController):
     deviceType = "controller"
+    commands = {"move": 1, "goto": 1}
+    persistState = True
 
     def __init__(self, name, pins, delay=0.02, refPoints={}):
         super().__init__(pins, delay)
@@ -239,7 +417,7 @@ class StepperSimple(stp.Motor, BaseController):
         self.state = {"position": self.currentPosition}
 
     def move(self, steps):
-        print(steps)
+        logger.debug("%s moving %s steps", self.name, steps)
         super().move(steps)
         super().release()
         self.currentPosition += steps
@@ -253,7 +431,7 @@ class StepperSimple(stp.Motor, BaseController):
         return int(params[0])
 
     def goto(self, position):
-        print(position)
+        logger.debug("%s going to %s", self.name, position)
         endPoint = self.refPoints[position]
         self.move(endPoint - self.currentPosition)
 
@@ -265,12 +443,21 @@ class StepperSimple(stp.Motor, BaseController):
     # def cleanup(self):
     #     super().cleanup()
 
+    def restoreState(self, state):
+        super().restoreState(state)
+        self.currentPosition = self.state["position"]
+
     def reset(self):
+        # rpistepper's reset steps the motor back to where it started.
         super().reset()
+        self.currentPosition = 0
+        self.state["position"] = self.currentPosition
 
 
 class DCMotorI2C(MotorKit, BaseController):
     deviceType = "controller"
+    coalescable = ("throttle",)
+    commands = {"throttle": 1}
 
     def __init__(self, name, terminal):
         if terminal > 4:
@@ -292,7 +479,7 @@ class DCMotorI2C(MotorKit, BaseController):
         }
         self.device = self.terminal_options[terminal]
         self.currentPosition = 0
-        self.state = {"position": self.currentPosition}
+        self.state = {"position": self.currentPosition, "throttle": 0}
 
     def setup(self, style):
         pass
@@ -300,13 +487,16 @@ class DCMotorI2C(MotorKit, BaseController):
     def reset(self):
         pass
 
+    # An I2C write to the motor hat, which waits on the bus behind any stepper
+    # step, so it runs in an executor rather than on the event loop.
     def throttle(self, speed):
         self.device.throttle = speed
+        self.state["throttle"] = speed
 
     def throttle_parser(self, params):
         if len(params) != 1:
             raise ArgumentNumberError(len(params), 1, "move")
-        print("Throttle is set to: {0}".format(params[0]))
+        logger.debug("Throttle is set to: %s", params[0])
         return float(params[0])
 
 
@@ -318,6 +508,8 @@ class DCMotorI2C(MotorKit, BaseController):
 
 class StepperI2C(MotorKit, BaseController):
     deviceType = "controller"
+    commands = {"move": 1, "goto": 1, "admingoto": 1, "degMove": 1, "home": None}
+    persistState = True
 
     def __init__(
         self,
@@ -366,6 +558,8 @@ class StepperI2C(MotorKit, BaseController):
         self.homing = False
         self.degPerStep = degPerStep
         self.gearRatio = gearRatio
+        # Rates and jitter of the last move, see steptiming.StepScheduler.report.
+        self.stepTiming = None
         time.sleep(0.2)  # Adding this to see if it released prooperly
         self.device.release()
         time.sleep(0.2)  # Adding this to see if it released prooperly
@@ -374,7 +568,7 @@ class StepperI2C(MotorKit, BaseController):
         pass
 
     def move(self, steps):
-        print(steps)
+        logger.debug("%s moving %s steps", self.name, steps)
         if steps >= 0:
             direction = stepper.BACKWARD
         else:
@@ -384,24 +578,38 @@ class StepperI2C(MotorKit, BaseController):
         elif self.currentPosition + steps > self.upperBound and steps > 0:
             steps = self.upperBound - self.currentPosition
 
-        for i in range(abs(steps)):
-            if len(self.limitSwitches) != 0:
-                for switch in self.limitSwitches:
-                    status = switch.getStatus(1)
-                    if status == gpio.HIGH:
-                        response = switch.switchAction(self, steps - i)
-                        if response is None:
-                            return ("ALERT", "{0}/{1}/{2}".format(self.name, "position", "limit"))
-                        else:
-                            return ("MESSAGE", response)
-
-            if self.homing:
-                homeStatus = self.homeSwitch.getStatus(1)
-                if homeStatus == gpio.HIGH:
-                    return True
-
-            self.device.onestep(style=self.style, direction=direction)
-            time.sleep(self.delay)
+        sign = 1 if steps >= 0 else -1
+        target = self.currentPosition + steps
+        schedule = StepScheduler(self.delay)
+        try:
+            for i in range(abs(steps)):
+                if self.cancelToken.cancelled:
+                    self.currentPosition += sign * i
+                    self.state["position"] = self.currentPosition
+                    self.device.release()
+                    return ("ALERT", "{0}/{1}/{2}".format(self.name, "cancelled", self.currentPosition))
+                if len(self.limitSwitches) != 0:
+                    for switch in self.limitSwitches:
+                        status = switch.getStatus(1)
+                        if status == gpio.HIGH:
+                            response = switch.switchAction(self, steps - i)
+                            if response is None:
+                                return ("ALERT", "{0}/{1}/{2}".format(self.name, "position", "limit"))
+                            else:
+                                return ("MESSAGE", response)
+
+                if self.homing:
+                    homeStatus = self.homeSwitch.getStatus(1)
+                    if homeStatus == gpio.HIGH:
+                        return True
+
+                self.device.onestep(style=self.style, direction=direction)
+                self.reportProgress(
+                    position=self.currentPosition + sign * (i + 1), target=target
+                )
+                schedule.wait()
+        finally:
+            self.recordStepTiming(schedule)
 
         self.currentPosition += steps
         self.state["position"] = self.currentPosition
@@ -419,6 +627,25 @@ class StepperI2C(MotorKit, BaseController):
             raise ArgumentNumberError(len(params), 1, "move")
         return int(params[0])
 
+    def recordStepTiming(self, schedule):
+        if schedule.steps == 0:
+            return
+        self.stepTiming = schedule.report()
+        # Only moves that fell behind or stepped unevenly are worth a line in journald.
+        troubled = self.stepTiming["resyncs"] or (
+            schedule.interval > 0 and self.stepTiming["jitter"] > schedule.interval / 2
+        )
+        logger.log(
+            logging.INFO if troubled else logging.DEBUG,
+            "%s made %d steps at %s of %s steps/s, jitter %.2f ms, %d resyncs",
+            self.name,
+            self.stepTiming["steps"],
+            self.stepTiming["achievedRate"],
+            self.stepTiming["requestedRate"],
+            self.stepTiming["jitter"] * 1e3,
+            self.stepTiming["resyncs"],
+        )
+
     def adminMove(self, steps):
         if steps >= 0:
             direction = stepper.BACKWARD
@@ -428,24 +655,28 @@ class StepperI2C(MotorKit, BaseController):
             steps = self.lowerBound - self.currentPosition
         elif self.currentPosition + steps > self.upperBound and steps > 0:
             steps = self.upperBound - self.currentPosition
+        schedule = StepScheduler(self.delay)
         for i in range(abs(steps)):
+            if self.cancelToken.cancelled:
+                steps = (1 if steps >= 0 else -1) * i
+                break
             self.device.onestep(style=self.style, direction=direction)
-            time.sleep(self.delay)
+            schedule.wait()
+        self.recordStepTiming(schedule)
         self.currentPosition += steps
         self.state["position"] = self.currentPosition
         self.device.release()
 
     def goto(self, position):
-        print(position)
+        logger.debug("%s going to %s", self.name, position)
         endPoint = self.refPoints[position]
-        response = self.move(endPoint - self.currentPosition)
-        return ("MESSAGE", response)
+        # move already returns a (type, result) pair, e.g. an ALERT when cancelled.
+        return self.move(endPoint - self.currentPosition)
 
     def admingoto(self, position):
-        print(position)
+        logger.debug("%s going to %s", self.name, position)
         endPoint = self.refPoints[position]
-        response = self.adminMove(endPoint - self.currentPosition)
-        return ("MESSAGE", response)
+        return self.adminMove(endPoint - self.currentPosition)
 
     def goto_parser(self, params):
         if len(params) != 1:
@@ -465,7 +696,7 @@ class StepperI2C(MotorKit, BaseController):
         return steps
 
     def degMove(self, deg):
-        print("{0} degrees".format(deg))
+        logger.debug("%s moving %s degrees", self.name, deg)
         step = deg / self.degPerStep
         step = int(step * self.gearRatio)
         step = round(step)
@@ -483,6 +714,10 @@ class StepperI2C(MotorKit, BaseController):
         self.move(direction * stepLimit)
         self.move(direction * additionalSteps)
 
+    def restoreState(self, state):
+        super().restoreState(state)
+        self.currentPosition = self.state["position"]
+
     def reset(self):
         if self.homeSwitch is not None:
             self.home(1)
@@ -495,7 +730,7 @@ class StepperI2C(MotorKit, BaseController):
             self.customHome(self)
             self.homing = False
         else:
-            print("No homing switch is attached to this motor")
+            logger.warning("No homing switch is attached to %s", self.name)
 
     def customHome(self, motor):
         pass
@@ -567,6 +802,8 @@ class FilterStepperI2C(StepperI2C):
 
 class AbsorberController(BaseController):  # Removed MotorKit subclass @ZakEspley
     deviceType = "controller"
+    commands = {"place": None}
+    persistState = True
 
     def __init__(
         self,
@@ -598,7 +835,7 @@ class AbsorberController(BaseController):  # Removed MotorKit subclass @ZakEsple
                 "s4": False,
                 "s5": False,
             },
-            "total": self.initialState,
+            "total": dict(self.initialState),
         }
 
     def setup(self, style):
@@ -623,9 +860,7 @@ class AbsorberController(BaseController):  # Removed MotorKit subclass @ZakEsple
         absorber = self.state["total"][slot1]
         # print(f"Transfer {absorber} from {slot1} --> {slot2}")
         if self.state["total"][slot2] != "":
-            print(
-                f'!!!!!!!!!!!WARNING:  Slot {slot2} already full with {self.state["total"][slot2]}'
-            )
+            logger.warning("Slot %s already full with %s", slot2, self.state["total"][slot2])
             raise
         # global x
         # x += 1
@@ -685,7 +920,7 @@ class AbsorberController(BaseController):  # Removed MotorKit subclass @ZakEsple
             currentAbsInSlot = self.__getAbsorber(slot)
             # Get the location of the current absorber
             currentAbsLocation = self.__getSlot(ab)
-            print(f"Absorber: {ab}  Location: {currentAbsLocation}")
+            logger.debug("Absorber: %s  Location: %s", ab, currentAbsLocation)
 
             # Determine if the absorber is used later down the line
             absorberUsed = currentAbsInSlot in absorbers
@@ -726,13 +961,13 @@ class AbsorberController(BaseController):  # Removed MotorKit subclass @ZakEsple
         ## Now we should identify chains.
         chains = self.__chainDetect(moveList["internal"])
         internalStarts = [item[0] for item in moveList["internal"]]
-        print("Pre-chains: {0}".format(moveList))
+        logger.debug("Pre-chains: %s", moveList)
         for chain in chains:
             for move in chain:
                 moveList["internal"].remove(move)
 
         moveList["chains"] = chains
-        print("Post-chains: {0}".format(moveList))
+        logger.debug("Post-chains: %s", moveList)
         return moveList
 
     def __chainDetect(self, movements):
@@ -825,7 +1060,7 @@ class AbsorberController(BaseController):  # Removed MotorKit subclass @ZakEsple
         unloads = moveList["unload"]
         loads = moveList["load"]
         internals = moveList["internal"]
-        print("INTERNALS:{0}".format(internals))
+        logger.debug("INTERNALS: %s", internals)
         unloadStarts = [item[0] for item in unloads]
         UILGroups = []
         ILGroups = []
@@ -855,19 +1090,19 @@ class AbsorberController(BaseController):  # Removed MotorKit subclass @ZakEsple
                     ILGroups.append(temp)
 
         if len(internals) > 0:
-            print("Starting Internals")
+            logger.debug("Starting internals")
             internalStarts = [item[0] for item in internals]
             internalFinish = [item[1] for item in internals]
             intersection = [item for item in internalFinish if item in internalStarts]
-            print("Intersections: {0}".format(intersection))
+            logger.debug("Intersections: %s", intersection)
             starts = [internal for internal in internals if internal[1] in intersection]
             for start in starts:
                 internals.remove(start)
-            print("INTERNALS2:{0}".format(internals))
-            print("STARTS:{0}".format(starts))
+            logger.debug("INTERNALS2: %s", internals)
+            logger.debug("STARTS: %s", starts)
             for startingI in starts:
                 temp = self.__chaseInternal(internals, startingI)
-                print("CHASEINTERNALS:{0}".format(temp))
+                logger.debug("CHASEINTERNALS: %s", temp)
                 internalStarts = [item[0] for item in internals]
                 nextSlot = temp[0][1]
                 # print(f"Checking for conflict with unload. Slot {nextSlot}")
@@ -951,7 +1186,7 @@ class AbsorberController(BaseController):  # Removed MotorKit subclass @ZakEsple
             if len(UIGroups) > 0:
                 moves = UIGroups.pop(0) + moves
             elif len(unloads) > 0:
-                print(unloads)
+                logger.debug("Unloads: %s", unloads)
                 moves.insert(0, unloads.pop(0))
 
         while len(IGroups) > 0:
@@ -994,8 +1229,11 @@ class AbsorberController(BaseController):  # Removed MotorKit subclass @ZakEsple
             moves = self.__handleChains(moveList["chains"], moves)
 
         # pp.pprint(moveList)
-        print("Moves:{0}".format(moves))
-        for move in moves:
+        logger.debug("Moves: %s", moves)
+        for i, move in enumerate(moves):
+            # Only stop between transfers so an absorber is never left on the magnet.
+            if self.cancelToken.cancelled:
+                return ("ALERT", "{0}/{1}/{2}".format(self.name, "cancelled", i))
             self.__transfer(move[0], move[1])
 
     def place_parser(self, params):
@@ -1017,6 +1255,7 @@ class AbsorberController(BaseController):  # Removed MotorKit subclass @ZakEsple
 
 class Multiplexer(BaseController):
     deviceType = "controller"
+    commands = {"press": 1}
 
     def __init__(
         self,
@@ -1028,8 +1267,8 @@ class Multiplexer(BaseController):
         defaultState=gpio.HIGH,
         delay=0.1,
     ):
-        self.state = {}
         super().__init__(name)
+        self.state = {"channel": defaultChannel}
         self.delay = delay
         self.pins = pins
         self.channels = channels
@@ -1058,10 +1297,11 @@ class Multiplexer(BaseController):
 
             gpio.output(pin, pinstate)
 
-    def press(self, channel):
+    async def press(self, channel):
         self.__setChannel(channel)
+        self.state["channel"] = channel
         gpio.output(self.inhibitorPin, gpio.LOW)
-        time.sleep(self.delay)
+        await asyncio.sleep(self.delay)
         gpio.output(self.inhibitorPin, gpio.HIGH)
 
     def press_parser(self, params):
@@ -1076,10 +1316,12 @@ class Multiplexer(BaseController):
         if self.defaultChannel is not None:
             self.__setChannel(self.defaultChannel)
         gpio.output(self.inhibitorPin, self.defaultState)
+        self.state["channel"] = self.defaultChannel
 
 
 class Keithley6514Electrometer(BaseController):
     deviceType = "measurement"
+    commands = {"press": 1}
 
     def __init__(self, name, usbAddress):
         super().__init__(name)
@@ -1094,11 +1336,12 @@ class Keithley6514Electrometer(BaseController):
     def press(self, params):
         self.inst.write("SYST:REM")
         self.inst.write(params)
+        self.state["setting"] = params
         if params != "SYST:KEY 1":
             self.inst.write("SYST:LOC")
 
     def press_parser(self, params):
-        print(">>", params)
+        logger.debug("%s >> %s", self.name, params)
         return params[0]
 
     def reset(self):
@@ -1107,6 +1350,7 @@ class Keithley6514Electrometer(BaseController):
 
 class Keithley2000Multimeter(BaseController):
     deviceType = "measurement"
+    commands = {"press": 1}
 
     def __init__(self, name, usbAddress):
         super().__init__(name)
@@ -1121,9 +1365,10 @@ class Keithley2000Multimeter(BaseController):
     def press(self, params):
         self.inst.write("SYST:REM")
         self.inst.write(params)
+        self.state["setting"] = params
 
     def press_parser(self, params):
-        print(">>", params)
+        logger.debug("%s >> %s", self.name, params)
         return params[0]
 
     def reset(self):
@@ -1132,6 +1377,8 @@ class Keithley2000Multimeter(BaseController):
 
 class PololuStepperMotor(BaseController):
     deviceType = "controller"
+    commands = {"move": 1, "goto": 1, "degMove": 1, "home": None}
+    persistState = True
 
     def __init__(
         self,
@@ -1181,6 +1428,8 @@ class PololuStepperMotor(BaseController):
         self.homing = False
         self.degPerStep = degPerStep
         self.gearRatio = gearRatio
+        # pigpio sends one wave at a time for the whole Pi; only stop the one we started.
+        self.sendingWave = False
 
     def move(self, steps):
         # Choose direction
@@ -1207,6 +1456,7 @@ class PololuStepperMotor(BaseController):
         step_x = absteps % 256
 
         pi.write(self.enablePin, 1)
+        start = time.monotonic()
         ## Wave Chains seems incredibly stupid.
         ## To see how to do it check out http://abyz.me.uk/rpi/pigpio/python.html#wave_chain
         pi.wave_chain(
@@ -1220,12 +1470,33 @@ class PololuStepperMotor(BaseController):
                 step_y,  # Repeat loop x + 256*y times.
             ]
         )
+        self.sendingWave = True
 
+        # The wave runs on pigpio's DMA so we can only estimate the position from
+        # the elapsed time and the pulse period.
+        stepPeriod = self.delay * 1e-6
+        sign = 1 if steps >= 0 else -1
         while pi.wave_tx_busy():
-            time.sleep(0.1)
+            if self.cancelToken.cancelled:
+                pi.wave_tx_stop()
+                break
+            done = min(absteps, int((time.monotonic() - start) / stepPeriod))
+            self.reportProgress(
+                position=self.currentPosition + sign * done,
+                target=self.currentPosition + steps,
+            )
+            time.sleep(min(0.1, self.progressInterval()))
+        self.sendingWave = False
 
         pi.write(self.enablePin, 0)
 
+        if self.cancelToken.cancelled:
+            # abort() may have stopped the wave already; estimate how far it got.
+            done = min(absteps, int((time.monotonic() - start) / stepPeriod))
+            self.currentPosition += sign * done
+            self.state["position"] = self.currentPosition
+            return ("ALERT", "{0}/{1}/{2}".format(self.name, "cancelled", self.currentPosition))
+
         self.currentPosition += steps
         self.state["position"] = self.currentPosition
 
@@ -1237,13 +1508,17 @@ class PololuStepperMotor(BaseController):
         else:
             return ("MESSAGE", "{0}/{1}/{2}".format(self.name, "position", self.currentPosition))
 
+    def abort(self):
+        if self.sendingWave:
+            pi.wave_tx_stop()
+
     def move_parser(self, params):
         if len(params) != 1:
             raise ArgumentNumberError(len(params), 1, "move")
         return int(params[0])
 
     def goto(self, position):
-        print(position)
+        logger.debug("%s going to %s", self.name, position)
         endPoint = self.refPoints[position]
         self.move(endPoint - self.currentPosition)
 
@@ -1260,7 +1535,7 @@ class PololuStepperMotor(BaseController):
         return steps
 
     def degMove(self, deg):
-        print("{0} degrees".format(deg))
+        logger.debug("%s moving %s degrees", self.name, deg)
         step = deg / self.degPerStep
         step = int(step * self.gearRatio)
         step = round(step)
@@ -1278,6 +1553,10 @@ class PololuStepperMotor(BaseController):
         self.move(direction * stepLimit)
         self.move(direction * additionalSteps)
 
+    def restoreState(self, state):
+        super().restoreState(state)
+        self.currentPosition = self.state["position"]
+
     def reset(self):
         if self.homeSwitch is not None:
             self.home(1)
@@ -1291,7 +1570,7 @@ class PololuStepperMotor(BaseController):
             self.customHome(self)
             self.homing = False
         else:
-            print("No homing switch is attached to this motor")
+            logger.warning("No homing switch is attached to %s", self.name)
 
     def customHome(self, motor):
         pass
@@ -1299,6 +1578,9 @@ class PololuStepperMotor(BaseController):
 
 class PololuDCMotor(BaseController):
     deviceType = "controller"
+    fastIO = True
+    coalescable = ("throttle",)
+    commands = {"throttle": 1}
 
     def __init__(
         self,
@@ -1350,13 +1632,14 @@ class PololuDCMotor(BaseController):
         # self.pwm = gpio.PWM(self.pwmPin, self.frequency)
         # self.pwm.start(dutyCycle)
 
-        self.state = {}
+        self.state = {"throttle": 0}
 
     def __stop(self, gpio, level, tick):
-        print("MOTOR IS CRASHING! HALTING!")
+        logger.error("%s is crashing! Halting!", self.name)
         self.throttle(self.throttle_parser([1]))
         time.sleep(2)
         self.throttle(self.throttle_parser([0]))
+        self.stateChanged("halt")
         pi.stop()
         sys.exit(0)
         # self.pulseCount += 1
@@ -1364,6 +1647,7 @@ class PololuDCMotor(BaseController):
         # gpio.cleanup()
         # sys.exit(0)
 
+    @nonblocking
     def throttle(self, speed):
         # if speed >= 0:
         #     # gpio.output(self.directionPin, gpio.LOW)
@@ -1374,6 +1658,7 @@ class PololuDCMotor(BaseController):
         self.dutyCycle = abs(speed)
         # self.pwm.ChangeDutyCycle(self.dutyCycle)
         pi.set_PWM_dutycycle(self.pwmPin, self.dutyCycle)
+        self.state["throttle"] = speed / self.pwmScaler
 
     def throttle_parser(self, params):
         if len(params) != 1:
@@ -1394,6 +1679,7 @@ class PololuDCMotor(BaseController):
 
 class ArduCamMultiCamera(BaseController):
     deviceType = "measurement"
+    commands = {"camera": 1, "cameraName": 1, "imageMod": 2}
 
     def __init__(
         self,
@@ -1410,7 +1696,7 @@ class ArduCamMultiCamera(BaseController):
         self.videoNumber = videoNumber
         self.numCameras = numCameras
         self.experiment = None
-        self.state = {}
+        self.state = {"camera": None, "settings": {}}
         self.defaultSettings = defaultSettings
         self.i2cbus = i2cbus
         self.cameraNames = cameraNamesDict
@@ -1445,17 +1731,30 @@ class ArduCamMultiCamera(BaseController):
         for i in range(self.numCameras):
             self.camera(_cameraNames[i])
             time.sleep(5)
-        if initialCamera in _cameraNames:
-            self.camera(initialCamera)
-        else:
-            self.cameraName(initialCamera)
+        self.selectInitialCamera()
         time.sleep(5)
+        # Start with the settings a reset restores, so a reset leaves the camera clean.
+        self.applyDefaultSettings()
+
+    def selectInitialCamera(self):
+        if self.initialCamera in self.camerai2c:
+            self.camera(self.initialCamera)
+        else:
+            self.cameraName(self.initialCamera)
+
+    def applyDefaultSettings(self):
+        self.state["settings"] = {}
+        if self.defaultSettings is not None:
+            for setting, value in self.defaultSettings.items():
+                self.imageMod([setting, value])
+                time.sleep(0.1)
 
     def camera(self, param):
         # Param should be a, b, c, d, or off
-        print("Switching to camera " + param)
+        logger.debug("Switching to camera %s", param)
         os.system(self.camerai2c[param])
         gpio.output(self.channels, self.cameraDict[param])
+        self.state["camera"] = param
 
     def camera_parser(self, params):
         if len(params) != 1:
@@ -1469,9 +1768,10 @@ class ArduCamMultiCamera(BaseController):
     # The name should be translated from the dictionary self.cameraNames
     def cameraName(self, param):
         cameraSlot = self.cameraNames[param]
-        print("Switching to camera {0}, slot {1}".format(param, cameraSlot))
+        logger.debug("Switching to camera %s, slot %s", param, cameraSlot)
         os.system(self.camerai2c[cameraSlot])
         gpio.output(self.channels, self.cameraDict[cameraSlot])
+        self.state["camera"] = cameraSlot
 
     def cameraName_parser(self, params):
         if len(params) != 1:
@@ -1490,6 +1790,7 @@ class ArduCamMultiCamera(BaseController):
             ),
             shell=True,
         )
+        self.state["settings"][imageControl] = controlValue
 
     def imageMod_parser(self, params):
         if len(params) != 2:
@@ -1497,15 +1798,14 @@ class ArduCamMultiCamera(BaseController):
         return params
 
     def reset(self):
-        self.camera(self.initialCamera)
-        if self.defaultSettings is not None:
-            for setting, value in self.defaultSettings.items():
-                self.imageMod([setting, value])
-                time.sleep(0.1)
+        self.selectInitialCamera()
+        self.applyDefaultSettings()
 
 
 class ElectronicScreen(BaseController):
     deviceType = "controller"
+    fastIO = True
+    commands = {"on": None, "off": None}
 
     def __init__(self, name, pin):
         super().__init__(name)
@@ -1513,18 +1813,25 @@ class ElectronicScreen(BaseController):
         self.state = "off"
         gpio.setup(self.pin, gpio.OUT)
 
+    @nonblocking
     def on(self, params):
         gpio.output(self.pin, gpio.HIGH)
+        self.state = "on"
 
+    @nonblocking
     def off(self, params):
         gpio.output(self.pin, gpio.LOW)
+        self.state = "off"
 
     def reset(self):
         gpio.output(self.pin, gpio.LOW)
+        self.state = "off"
 
 
 class LimitSwitch(BaseController):
     deviceType = "controller"
+    fastIO = True
+    commands = {"getStatus": None}
 
     def __init__(self, name, pin, state=False):
         super().__init__(name)
@@ -1532,6 +1839,7 @@ class LimitSwitch(BaseController):
         self.state = state
         gpio.setup(self.pin, gpio.IN, pull_up_down=gpio.PUD_DOWN)
 
+    @nonblocking
     def getStatus(self, params):
         state = gpio.input(self.pin)
         self.state = state
@@ -1546,6 +1854,8 @@ class LimitSwitch(BaseController):
 
 class HomeSwitch(BaseController):
     deviceType = "controller"
+    fastIO = True
+    commands = {"getStatus": None}
 
     def __init__(self, name, pin, state=False):
         super().__init__(name)
@@ -1553,6 +1863,7 @@ class HomeSwitch(BaseController):
         self.state = state
         gpio.setup(self.pin, gpio.IN, pull_up_down=gpio.PUD_DOWN)
 
+    @nonblocking
     def getStatus(self, params):
         state = gpio.input(self.pin)
         self.state = state
@@ -1564,30 +1875,38 @@ class HomeSwitch(BaseController):
 
 class SingleGPIO(BaseController):
     deviceType = "controller"
+    fastIO = True
+    commands = {"on": None, "off": None}
 
     def __init__(self, name, pin, initialState=False):
         super().__init__(name)
         self.pin = pin
         gpio.setup(self.pin, gpio.OUT)
         if initialState:
-            self.state = "off"
+            self.state = "on"
             gpio.output(self.pin, gpio.HIGH)
         else:
             self.state = "off"
             gpio.output(self.pin, gpio.LOW)
 
+    @nonblocking
     def on(self, params):
         gpio.output(self.pin, gpio.HIGH)
+        self.state = "on"
 
+    @nonblocking
     def off(self, params):
         gpio.output(self.pin, gpio.LOW)
+        self.state = "off"
 
     def reset(self):
         gpio.output(self.pin, gpio.LOW)
+        self.state = "off"
 
 
 class PushButton(BaseController):
     deviceType = "controller"
+    commands = {"press": None}
 
     def __init__(self, name, pin, initialState=False, delay=0.1):
         super().__init__(name)
@@ -1602,14 +1921,14 @@ class PushButton(BaseController):
             self.state = "off"
             gpio.output(self.pin, gpio.LOW)
 
-    def press(self, params):
+    async def press(self, params):
         if self.initialState:
             gpio.output(self.pin, gpio.LOW)
-            time.sleep(self.delay)
+            await asyncio.sleep(self.delay)
             gpio.output(self.pin, gpio.HIGH)
         else:
             gpio.output(self.pin, gpio.HIGH)
-            time.sleep(self.delay)
+            await asyncio.sleep(self.delay)
             gpio.output(self.pin, gpio.LOW)
 
     def reset(self):
@@ -1618,6 +1937,9 @@ class PushButton(BaseController):
 
 class PWMChannel(BaseController):
     deviceType = "controller"
+    fastIO = True
+    coalescable = ("power",)
+    commands = {"power": 1}
 
     def __init__(self, name, pin, frequency, defaultDutyCycle=0):
         super().__init__(name)
@@ -1628,10 +1950,12 @@ class PWMChannel(BaseController):
         gpio.setup(self.pin, gpio.OUT)
         self.pwm = gpio.PWM(self.pin, self.frequency)
         self.pwm.start(self.dutyCycle)
-        self.state = {}
+        self.state = {"dutyCycle": self.dutyCycle}
 
+    @nonblocking
     def power(self, dutyCycle):
         self.pwm.ChangeDutyCycle(dutyCycle)
+        self.state["dutyCycle"] = dutyCycle
 
     def power_parser(self, params):
         if len(params) != 1:
@@ -1645,6 +1969,7 @@ class PWMChannel(BaseController):
 
     def reset(self):
         self.pwm.ChangeDutyCycle(self.defaultDutyCycle)
+        self.state["dutyCycle"] = self.defaultDutyCycle
 
 
 class S42CStepperMotor(BaseController):
@@ -1703,6 +2028,8 @@ class S42CStepperMotor(BaseController):
     """
 
     deviceType = "controller"
+    commands = {"move": 1, "goto": 1}
+    persistState = True
 
     def __init__(
         self,
@@ -1775,6 +2102,8 @@ class S42CStepperMotor(BaseController):
         # Always enable closed loop control. EN is active low.
         self.pi.write(self.EN, 0)
         self.state = {"position": self.curPos}
+        # pigpio sends one wave at a time for the whole Pi; only stop the one we started.
+        self.sendingWave = False
 
     def move_parser(self, params: list) -> int:
         """
@@ -1820,22 +2149,38 @@ class S42CStepperMotor(BaseController):
             raise ArgumentError(self.name, "degMove", params)
         return deg
 
-    def __sqGenPWM(self, pin, period, num):
+    def __sqGenPWM(self, pin, period, num, sign=1):
         pOn = pigpio.pulse(1 << self.STEP, 0, int(self.delay * 1e6 / 2))
         pOff = pigpio.pulse(0, 1 << self.STEP, int(self.delay * 1e6 / 2))
         pulse = [pOn, pOff]
-        pi.wave_clear()
-        pi.wave_add_generic(pulse)
-        stepWave = pi.wave_create()
+        self.pi.wave_clear()
+        self.pi.wave_add_generic(pulse)
+        stepWave = self.pi.wave_create()
 
         absteps = abs(num)
         step_y = absteps // 256
         step_x = absteps % 256
 
-        pi.wave_chain([255, 0, stepWave, 255, 1, step_x, step_y])
+        self.pi.wave_chain([255, 0, stepWave, 255, 1, step_x, step_y])
+        self.sendingWave = True
+        start = time.monotonic()
+
+        # Position is estimated from elapsed time; the wave itself runs on DMA.
+        while self.pi.wave_tx_busy():
+            if self.cancelToken.cancelled:
+                self.pi.wave_tx_stop()
+                break
+            done = min(absteps, int((time.monotonic() - start) / self.delay))
+            self.reportProgress(
+                position=self.state["position"] + sign * done,
+                target=self.state["position"] + sign * absteps,
+            )
+            time.sleep(min(0.1, self.progressInterval()))
+        self.sendingWave = False
 
-        while pi.wave_tx_busy():
-            time.sleep(0.1)
+        if self.cancelToken.cancelled:
+            return min(absteps, int((time.monotonic() - start) / self.delay))
+        return absteps
 
     def move(self, steps: int):
         """
@@ -1913,7 +2258,12 @@ class S42CStepperMotor(BaseController):
         else:
             self.pi.write(self.DIR, 0)
 
-        self.__sqGenPWM(self.STEP, self.delay, abs(moveSteps))
+        sign = 1 if moveSteps >= 0 else -1
+        done = self.__sqGenPWM(self.STEP, self.delay, abs(moveSteps), sign)
+        if self.cancelToken.cancelled:
+            self.curPos += sign * done
+            self.state["position"] += sign * done
+            return ("ALERT", "{0}/{1}/{2}".format(self.name, "cancelled", self.state["position"]))
         time.sleep(self.stepWaitTime * abs(moveSteps))
 
         # update self.curPos and self.state
@@ -1947,12 +2297,23 @@ class S42CStepperMotor(BaseController):
             target = self.refPoints[ref]
             return self.move(target - self.curPos)
 
+    def abort(self):
+        if self.sendingWave:
+            self.pi.wave_tx_stop()
+
+    def restoreState(self, state):
+        super().restoreState(state)
+        self.curPos = self.state["position"]
+
     def reset(self):
         return self.move(-self.curPos)
 
 
 class FS5103RContinuousMotor(BaseController):
     deviceType = "controller"
+    fastIO = True
+    coalescable = ("throttle",)
+    commands = {"throttle": 1, "disable": 0}
 
     def __init__(self, name, PWM, limitPin=None, _reversed=False, pi=None):
         """
@@ -1979,7 +2340,7 @@ class FS5103RContinuousMotor(BaseController):
         self._reversed = _reversed
         # The host Rpi, in case multihost systems are used in the future
         if not pi:
-            self.pi = pigpio.pi()
+            self.pi = sharedPi
         else:
             self.pi = pi
             warn("Foreign controls may not be supported.", RuntimeWarning)
@@ -2002,6 +2363,7 @@ class FS5103RContinuousMotor(BaseController):
             self.pi.set_pull_up_down(self.PWM, pigpio.PUD_DOWN)
         self.state = {"running": False, "throttle": 0}
 
+    @nonblocking
     def throttle(self, throttle):
         """
         args:
@@ -2023,6 +2385,7 @@ class FS5103RContinuousMotor(BaseController):
         )
         # print(self.name, f"has reached its limit. status {level}")
         self.throttle(0)
+        self.stateChanged("limit")
 
     def __resetCallback(self, gpio, level, tick):
         self.startCallback.cancel()
@@ -2031,6 +2394,7 @@ class FS5103RContinuousMotor(BaseController):
         )
         # print(self.name, f"stop callback reset. status {level}")
 
+    @nonblocking
     def disable(self):
         self.pi.set_mode(self.PWM, pigpio.INPUT)
         self.state["running"] = False
@@ -2055,6 +2419,9 @@ class FS5103RContinuousMotor(BaseController):
 
 class GeneralPWMServo(BaseController):
     deviceType = "controller"
+    fastIO = True
+    coalescable = ("goto",)
+    commands = {"goto": 1, "disable": 0}
 
     def __init__(self, name, PWM, pi=None):
         """
@@ -2071,7 +2438,7 @@ class GeneralPWMServo(BaseController):
         super().__init__(name)
         self.PWM = PWM
         if not pi:
-            self.pi = pigpio.pi()
+            self.pi = sharedPi
         else:
             self.pi = pi
             warn("Foreign controls may not be supported.", RuntimeWarning)
@@ -2088,6 +2455,7 @@ class GeneralPWMServo(BaseController):
         except:
             raise ArgumentError(self.name, "goto", params[0], float)
 
+    @nonblocking
     def goto(self, angle):
         """
         This method will use one of the PWM channels on the pi to control
@@ -2105,6 +2473,7 @@ class GeneralPWMServo(BaseController):
         self.state["angle"] = angle
         return self.state
 
+    @nonblocking
     def disable(self):
         """
         This method will stop the servo control and free up the PWM channel.
@@ -2119,6 +2488,93 @@ class GeneralPWMServo(BaseController):
         pass
 
 
+class RemoteDevice(BaseController):
+    """
+    A device served by another remla node, see gateway.py. Its commands are sent
+    to the node and its state mirrors what the node broadcasts.
+    """
+
+    deviceType = "remote"
+
+    def __init__(self, name, node, commands, remoteName=None, timeout=120.0):
+        """
+        :param node: The node's websocket address, e.g. ``ws://pi2.local:8675``.
+        :param commands: The device's commands mapped to how many params they take,
+            as on the node.
+        :param remoteName: The device's name on the node, defaults to ``name``.
+        :param timeout: Seconds to wait for the node to finish a command or reset.
+        """
+        super().__init__(name)
+        self.node = connectionFor(node)
+        self.commands = dict(commands)
+        self.remoteName = remoteName or name
+        self.timeout = timeout
+        self.state = {}
+        # The first snapshot from the node is the device's starting state.
+        self.mirrored = False
+        self.node.watch(self.remoteName, self.onRemoteFrame)
+
+    def commandTable(self):
+        # Every command is the same coroutine, so they all run on the event loop.
+        return {
+            cmd: Command(cmd, functools.partial(self.forward, cmd), None, arity)
+            for cmd, arity in self.commands.items()
+        }
+
+    async def forward(self, cmd, params=None):
+        reply, seconds = await self.node.request(
+            self.remoteName, cmd, params or [], timeout=self.timeout
+        )
+        if self.experiment is not None:
+            self.experiment.metrics.hopSeconds.observe(seconds, node=self.node.url)
+        return reply["type"].upper(), reply.get("result")
+
+    def onRemoteFrame(self, kind, body):
+        if kind == "progress":
+            if self.experiment is not None:
+                self.experiment.publishProgress(self.name, body)
+            return
+        if kind == "state" and isinstance(self.state, dict) and isinstance(body, dict):
+            self.state.update(body)
+        else:
+            self.state = copy.deepcopy(body)
+        if kind == "snapshot" and not self.mirrored:
+            self.mirrored = True
+            self.markClean()
+        self.stateChanged("remote")
+
+    def abort(self):
+        # Called on the event loop; the node cancels the command under its own locks.
+        task = asyncio.ensure_future(self.node.request(self.remoteName, "stop"))
+        task.add_done_callback(self.logAbort)
+
+    def logAbort(self, task):
+        if task.exception():
+            logger.error("Could not stop %s: %s", self.name, task.exception())
+
+    def reset(self):
+        # Runs on a worker thread while the event loop carries the request.
+        loop = self.experiment.loop if self.experiment is not None else None
+        try:
+            asyncio.get_running_loop()
+            onLoop = True
+        except RuntimeError:
+            onLoop = False
+        if loop is None or not loop.is_running() or onLoop:
+            # On shutdown the node resets its devices itself once the gateway leaves.
+            logger.info("Leaving the reset of %s to its node", self.name)
+            return
+        future = asyncio.run_coroutine_threadsafe(
+            self.node.request(self.remoteName, "reset", timeout=self.timeout), loop
+        )
+        try:
+            # The request times out on its own; this also bounds connecting to the node.
+            future.result(self.timeout + 2 * self.node.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise RemoteError(self.node.url, f"no reply to {self.remoteName}/reset")
+
+
 class CommandError(Exception):
     def __init__(self, command, *args):
         self.command = command
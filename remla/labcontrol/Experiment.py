@@ -1,18 +1,41 @@
 import asyncio
+import contextlib
+import copy
+import inspect
 import json
 import logging
 import os
 import socket
-import threading
-from collections import deque
+import time
+from collections import OrderedDict, defaultdict
 from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from urllib.parse import parse_qs, urlsplit
 from signal import SIGINT, signal
 
 import RPi.GPIO as gpio
 import websockets
 
+from remla.labcontrol import protocol
+from remla.labcontrol.admission import Admission
+from remla.labcontrol.events import (
+    CommandFinished,
+    EventBus,
+    Progress,
+    StateChanged,
+    StateDelta,
+)
+from remla.labcontrol.ipc import IpcConnection, IpcServer, defaultIpcPath
+from remla.labcontrol.journal import StateJournal
+from remla.labcontrol.logsetup import setupLogging, stopLogging
+from remla.labcontrol.metrics import CommandTiming, ExperimentMetrics
+from remla.labcontrol.statusserver import StatusServer
+from remla.labcontrol.tracing import JsonLinesSink, Tracer
+from remla.labcontrol.Controllers import CancelToken, CommandError, RemoteDevice
 from remla.settings import *
 
+logger = logging.getLogger(__name__)
+
 
 class NoDeviceError(Exception):
     def __init__(self, device_name):
@@ -24,191 +47,952 @@ class NoDeviceError(Exception):
         )
 
 
-def runMethod(device, method, params):
+def splitResponse(response):
+    # Controllers return either a (type, result) tuple or a bare result (often None).
+    if isinstance(response, tuple) and len(response) == 2:
+        return response
+    return "MESSAGE", response
+
+
+def stateDelta(old, new):
+    """
+    Compare two controller states. Returns (changed, delta) where delta holds the
+    changed top-level keys of a dict state (None for removed keys), or the whole
+    new state for anything else.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        delta = {
+            key: value
+            for key, value in new.items()
+            if key not in old or old[key] != value
+        }
+        for key in old:
+            if key not in new:
+                delta[key] = None
+        return bool(delta), delta
+    return old != new, new
+
+
+class PendingCommand(object):
+    """A coalescable command that is waiting for its lock group."""
+
+    def __init__(self, websocket, request=None):
+        self.websocket = websocket
+        self.request = request
+        self.superseded = False
+
+
+def runCommand(device, command, params, cancelToken=None):
+    if cancelToken is not None:
+        device.cancelToken = cancelToken
+    return command(params)
+
+
+def runTimed(timing, func, *args):
+    """Run func on an executor thread, stamping when the hardware work starts and ends."""
+    timing.hardwareStart = time.monotonic()
+    try:
+        return func(*args)
+    finally:
+        timing.hardwareEnd = time.monotonic()
+
+
+def runMethod(device, method, params, cancelToken=None):
     if hasattr(device, "cmdHandler"):
         func = getattr(device, "cmdHandler")
-        result = func(method, params, device.name)
+        result = func(method, params, device.name, cancelToken)
         return result
     else:
-        logging.error(f"Device {device} does not have a cmdHandler method")
+        logger.error("Device %s does not have a cmdHandler method", device)
         raise
 
 
+# Connections to this path are spectators, e.g. ws://lab:8675/spectate?protocol=json
+spectatorPath = "/spectate"
+
+
+metricsContentType = "text/plain; version=0.0.4; charset=utf-8"
+
+
 class Experiment(object):
-    def __init__(self, name, host="localhost", port=8675, admin=False):
+    def __init__(
+        self,
+        name,
+        host="localhost",
+        port=8675,
+        admin=False,
+        lockWorkers=1,
+        gpioWorkers=2,
+        broadcastState=True,
+        progressRate=10,
+        admission=None,
+        noticeInterval=5.0,
+        broadcastInterval=0.05,
+        leaseSeconds=None,
+        idleSeconds=None,
+        statusHost="127.0.0.1",
+        statusPort=None,
+        traceCapacity=1000,
+        traceFile=None,
+        debug=False,
+        logSettings=None,
+        journal=None,
+        ipcPath=defaultIpcPath,
+        loop=None,
+        configureLogging=True,
+    ):
         self.name = name
         self.host = host
         self.port = port
         self.devices = {}
+        # (deviceName, cmd) -> Command, built once in addDevice.
+        self.dispatchTable = {}
 
         self.lockGroups = {}
         self.lockMapping = {}
+        # Each lock group gets its own pool so a long move in one group can't
+        # starve the others. Fast GPIO devices share a separate pool.
+        self.lockWorkers = lockWorkers
+        self.executors = {
+            "gpio": ThreadPoolExecutor(
+                max_workers=gpioWorkers, thread_name_prefix=f"{name}-gpio"
+            )
+        }
+        self.queueDepth = defaultdict(int)
+        # (deviceName, method) -> PendingCommand for coalescable commands that
+        # have not started yet. A newer command of the same kind replaces it.
+        self.pendingCommands = {}
+        # deviceName -> CancelTokens of its queued and running commands.
+        self.commandTokens = defaultdict(set)
 
         self.allStates = {}
-        self.clients = deque()
+        # Last state sent to clients for each device, used to work out deltas.
+        self.broadcastState = broadcastState
+        self.publishedStates = {}
+        # State changes are batched and broadcast at most this often (seconds), so
+        # a burst of commands costs one frame per device however many are watching.
+        self.broadcastInterval = broadcastInterval
+        self.dirtyStates = set()
+        self.flushHandle = None
+        # Long moves report their position at most this often (seconds).
+        self.progressInterval = 1 / progressRate
+        # Connection id -> websocket for every connection, spectators included.
+        self.clients = OrderedDict()
+        # Connection id -> websocket for clients that can take control, oldest first.
+        self.controlQueue = OrderedDict()
         self.activeClient = None
+        # Waiting clients are reminded they lack control at most this often (seconds).
+        self.noticeInterval = noticeInterval
+        self.lastNotice = {}
+        # Control is leased: once someone is waiting, the active client loses it
+        # after leaseSeconds, or after idleSeconds without sending a command.
+        # None disables either limit.
+        self.leaseSeconds = leaseSeconds
+        self.idleSeconds = idleSeconds
+        self.leaseCheckInterval = 1.0
+        self.leaseStart = None
+        self.lastCommandTime = None
+        self.leaseTask = None
+        # deviceName -> asyncio.Event, cleared while the device is being reset.
+        self.resetEvents = {}
+        self.resetTask = None
+
+        self.metrics = ExperimentMetrics(self)
+        # Local HTTP endpoint for scrapers; None leaves it off.
+        self.statusHost = statusHost
+        self.statusPort = statusPort
+        self.tracer = Tracer(traceCapacity)
+        if traceFile:
+            self.tracer.addSink(JsonLinesSink(traceFile))
+        self.statusServer = StatusServer(
+            {
+                "/metrics": lambda query: (metricsContentType, self.metrics.render()),
+                "/trace": self.traceRoute,
+            }
+        )
+        # websocket -> wire protocol, settled by the first frame on each connection.
+        self.protocols = {}
+        # JSON connections that declared themselves a gateway and may send `reset`.
+        self.gateways = set()
+        # Per-client in-flight and rate limits, from the lab's `admission` settings.
+        self.admission = Admission(**(admission or {}))
+        self.gates = {}
 
         self.initializedStates = False
         self.admin = admin
-        self.executor = ThreadPoolExecutor(max_workers=4)
+        logsDirectory.mkdir(parents=True, exist_ok=True)
         self.logPath = logsDirectory / f"{self.name}.log"
         # self.jsonFile = os.path.join(self.directory, self.name + ".json")
-        logging.basicConfig(
-            filename=self.logPath,
-            level=logging.INFO,
-            format="%(levelname)s - %(asctime)s - %(filename)s - %(funcName)s \r\n %(message)s \r\n",
-        )
-        logging.info("""
+        if configureLogging:
+            # Rotation and format from settings.yml, see logsetup.setupLogging.
+            # A process hosting several experiments sets logging up once itself.
+            setupLogging(self.logPath, debug=debug, **(logSettings or {}))
+        logger.info("""
         ##############################################################
         ####                Starting New Log                      ####
         ##############################################################    
         """)
-        self.startIpcListener()
-        self.loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(self.loop)
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+        # Experiments hosted in the same process share one loop; see host.ExperimentHost.
+        self.loop = loop
+        # Journal of persistent device state; see journal.StateJournal for the settings.
+        self.journal = None
+        self.restoredStates = {}
+        if journal:
+            self.journal = StateJournal(**journal, loop=self.loop)
+            self.restoredStates = self.journal.load()
+        # Local control socket for the CLI and admin scripts, started with the server.
+        self.ipcServer = IpcServer(self, ipcPath)
+
+        self.events = EventBus(self.loop)
+        self.events.subscribe(StateChanged, self.onStateChanged)
+        self.events.subscribe(StateDelta, self.broadcastDelta)
+        self.events.subscribe(StateDelta, self.journalDelta)
+        self.events.subscribe(Progress, self.broadcastProgress)
+        self.events.subscribe(Progress, self.journalProgress)
+        self.events.subscribe(CommandFinished, self.traceCommand)
+        self.metrics.subscribe(self.events)
 
     def logException(self, task):
         if task.exception():
-            logging.exception("Unknown Exception: %s", task.exception())
+            logger.error("Unknown Exception: %s", task.exception(), exc_info=task.exception())
 
     def addDevice(self, device):
         device.experiment = self
-        logging.info("Adding Device - " + device.name)
+        logger.info("Adding Device - %s", device.name)
         self.devices[device.name] = device
+        if device.commands is None:
+            logger.warning(
+                "%s does not declare its commands; any attribute can be called", device.name
+            )
+        else:
+            for cmd, command in device.commandTable().items():
+                self.dispatchTable[(device.name, cmd)] = command
+        # Handoffs only reset devices whose state moved away from this one. Taken
+        # before any journaled state is applied, so a motor restored away from its
+        # starting position still counts as dirty.
+        device.markClean()
+        if device.persistState and device.name in self.restoredStates:
+            device.restoreState(self.restoredStates[device.name])
+            logger.info("Restored state of %s: %s", device.name, device.getState())
+        self.publishedStates[device.name] = copy.deepcopy(device.getState())
 
-    def addLockGroup(self, name: str, devices):
+    def addLockGroup(self, name: str, devices, workers=None):
         lock = asyncio.Lock()
         self.lockGroups[name] = lock
+        self.executors[name] = ThreadPoolExecutor(
+            max_workers=workers or self.lockWorkers,
+            thread_name_prefix=f"{self.name}-{name}",
+        )
         for device in devices:
             self.lockMapping[device.name] = name
 
+    def lookupCommand(self, deviceName, cmd, params):
+        """
+        Resolve a command from the dispatch table, rejecting unknown devices,
+        unknown commands and the wrong number of params before anything is queued.
+        Returns None for devices without an explicit command set.
+        """
+        device = self.devices.get(deviceName)
+        if device is None:
+            raise NoDeviceError(deviceName)
+        if device.commands is None:
+            return None
+        command = self.dispatchTable.get((deviceName, cmd))
+        if command is None:
+            raise CommandError(cmd, f"Device '{deviceName}' has no command '{cmd}'")
+        command.checkArity(params)
+        return command
+
+    def poolFor(self, deviceName):
+        if getattr(self.devices[deviceName], "fastIO", False):
+            return "gpio"
+        return self.lockMapping.get(deviceName, "gpio")
+
+    def queueDepths(self):
+        """Commands waiting on or running in each lock group and the GPIO pool, with pool sizes."""
+        depths = {}
+        for name, executor in self.executors.items():
+            depths[name] = {
+                "queued": self.queueDepth[name],
+                "workers": executor._max_workers,
+            }
+        return depths
+
+    def shutdownExecutors(self, wait=True):
+        for executor in self.executors.values():
+            executor.shutdown(wait=wait)
+
     def recallState(self):
-        logging.info("Recalling State")
-        with open(self.jsonFile, "r") as f:
-            self.allStates = json.load(f)
-        for name, device in self.devices.items():
-            device.setState(self.allStates[name])
+        """Put every persistent device back in the state the journal last saw."""
+        logger.info("Recalling State")
+        if self.journal is not None:
+            for name, device in self.devices.items():
+                if device.persistState and name in self.journal.states:
+                    device.restoreState(copy.deepcopy(self.journal.states[name]))
         self.initializedStates = True
 
     def getControllerStates(self):
-        logging.info("Getting Controller States")
+        logger.info("Getting Controller States")
         for name, device in self.devices.items():
             self.allStates[name] = device.getState()
-        with open(self.jsonFile, "w") as f:
-            json.dump(self.allStates, f)
         self.initializedStates = True
+        return self.allStates
+
+    def closeJournal(self):
+        """Write the final state of every persistent device to the journal."""
+        if self.journal is not None:
+            self.journal.close(self.persistentStates())
+            self.journal = None
+
+    def persistentStates(self):
+        return {
+            name: copy.deepcopy(device.getState())
+            for name, device in self.devices.items()
+            if device.persistState
+        }
 
     async def handleConnection(self, websocket, path):
-        print("Connection!:", websocket, path)
-        self.clients.append(websocket)  # Track all clients by their WebSocket
+        url = urlsplit(path)
+        if url.path.rstrip("/") == spectatorPath:
+            await self.handleSpectator(websocket, parse_qs(url.query))
+            return
+        logger.info("Connection from %s on %s", websocket.remote_address, path)
+        self.clients[websocket.id] = websocket  # Track all clients by their WebSocket
+        self.controlQueue[websocket.id] = websocket
+        gate = self.gates[websocket] = self.admission.gate()
+        if self.leaseTask is None and (self.leaseSeconds or self.idleSeconds):
+            self.leaseTask = asyncio.create_task(self.watchLeases())
+            self.leaseTask.add_done_callback(self.leaseWatcherDone)
         try:
-            if self.activeClient is None and self.clients:
-                self.activeClient = websocket
-                await self.sendAlert(
-                    websocket, "Experiment/controlStatus/1,You have control of the lab equipment."
-                )
+            if self.activeClient is None:
+                await self.grantControl(websocket, "You have control of the lab equipment.")
             else:
                 await self.sendAlert(
                     websocket,
                     "Experiment/controlStatus/0,You are connected but do not have control of the lab equipment.",
                 )
+                await self.sendQueuePosition(websocket, len(self.controlQueue) - 1)
+            if self.broadcastState:
+                await self.sendDataToClient(
+                    websocket,
+                    self.encodeStateFrame(websocket, protocol.encodeSnapshot(self.publishedStates)),
+                )
             async for command in websocket:
+                if websocket not in self.protocols and await self.negotiate(
+                    websocket, command
+                ):
+                    continue
                 if websocket == self.activeClient:
+                    reason = gate.admit()
+                    if reason is not None:
+                        self.admission.reject(reason)
+                        await self.sendOverload(websocket, command, reason)
+                        continue
+                    self.lastCommandTime = time.monotonic()
                     task = asyncio.create_task(self.processCommand(command, websocket))
                     task.add_done_callback(self.logException)
+                    task.add_done_callback(gate.release)
                 else:
-                    asyncio.create_task(
-                        self.sendAlert(
+                    now = time.monotonic()
+                    if now - self.lastNotice.get(websocket.id, -self.noticeInterval) >= self.noticeInterval:
+                        self.lastNotice[websocket.id] = now
+                        await self.sendAlert(
                             websocket, "Experiment/controlStatus/0,You do not have control to send commands."
                         )
-                    )
         finally:
-            self.clients.remove(websocket)  # Remove client that closed connection
+            del self.clients[websocket.id]  # Remove client that closed connection
+            self.controlQueue.pop(websocket.id, None)
+            self.lastNotice.pop(websocket.id, None)
+            self.protocols.pop(websocket, None)
+            self.gateways.discard(websocket)
+            self.gates.pop(websocket, None)
             if (
                 websocket == self.activeClient
             ):  # if the removed client was the active client
-                self.activeClient = (
-                    self.clients[0] if len(self.clients) > 0 else None
-                )  # set the first client in the list to be the new active client
-                if self.activeClient is not None:
-                    await self.sendAlert(
-                        self.activeClient, "Experiment/controlStatus/1,You are the new active client."
-                    )
-                print("the first client has changed!")
-                self.resetExperiment()
-                # logging.info("Looping through devices - resetting them.")
-                # for deviceName, device in self.devices.items():
-                #     logging.info("Running reset and cleanup on device " + deviceName)
-                #     device.reset()
-                # logging.info("Everything reset properly!")
+                await self.handOff("You are the new active client.")
+            else:
+                # Everyone behind the client that left moved up one place.
+                await self.notifyQueue()
+
+    async def grantControl(self, websocket, message):
+        self.activeClient = websocket
+        self.leaseStart = self.lastCommandTime = time.monotonic()
+        if websocket is not None:
+            await self.sendAlert(websocket, f"Experiment/controlStatus/1,{message}")
+
+    async def handOff(self, message):
+        """
+        Give control to the longest-waiting client and reset the apparatus for
+        them. The active client must already be out of the front of the queue.
+        """
+        # The longest-waiting client takes over.
+        client = next(iter(self.controlQueue.values()), None)
+        # Stop the last client's commands and set up the reset events before the
+        # new client hears it has control, so none of its commands skip the reset.
+        self.stopAll()
+        self.resetExperiment(client)
+        await self.grantControl(client, message)
+        logger.info("Control passed to %s", self.activeClient)
+        await self.notifyQueue()
+
+    async def expireLease(self, reason):
+        """Send the active client to the back of the queue and hand control on."""
+        expired = self.activeClient
+        logger.info("Lease of %s ended: %s", expired, reason)
+        self.controlQueue.move_to_end(expired.id)
+        await self.sendAlert(expired, f"Experiment/controlStatus/0,{reason}")
+        await self.handOff("It is your turn, you have control of the lab equipment.")
+
+    def leaseWatcherDone(self, task):
+        # Cleared so the next connection starts a new watcher if this one failed.
+        if task is self.leaseTask:
+            self.leaseTask = None
+        if not task.cancelled():
+            self.logException(task)
+
+    async def watchLeases(self):
+        while True:
+            await asyncio.sleep(self.leaseCheckInterval)
+            if self.activeClient is None or len(self.controlQueue) < 2:
+                # Nobody is waiting, so there is no reason to cut a session short.
+                continue
+            now = time.monotonic()
+            if self.leaseSeconds and now - self.leaseStart >= self.leaseSeconds:
+                await self.expireLease("Your time with the lab equipment is up.")
+            elif self.idleSeconds and now - self.lastCommandTime >= self.idleSeconds:
+                await self.expireLease("Control was passed on because you were idle.")
+
+    def leaseRemaining(self):
+        """Seconds left on the active client's lease, None if leases are unlimited."""
+        if not self.leaseSeconds or self.activeClient is None:
+            return None
+        return max(0.0, self.leaseStart + self.leaseSeconds - time.monotonic())
+
+    async def sendQueuePosition(self, websocket, position, remaining=None):
+        """
+        Tell a waiting client its place in line (1 is next) and, when leases are
+        limited, roughly how many seconds until its turn.
+        """
+        if remaining is None:
+            remaining = self.leaseRemaining()
+        if remaining is None:
+            await self.sendAlert(websocket, f"Experiment/queue/{position}")
+            return
+        wait = remaining + (position - 1) * self.leaseSeconds
+        await self.sendAlert(websocket, f"Experiment/queue/{position},{round(wait)}")
+
+    async def notifyQueue(self):
+        remaining = self.leaseRemaining()
+        waiting = islice(self.controlQueue.values(), 1, None)
+        for position, websocket in enumerate(waiting, start=1):
+            await self.sendQueuePosition(websocket, position, remaining)
+
+    async def handleSpectator(self, websocket, query):
+        """
+        Observers only receive the snapshot and broadcasts. They never queue for
+        control and anything they send is discarded without being parsed.
+        """
+        self.clients[websocket.id] = websocket
+        self.protocols[websocket] = (
+            protocol.JSON if query.get("protocol") == [protocol.JSON] else protocol.TEXT
+        )
+        try:
+            if self.broadcastState:
+                await self.sendDataToClient(
+                    websocket,
+                    self.encodeStateFrame(websocket, protocol.encodeSnapshot(self.publishedStates)),
+                )
+            async for _ in websocket:
+                pass
+        finally:
+            del self.clients[websocket.id]
+            self.protocols.pop(websocket, None)
+
+    async def negotiate(self, websocket, frame):
+        """
+        Settle the wire protocol from a connection's first frame. Returns True if
+        the frame was a protocol request and has been answered.
+        """
+        self.protocols[websocket] = protocol.TEXT
+        if not protocol.isStructured(frame):
+            return False
+        self.protocols[websocket] = protocol.JSON
+        try:
+            message = protocol.parseStructured(frame)
+        except protocol.ProtocolError:
+            return False
+        if "protocol" not in message:
+            return False
+        requested = message["protocol"]
+        if requested not in protocol.protocols:
+            self.protocols[websocket] = protocol.TEXT
+            error = protocol.ProtocolError(f"Unsupported protocol {requested}")
+            await self.sendDataToClient(websocket, protocol.encodeError(message.get("id"), error))
+            return True
+        self.protocols[websocket] = requested
+        if requested == protocol.JSON and message.get("gateway") is True:
+            self.gateways.add(websocket)
+        await self.sendDataToClient(
+            websocket, protocol.encodeHello(requested, websocket == self.activeClient)
+        )
+        return True
 
     async def processCommand(self, command, websocket):
-        print(f"Processing Command {command} from {websocket}")
-        logging.info("Processing Command - " + command)
-        deviceName, cmd, params = command.strip().split("/")
-        params = params.split(",")
-        if deviceName not in self.devices:
-            print("Raising no device error")
-            raise NoDeviceError(deviceName)
+        received = time.monotonic()
+        logger.debug("Processing command %s from %s", command, websocket)
+        if protocol.isStructured(command):
+            await self.processStructuredCommand(command, websocket, received)
+            return
 
-        await self.runDeviceMethod(deviceName, cmd, params, websocket)
+        request = protocol.parseText(command)
+        request.timing = CommandTiming(received)
+        request.timing.parsed = time.monotonic()
+        await self.dispatchRequest(request, websocket)
 
-    async def runDeviceMethod(self, deviceName, method, params, websocket):
-        device = self.devices.get(deviceName)
+    async def dispatchRequest(self, request, websocket):
+        if request.deviceName not in self.devices:
+            self.finishCommand(request, "error", websocket)
+            raise NoDeviceError(request.deviceName)
+        # `stop` never queues behind the lock group; it cancels what is there.
+        if request.cmd == "stop":
+            stopped = self.stopDevice(request.deviceName)
+            await self.sendReply(
+                websocket, request, "MESSAGE", f"{request.deviceName}/stopped/{stopped}"
+            )
+            return
+        # `reset` lets a gateway put a remote device back once its own client leaves.
+        if request.cmd == "reset":
+            if not self.mayReset(websocket):
+                self.finishCommand(request, "error", websocket)
+                raise CommandError("reset", "Only a gateway or the control socket can reset devices")
+            await self.resetNow(request.deviceName)
+            await self.sendReply(websocket, request, "MESSAGE", f"{request.deviceName}/reset")
+            return
+        await self.runDeviceMethod(
+            request.deviceName, request.cmd, request.params, websocket, request
+        )
+
+    def mayReset(self, websocket):
+        return isinstance(websocket, IpcConnection) or websocket in self.gateways
 
+    async def processStructuredCommand(self, frame, websocket, received=None):
+        # JSON requests always get a reply tagged with their id, errors included.
+        requestId = None
+        try:
+            message = protocol.parseStructured(frame)
+            requestId = message.get("id")
+            if message.get("type") == protocol.BATCH:
+                requests = protocol.batchFromMessage(message)
+                parsed = time.monotonic()
+                for request in requests:
+                    request.timing = CommandTiming(received)
+                    request.timing.parsed = parsed
+                await self.runBatch(requests, websocket, requestId)
+                return
+            request = protocol.requestFromMessage(message)
+            request.timing = CommandTiming(received)
+            request.timing.parsed = time.monotonic()
+            await self.dispatchRequest(request, websocket)
+        except Exception as e:
+            logger.exception("Request %s failed: %s", requestId, e)
+            await self.sendDataToClient(websocket, protocol.encodeError(requestId, e))
+
+    async def supersede(self, deviceName, method, websocket, request=None):
+        """
+        Claim the pending slot for a coalescable command, superseding the one
+        already waiting there. Returns the PendingCommand for the new command.
+        """
+        key = (deviceName, method)
+        previous = self.pendingCommands.get(key)
+        pending = PendingCommand(websocket, request)
+        self.pendingCommands[key] = pending
+        if previous is not None:
+            previous.superseded = True
+            logger.debug("Device %s %s superseded by a newer command", deviceName, method)
+            await self.sendReply(
+                previous.websocket,
+                previous.request,
+                "SUPERSEDED",
+                f"{deviceName}/{method}/superseded",
+            )
+        return pending
+
+    async def runDeviceMethod(self, deviceName, method, params, websocket, request=None):
+        if request is None:
+            request = protocol.Request(deviceName, method, params)
+        try:
+            command = self.lookupCommand(deviceName, method, params)
+        except Exception:
+            # Rejected before queueing, but still traced and counted.
+            self.finishCommand(request, "error", websocket)
+            raise
+        device = self.devices[deviceName]
+
+        pending = None
+        timing = request.timing
+        if timing is None:
+            timing = request.timing = CommandTiming()
+        outcome = "error"
         lockGroupName = self.lockMapping.get(deviceName)
         if lockGroupName:
-            async with self.lockGroups[lockGroupName]:
-                loop = asyncio.get_event_loop()
-                response = await loop.run_in_executor(
-                    self.executor, runMethod, device, method, params
-                )
-                if len(response) > 1:
-                    response_type = response[0]
-                    result = response[1]
-                else:
-                    response_type = "MESSAGE"
-                    result = response[0]
+            poolName = self.poolFor(deviceName)
+            self.queueDepth[lockGroupName] += 1
+            if poolName != lockGroupName:
+                self.queueDepth[poolName] += 1
+            token = CancelToken()
+            self.commandTokens[deviceName].add(token)
+            try:
+                if method in device.coalescable:
+                    pending = await self.supersede(deviceName, method, websocket, request)
+                await self.waitUntilReady(deviceName)
+                timing.lockRequested = time.monotonic()
+                async with self.lockGroups[lockGroupName]:
+                    timing.lockAcquired = time.monotonic()
+                    if pending is not None:
+                        if pending.superseded:
+                            # Already answered by supersede(); just give up the lock.
+                            outcome = "superseded"
+                            return
+                        # Once started, a command can no longer be replaced.
+                        del self.pendingCommands[(deviceName, method)]
+                    response_type, result = await self.executeCommand(
+                        deviceName, method, command, params, token, timing
+                    )
+                outcome = "cancelled" if token.cancelled else "ok"
+            finally:
+                # Cancelled while waiting, e.g. by stop or a disconnect: free the slot
+                # so later commands do not coalesce into this one.
+                if pending is not None and self.pendingCommands.get((deviceName, method)) is pending:
+                    del self.pendingCommands[(deviceName, method)]
+                self.commandTokens[deviceName].discard(token)
+                self.queueDepth[lockGroupName] -= 1
+                if poolName != lockGroupName:
+                    self.queueDepth[poolName] -= 1
+                if outcome not in ("ok", "cancelled"):
+                    self.finishCommand(request, outcome, websocket)
         else:
-            logging.error("All devices need a lock")
+            logger.error("All devices need a lock")
             raise
             # result = await self.runMethod(device, method, params)
         if result is not None:
-            logging.info(f"Device {deviceName} ran {method} with result: {result}")
-            if response_type == "ALERT":
-                await self.sendAlert(websocket, f"{result}")
+            logger.debug("Device %s ran %s with result: %s", deviceName, method, result)
+        timing.sendStart = time.monotonic()
+        await self.sendReply(websocket, request, response_type, result)
+        timing.sent = time.monotonic()
+        self.finishCommand(request, outcome, websocket)
+        self.publishState(deviceName)
+
+    async def executeCommand(self, deviceName, method, command, params, token, timing=None):
+        """
+        Run one command on its device and return (responseType, result). The
+        caller must already hold the device's lock group.
+        """
+        device = self.devices[deviceName]
+        if timing is None:
+            timing = CommandTiming()
+        if token.cancelled:
+            return "ALERT", f"{deviceName}/{method}/cancelled"
+        if command is not None and command.inline:
+            # Microsecond GPIO writes and async commands skip the thread hop.
+            timing.hardwareStart = time.monotonic()
+            try:
+                response = runCommand(device, command, params, token)
+                if inspect.isawaitable(response):
+                    response = await response
+            finally:
+                timing.hardwareEnd = time.monotonic()
+            return splitResponse(response)
+        loop = asyncio.get_event_loop()
+        if command is not None:
+            job = (runCommand, device, command, params, token)
+        else:
+            job = (runMethod, device, method, params, token)
+        timing.submitted = time.monotonic()
+        response = await loop.run_in_executor(
+            self.executors[self.poolFor(deviceName)], runTimed, timing, *job
+        )
+        return splitResponse(response)
+
+    async def runBatch(self, requests, websocket, requestId=None):
+        """
+        Run an ordered list of requests as one unit. Every lock group involved is
+        acquired once, in name order so two batches can never deadlock, and held
+        until the last command finishes, so nothing interleaves with the batch.
+        Execution stops at the first error or cancellation; commands already run
+        are not rolled back. The client gets one combined reply.
+        """
+        commands = []
+        try:
+            for request in requests:
+                if request.deviceName not in self.devices:
+                    raise NoDeviceError(request.deviceName)
+                if request.cmd == "stop":
+                    raise protocol.ProtocolError("stop cannot be batched", requestId)
+                if request.deviceName not in self.lockMapping:
+                    raise protocol.ProtocolError(
+                        f"{request.deviceName} has no lock group", requestId
+                    )
+                commands.append(
+                    self.lookupCommand(request.deviceName, request.cmd, request.params)
+                )
+        except Exception:
+            # The whole batch is turned away; every command in it gets its record.
+            for request in requests:
+                self.finishCommand(request, "error", websocket)
+            raise
+
+        deviceNames = {request.deviceName for request in requests}
+        groupNames = sorted({self.lockMapping[deviceName] for deviceName in deviceNames})
+        tokens = {deviceName: CancelToken() for deviceName in deviceNames}
+        for deviceName, token in tokens.items():
+            self.commandTokens[deviceName].add(token)
+        for groupName in groupNames:
+            self.queueDepth[groupName] += 1
+
+        results = []
+        # (request, outcome) for every command that ran, recorded once the reply is sent.
+        finished = []
+        try:
+            for deviceName in deviceNames:
+                await self.waitUntilReady(deviceName)
+            lockRequested = time.monotonic()
+            async with contextlib.AsyncExitStack() as stack:
+                for groupName in groupNames:
+                    await stack.enter_async_context(self.lockGroups[groupName])
+                lockAcquired = time.monotonic()
+                for request, command in zip(requests, commands):
+                    timing = request.timing or CommandTiming(lockRequested)
+                    timing.lockRequested, timing.lockAcquired = lockRequested, lockAcquired
+                    try:
+                        response_type, result = await self.executeCommand(
+                            request.deviceName,
+                            request.cmd,
+                            command,
+                            request.params,
+                            tokens[request.deviceName],
+                            timing,
+                        )
+                    except Exception as e:
+                        logger.exception("Batch %s failed at %s: %s", requestId, request, e)
+                        results.append(protocol.batchError(request, e))
+                        finished.append((request, "error"))
+                        break
+                    results.append(protocol.batchResult(request, response_type, result))
+                    cancelled = tokens[request.deviceName].cancelled
+                    finished.append((request, "cancelled" if cancelled else "ok"))
+                    if cancelled:
+                        break
+        finally:
+            for deviceName, token in tokens.items():
+                self.commandTokens[deviceName].discard(token)
+            for groupName in groupNames:
+                self.queueDepth[groupName] -= 1
+
+        logger.debug("Batch %s ran %d of %d commands", requestId, len(results), len(requests))
+        sendStart = time.monotonic()
+        await self.sendDataToClient(
+            websocket, protocol.encodeBatchReply(requestId, results, len(requests))
+        )
+        sent = time.monotonic()
+        for request, outcome in finished:
+            request.timing.sendStart, request.timing.sent = sendStart, sent
+            self.finishCommand(request, outcome, websocket)
+        for deviceName in deviceNames:
+            self.publishState(deviceName)
+
+    def finishCommand(self, request, outcome, websocket=None):
+        if request.timing is None:
+            request.timing = CommandTiming()
+        client = getattr(websocket, "id", None)
+        self.events.publish(
+            CommandFinished(request, outcome, str(client) if client is not None else None)
+        )
+
+    def traceCommand(self, event):
+        self.tracer.record(event.request, event.request.timing, event.outcome, event.client)
+
+    def traceRoute(self, query):
+        last = int(query.get("last", ["200"])[0])
+        return "application/json", json.dumps(self.tracer.last(last))
+
+    def stopDevice(self, deviceName):
+        """
+        Cancel every queued and running command for a device without waiting for
+        its lock group, then let the device interrupt its hardware. Returns the
+        number of commands cancelled.
+        """
+        tokens = self.commandTokens[deviceName]
+        for token in tokens:
+            token.cancel()
+        if tokens:
+            self.devices[deviceName].abort()
+        logger.info("Stopped %d command(s) on %s", len(tokens), deviceName)
+        return len(tokens)
+
+    def stopAll(self):
+        return sum(self.stopDevice(deviceName) for deviceName in self.devices)
+
+    def publishState(self, deviceName, reason="command"):
+        """Announce that a device's state may have changed. Safe from any thread."""
+        self.events.publish(StateChanged(deviceName, reason))
+
+    def onStateChanged(self, event):
+        """Queue a device for the next state flush."""
+        # Flushed even with nobody connected, so publishedStates, and with it the
+        # snapshot the next client gets, follows resets done after the last one left.
+        self.dirtyStates.add(event.deviceName)
+        if self.flushHandle is None:
+            self.flushHandle = self.loop.call_later(self.broadcastInterval, self.flushStates)
+
+    def flushStates(self):
+        """Publish what changed in each queued device's state since the last flush."""
+        self.flushHandle = None
+        deviceNames, self.dirtyStates = self.dirtyStates, set()
+        for deviceName in deviceNames:
+            state = self.devices[deviceName].getState()
+            changed, delta = stateDelta(self.publishedStates.get(deviceName), state)
+            if not changed:
+                continue
+            self.publishedStates[deviceName] = copy.deepcopy(state)
+            self.events.publish(StateDelta(deviceName, delta))
+
+    def broadcastDelta(self, event):
+        if self.broadcastState and self.clients:
+            self.broadcast(protocol.encodeState(event.deviceName, event.delta))
+
+    def journalDelta(self, event):
+        if self.journal is not None and self.devices[event.deviceName].persistState:
+            self.journal.record(event.deviceName, copy.deepcopy(event.delta))
+
+    def publishProgress(self, deviceName, progress):
+        """Publish a progress event. Called from executor threads during long moves."""
+        self.events.publish(Progress(deviceName, progress))
+
+    def broadcastProgress(self, event):
+        self.broadcast(protocol.encodeProgress(event.deviceName, event.progress), "PROGRESS")
+
+    def journalProgress(self, event):
+        # Journal positions mid-move too, so a power cut loses at most syncInterval.
+        if (
+            self.journal is not None
+            and self.devices[event.deviceName].persistState
+            and "position" in event.progress
+        ):
+            self.journal.record(event.deviceName, {"position": event.progress["position"]})
+
+    def broadcast(self, body: str, textPrefix="STATE"):
+        """
+        Send one pre-serialized JSON body to every client. JSON clients get it as
+        is, text clients get it behind a prefix such as STATE:.
+        """
+        jsonClients = []
+        textClients = []
+        for client in self.clients.values():
+            if self.protocols.get(client) == protocol.JSON:
+                jsonClients.append(client)
             else:
-                await self.sendMessage(websocket, f"{result}")
+                textClients.append(client)
+        if jsonClients:
+            websockets.broadcast(jsonClients, body)
+        if textClients:
+            websockets.broadcast(textClients, f"{textPrefix}: {body}")
+        self.metrics.sentBytes.inc(
+            len(body) * len(jsonClients) + (len(body) + len(textPrefix) + 2) * len(textClients),
+            kind="broadcast",
+        )
+
+    def encodeStateFrame(self, websocket, body: str):
+        if self.protocols.get(websocket) == protocol.JSON:
+            return body
+        return f"STATE: {body}"
+
+    async def sendReply(self, websocket, request, responseType, result):
+        if request is not None and request.structured:
+            await self.sendDataToClient(
+                websocket, protocol.encodeReply(request.requestId, responseType, result)
+            )
+        elif responseType in ("ALERT", "SUPERSEDED"):
+            await self.sendAlert(websocket, f"{result}")
+        elif result is not None:
+            await self.sendMessage(websocket, f"{result}")
         else:
-            await self.sendMessage(websocket, f"{deviceName} ran {method}")
+            await self.sendMessage(websocket, f"{request.deviceName} ran {request.cmd}")
 
     def startServer(self):
         # This function sets up and runs the WebSocket server indefinitely
-        # loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.loop)
-        start_server = websockets.serve(self.handleConnection, self.host, self.port)
-
-        print(f"Server started at ws://{self.host}:{self.port}")
-        self.loop.run_until_complete(start_server)
+        self.loop.run_until_complete(websockets.serve(self.handleConnection, self.host, self.port))
+        logger.info("Server started at ws://%s:%s", self.host, self.port)
+        self.loop.run_until_complete(self.startServices())
         self.loop.run_forever()
 
+    async def startServices(self):
+        """Start the IPC socket, the status server if configured, and connect to remote nodes."""
+        await self.ipcServer.start()
+        if self.statusPort is not None:
+            await self.statusServer.start(self.statusHost, self.statusPort)
+        # Connect now so remote state is mirrored before the first command.
+        for node in self.remoteNodes():
+            task = asyncio.create_task(node.connect())
+            task.add_done_callback(self.logException)
+
+    def remoteNodes(self):
+        """The connection to every node a RemoteDevice of this experiment lives on."""
+        return {
+            device.node.url: device.node
+            for device in self.devices.values()
+            if isinstance(device, RemoteDevice)
+        }.values()
+
     async def sendDataToClient(self, websocket, dataStr: str):
+        self.metrics.sentBytes.inc(len(dataStr), kind="reply")
         try:
             await websocket.send(dataStr)
         except websockets.exceptions.ConnectionClosed:
-            logging.warning(
-                f"Failed to send message: {dataStr} - Connection was closed."
-            )
-            print(f"Failed to send message: {dataStr} - Connection was closed.")
+            logger.warning("Failed to send message: %s - Connection was closed.", dataStr)
 
     async def sendMessage(self, websocket, message: str):
-        updatedMessage = f"MESSAGE: {message}"
+        if self.protocols.get(websocket) == protocol.JSON:
+            updatedMessage = protocol.encodeReply(None, "MESSAGE", message)
+        else:
+            updatedMessage = f"MESSAGE: {message}"
         await self.sendDataToClient(websocket, updatedMessage)
 
     async def sendAlert(self, websocket, alertMsg: str):
-        updatedAlertMsg = f"ALERT: {alertMsg}"
+        if self.protocols.get(websocket) == protocol.JSON:
+            updatedAlertMsg = protocol.encodeReply(None, "ALERT", alertMsg)
+        else:
+            updatedAlertMsg = f"ALERT: {alertMsg}"
         await self.sendDataToClient(websocket, updatedAlertMsg)
 
+    async def sendOverload(self, websocket, frame, reason):
+        """Tell a client its command was dropped by admission control."""
+        logger.warning("Rejected command from %s: %s", websocket, reason)
+        structured = protocol.isStructured(frame)
+        requestId = None
+        requests = []
+        try:
+            if structured:
+                message = protocol.parseStructured(frame)
+                requestId = message.get("id")
+                if message.get("type") == protocol.BATCH:
+                    requests = protocol.batchFromMessage(message)
+                else:
+                    requests = [protocol.requestFromMessage(message)]
+            else:
+                requests = [protocol.parseText(frame)]
+        except (protocol.ProtocolError, ValueError):
+            pass
+        for request in requests:
+            self.finishCommand(request, "rejected", websocket)
+        if structured:
+            await self.sendDataToClient(websocket, protocol.encodeOverload(requestId, reason))
+        else:
+            await self.sendAlert(websocket, f"Experiment/overloaded/{reason}")
+
     async def sendCommandToClient(self, websocket, command: str):
         updatedCommand = f"COMMAND: {command}"
         await self.sendDataToClient(websocket, updatedCommand)
@@ -219,44 +1003,22 @@ class Experiment(object):
             names.append(deviceName)
         return names
 
-    async def onClientDisconnect(self, websocket):
-        # Remove client from the client queue if they disconnect
-        if websocket in self.clients:
-            self.clients.remove(websocket)
-        if websocket == self.activeClient:
-            self.activeClient = None
-            # Pass control to the next available client in the queue
-            while self.clientQueue:
-                potentialController = self.clientQueue.popleft()
-                if potentialController.open:
-                    self.activeClient = potentialController
-                    await self.sendMessage(
-                        self.activeClient, "You now have control of the lab equipment."
-                    )
-                    break
-            if not self.activeClient:
-                print("No active clients")
-                logging.info("No active clients")
-                self.activeClient = None
-
-            logging.info(f"Active client disconnected: {websocket}.")
-        else:
-            logging.info(f"Non-active client disconnected: {websocket}.")
-
     def exitHandler(self, signalReceived, frame):
-        logging.info("Attempting to exit")
+        logger.info("Attempting to exit")
         if self.socket is not None:
             self.socket.close()
-            logging.info("Socket is closed")
+            logger.info("Socket is closed")
 
         # if self.messengerSocket is not None:
         #     self.messengerSocket.close()
         #     logging.info("Messenger socket closed")
 
         if not self.admin:
-            self.resetExperiment()
+            self.resetAllDevices()
         else:
             gpio.cleanup()
+        self.closeJournal()
+        self.tracer.close()
         exit(0)
 
     def setupSignalHandlers(self):
@@ -264,13 +1026,13 @@ class Experiment(object):
         signal.signal(signal.SIGTERM, self.exitHandler)
 
     def closeHandler(self):
-        logging.info("Client Disconnected. Handling Close.")
+        logger.info("Client Disconnected. Handling Close.")
         if self.connection is not None:
             self.connection.close()
-            logging.info("Connection to client closed.")
+            logger.info("Connection to client closed.")
         if not self.admin:
             for deviceName, device in self.devices.items():
-                logging.info("Running reset on device " + deviceName)
+                logger.info("Running reset on device %s", deviceName)
                 device.reset()
 
     def setup(self):
@@ -296,50 +1058,133 @@ class Experiment(object):
             self.__waitToConnect()
         except OSError:
             if os.path.exists(self.socketPath):
-                print(
-                    f"Error accessing {self.socketPath}\nTry running 'sudo chown pi: {self.socketPath}'"
+                logger.error(
+                    "Error accessing %s\nTry running 'sudo chown pi: %s'",
+                    self.socketPath,
+                    self.socketPath,
                 )
+                # os._exit skips atexit, so flush the log queue first.
+                stopLogging()
                 os._exit(0)
                 return
             else:
-                print(
-                    f"Socket file not found. Did you configure uv4l-uvc.conf to use {self.socketPath}?"
+                logger.error(
+                    "Socket file not found. Did you configure uv4l-uvc.conf to use %s?",
+                    self.socketPath,
                 )
                 raise
-            logging.error("Socket Error!", exc_info=True)
-            print(f"Socket error: {err}")
-
-    def startIpcListener(self, ipc_path="/tmp/remla_cmd.sock"):
-        # Remove old socket if exists
-        if os.path.exists(ipc_path):
-            os.unlink(ipc_path)
-        ipc_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        ipc_sock.bind(ipc_path)
-        ipc_sock.listen(1)
-        print(f"IPC listener started at {ipc_path}")
-
-        def ipc_loop():
-            while True:
-                conn, _ = ipc_sock.accept()
-                data = conn.recv(1024).decode().strip()
-                if data in ["boot", "contact"]:
-                    # Send message to active client
-                    if self.activeClient:
-                        future = asyncio.run_coroutine_threadsafe(
-                            self.sendAlert(self.activeClient, f"Experiment/message/{data}"),
-                            self.loop
-                        )
-                        print(f"Sent {data} message to active client.")
-                    else:
-                        print(f"No active client to send {data} message.")
-                conn.close()
+            logger.error("Socket error: %s", err, exc_info=True)
 
+    def resetDevice(self, device):
+        logger.info("Resetting device %s", device.name)
+        # The last command's token may have been cancelled on handoff.
+        device.cancelToken = CancelToken()
+        device.reset()
 
-        threading.Thread(target=ipc_loop, daemon=True).start()
-
-    def resetExperiment(self):
-        logging.info("Resetting experiment to original state.")
+    def resetDependents(self):
+        """deviceName -> names of the devices that drive it and must reset first."""
+        dependents = defaultdict(list)
         for deviceName, device in self.devices.items():
-            logging.info(f"Resetting device {deviceName}")
-            device.reset()
-        logging.info("Experiment reset complete.")
\ No newline at end of file
+            for dependency in device.dependencies():
+                if dependency.name in self.devices:
+                    dependents[dependency.name].append(deviceName)
+        return dependents
+
+    def resetOrder(self):
+        """Every device name, each one after all the devices that drive it."""
+        dependents = self.resetDependents()
+        order = []
+        seen = set()
+
+        def visit(deviceName):
+            if deviceName in seen:
+                return
+            seen.add(deviceName)
+            for dependent in dependents[deviceName]:
+                visit(dependent)
+            order.append(deviceName)
+
+        for deviceName in self.devices:
+            visit(deviceName)
+        return order
+
+    def resetAllDevices(self):
+        """Reset every device one after another on the calling thread. Used on shutdown."""
+        logger.info("Resetting experiment to original state.")
+        for deviceName in self.resetOrder():
+            if self.devices[deviceName].isDirty():
+                self.resetDevice(self.devices[deviceName])
+        logger.info("Experiment reset complete.")
+
+    def resetExperiment(self, client=None):
+        """
+        Start resetting every device that has changed since its last reset in
+        the background and return the task. Lock groups reset in parallel on their own pools; within the
+        dependencies a device only resets once every device driving it is done
+        (an absorber before its stepper). Commands wait only for the devices
+        they use. ``client`` is sent ``Experiment/ready`` once it is all done.
+        """
+        events = {deviceName: asyncio.Event() for deviceName in self.devices}
+        self.resetEvents.update(events)
+        self.resetTask = asyncio.create_task(
+            self.runReset(events, self.resetTask, client)
+        )
+        self.resetTask.add_done_callback(self.logException)
+        return self.resetTask
+
+    async def runReset(self, events, previous, client):
+        if previous is not None:
+            # A reset is still running from an earlier handoff; let it finish first.
+            await asyncio.wait([previous])
+        logger.info("Resetting experiment to original state.")
+        start = time.monotonic()
+        dependents = self.resetDependents()
+        await asyncio.gather(
+            *(
+                self.resetOne(deviceName, events, dependents[deviceName])
+                for deviceName in self.devices
+            )
+        )
+        logger.info("Experiment reset complete in %.2f s.", time.monotonic() - start)
+        if client is not None and client == self.activeClient:
+            await self.sendAlert(client, "Experiment/ready")
+
+    async def resetOne(self, deviceName, events, dependents):
+        try:
+            for dependent in dependents:
+                await events[dependent].wait()
+            lockGroupName = self.lockMapping.get(deviceName)
+            lock = self.lockGroups[lockGroupName] if lockGroupName else contextlib.nullcontext()
+            async with lock:
+                # Checked under the lock, after any cancelled command has finished.
+                if not self.devices[deviceName].isDirty():
+                    logger.debug("Skipping reset of untouched device %s", deviceName)
+                    return
+                await asyncio.get_event_loop().run_in_executor(
+                    self.executors[self.poolFor(deviceName)],
+                    self.resetDevice,
+                    self.devices[deviceName],
+                )
+            self.publishState(deviceName, "reset")
+        except Exception:
+            logger.exception("Resetting %s failed", deviceName)
+        finally:
+            events[deviceName].set()
+
+    async def resetNow(self, deviceName):
+        """Reset one device under its lock group, whether or not it looks dirty."""
+        lockGroupName = self.lockMapping.get(deviceName)
+        lock = self.lockGroups[lockGroupName] if lockGroupName else contextlib.nullcontext()
+        async with lock:
+            await asyncio.get_event_loop().run_in_executor(
+                self.executors[self.poolFor(deviceName)],
+                self.resetDevice,
+                self.devices[deviceName],
+            )
+        self.publishState(deviceName, "reset")
+
+    async def waitUntilReady(self, deviceName):
+        """Hold a command back while its device is being reset."""
+        event = self.resetEvents.get(deviceName)
+        if event is not None and not event.is_set():
+            await event.wait()
\ No newline at end of file
@@ -0,0 +1,95 @@
+"""
+Admission control for commands arriving over websocket connections.
+
+Every connection gets a ClientGate. A gate bounds how many of its commands can be
+queued or running at once and, optionally, how fast new ones may arrive (a token
+bucket). Commands over either limit are rejected straight away with an overload
+reply instead of piling up as tasks behind a lock group. Limits come from the
+``admission`` section of the lab YAML::
+
+    admission:
+      maxInFlight: 32   # queued + running commands per client
+      rate: 20          # commands per second, refilled continuously
+      burst: 40         # bucket size; defaults to rate
+"""
+
+import time
+from collections import Counter
+
+INFLIGHT = "inFlight"
+RATE = "rate"
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        """
+        :param rate: Tokens added per second.
+        :param burst: Most tokens the bucket holds, i.e. the largest burst allowed.
+        :param clock: Monotonic clock in seconds, replaceable for tests.
+        """
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = clock()
+
+    def take(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class ClientGate(object):
+    """Admission state for a single connection."""
+
+    def __init__(self, maxInFlight, bucket=None):
+        self.maxInFlight = maxInFlight
+        self.bucket = bucket
+        self.inFlight = 0
+
+    def admit(self):
+        """Reserve a slot for a command. Returns None if admitted, else the reason it was not."""
+        if self.maxInFlight is not None and self.inFlight >= self.maxInFlight:
+            return INFLIGHT
+        if self.bucket is not None and not self.bucket.take():
+            return RATE
+        self.inFlight += 1
+        return None
+
+    def release(self, *args):
+        # Accepts and ignores the finished task so it can be a done callback.
+        self.inFlight -= 1
+
+
+class Admission(object):
+    def __init__(self, maxInFlight=32, rate=None, burst=None):
+        """
+        :param maxInFlight: Commands a client may have queued or running at once,
+            None for no limit.
+        :param rate: Sustained commands per second per client, None for no limit.
+        :param burst: Token bucket size, defaults to ``rate``.
+        """
+        self.maxInFlight = maxInFlight
+        self.rate = rate
+        self.burst = burst
+        # reason -> number of commands rejected for it, across all clients.
+        self.rejected = Counter()
+
+    def gate(self):
+        bucket = TokenBucket(self.rate, self.burst) if self.rate else None
+        return ClientGate(self.maxInFlight, bucket)
+
+    def reject(self, reason):
+        self.rejected[reason] += 1
+
+    def stats(self):
+        return {
+            "maxInFlight": self.maxInFlight,
+            "rate": self.rate,
+            "burst": self.burst,
+            "rejected": {INFLIGHT: self.rejected[INFLIGHT], RATE: self.rejected[RATE]},
+        }
@@ -0,0 +1,99 @@
+"""
+The experiment-wide event bus.
+
+Controllers and the server publish typed events; the websocket fan-out, the
+state journal, metrics and tracing subscribe to the types they care about.
+``publish`` is safe from any thread: events published off the event loop, e.g.
+from a pigpio callback or an executor thread, are handed to the loop and
+delivered there, so subscribers always run on the loop thread.
+"""
+
+import asyncio
+import logging
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+
+class Event(object):
+    __slots__ = ()
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{self.__class__.__name__}({fields})"
+
+
+class StateChanged(Event):
+    """A device's state may have changed; subscribers read it with getState."""
+
+    __slots__ = ("deviceName", "reason")
+
+    def __init__(self, deviceName, reason="command"):
+        """
+        :param reason: What changed it, e.g. ``"command"``, ``"reset"`` or ``"limit"``.
+        """
+        self.deviceName = deviceName
+        self.reason = reason
+
+
+class StateDelta(Event):
+    """The changed part of a device's state, see Experiment.stateDelta."""
+
+    __slots__ = ("deviceName", "delta")
+
+    def __init__(self, deviceName, delta):
+        self.deviceName = deviceName
+        self.delta = delta
+
+
+class Progress(Event):
+    """A progress report from a long-running command, e.g. a stepper move."""
+
+    __slots__ = ("deviceName", "progress")
+
+    def __init__(self, deviceName, progress):
+        self.deviceName = deviceName
+        self.progress = progress
+
+
+class CommandFinished(Event):
+    """A command ran to an outcome: ``ok``, ``cancelled``, ``superseded`` or ``error``."""
+
+    __slots__ = ("request", "outcome", "client")
+
+    def __init__(self, request, outcome, client=None):
+        self.request = request
+        self.outcome = outcome
+        self.client = client
+
+
+class EventBus(object):
+    def __init__(self, loop):
+        self.loop = loop
+        # Event type -> handlers, called in the order they subscribed.
+        self.handlers = defaultdict(list)
+
+    def subscribe(self, eventType, handler):
+        self.handlers[eventType].append(handler)
+
+    def unsubscribe(self, eventType, handler):
+        self.handlers[eventType].remove(handler)
+
+    def publish(self, event):
+        """Deliver an event to its subscribers on the loop thread. Safe from any thread."""
+        try:
+            onLoop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            onLoop = False
+        if onLoop or not self.loop.is_running():
+            # Nothing else can be touching subscriber state, e.g. during shutdown.
+            self.deliver(event)
+        else:
+            self.loop.call_soon_threadsafe(self.deliver, event)
+
+    def deliver(self, event):
+        for handler in self.handlers.get(type(event), ()):
+            try:
+                handler(event)
+            except Exception:
+                logger.exception("Handler %s failed on %s", handler, event)
@@ -0,0 +1,224 @@
+"""
+Connections from a gateway Experiment to remla nodes running on other Pis.
+
+A lab that needs more GPIO or I2C than one Pi has runs ``remla run`` on every Pi
+and picks one as the gateway. Devices wired to another Pi appear in the
+gateway's lab YAML as RemoteDevice entries::
+
+    devices:
+      farStepper:
+        type: RemoteDevice
+        node: ws://pi2.local:8675
+        commands: {move: 1, goto: 1}
+        remoteName: stepper   # the device's name on the node, defaults to farStepper
+        timeout: 120          # seconds to wait for the node's reply
+
+Clients connect to the gateway only. The gateway keeps one websocket per node,
+speaks the JSON protocol over it and keeps many requests in flight at once,
+matched by id. It should be the only client of each node, since a node only
+takes commands from the client holding control.
+
+Lock groups in the gateway's YAML may mix local and remote devices. The gateway
+holds the group while the node runs the command, so commands and batches that
+span several nodes are serialized the same way local ones are. Each node still
+applies its own lock groups.
+
+Every round trip to a node is recorded in ``remla_hop_seconds{node}``. A node
+can itself be a gateway; each gateway reports the hops it makes.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from collections import defaultdict
+
+import websockets
+
+from remla.labcontrol import protocol
+
+logger = logging.getLogger(__name__)
+
+controlPrefix = "Experiment/controlStatus/"
+
+
+class RemoteError(Exception):
+    def __init__(self, node, message):
+        self.node = node
+        self.message = message
+
+    def __str__(self):
+        return "RemoteError, {0}: {1}".format(self.node, self.message)
+
+
+class NodeConnection(object):
+    def __init__(self, url, timeout=10.0, requestTimeout=120.0):
+        """
+        :param url: The node's websocket address, e.g. ``ws://pi2.local:8675``.
+        :param timeout: Seconds to wait for the node to connect and say hello.
+        :param requestTimeout: Seconds to wait for the reply to a command, unless the
+            request sets its own.
+        """
+        self.url = url
+        self.timeout = timeout
+        self.requestTimeout = requestTimeout
+        self.websocket = None
+        # True while the node lets this gateway send commands.
+        self.control = False
+        self.nextId = 0
+        # request id -> future for the reply.
+        self.pending = {}
+        # remote device name -> callbacks(kind, body) for its broadcasts.
+        self.watchers = defaultdict(list)
+        self.connectLock = asyncio.Lock()
+        self.hello = None
+
+    def watch(self, deviceName, callback):
+        """
+        Follow the state a node broadcasts for one of its devices. The callback is
+        called on the event loop with ``("snapshot", state)``, ``("state", delta)``
+        or ``("progress", progress)``.
+        """
+        self.watchers[deviceName].append(callback)
+
+    @property
+    def connected(self):
+        return self.websocket is not None and self.websocket.open
+
+    async def connect(self):
+        async with self.connectLock:
+            if self.connected:
+                return
+            websocket = await asyncio.wait_for(websockets.connect(self.url), self.timeout)
+            self.websocket = websocket
+            self.hello = asyncio.get_running_loop().create_future()
+            reader = asyncio.create_task(self.read(websocket))
+            reader.add_done_callback(self.logException)
+            try:
+                # Declaring itself a gateway lets this connection send `reset`.
+                await websocket.send(protocol.toJson({"protocol": protocol.JSON, "gateway": True}))
+                await asyncio.wait_for(asyncio.shield(self.hello), self.timeout)
+            except Exception:
+                await websocket.close()
+                raise
+            logger.info("Connected to node %s, control: %s", self.url, self.control)
+
+    async def close(self):
+        if self.websocket is not None:
+            await self.websocket.close()
+
+    def logException(self, task):
+        if not task.cancelled() and task.exception():
+            logger.error("Node %s reader failed", self.url, exc_info=task.exception())
+
+    async def read(self, websocket):
+        try:
+            async for frame in websocket:
+                self.handleFrame(frame)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            if self.websocket is websocket:
+                self.websocket = None
+                self.control = False
+            logger.warning("Lost connection to node %s", self.url)
+            error = ConnectionError(f"Lost connection to node {self.url}")
+            if self.hello is not None and not self.hello.done():
+                self.hello.set_exception(error)
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self.pending.clear()
+
+    def handleFrame(self, frame):
+        # Frames sent before the protocol is settled use the text framing.
+        if frame.startswith("ALERT: "):
+            self.handleAlert(frame[len("ALERT: ") :])
+            return
+        for prefix in ("STATE: ", "PROGRESS: "):
+            if frame.startswith(prefix):
+                frame = frame[len(prefix) :]
+        if not protocol.isStructured(frame):
+            return
+        message = json.loads(frame)
+        kind = message.get("type")
+        requestId = message.get("id")
+        if requestId is not None:
+            future = self.pending.pop(requestId, None)
+            if future is not None and not future.done():
+                future.set_result(message)
+        elif kind == "hello":
+            self.control = message["control"]
+            if not self.hello.done():
+                self.hello.set_result(message)
+        elif kind == "alert":
+            self.handleAlert(str(message.get("result")))
+        elif kind == "snapshot":
+            for deviceName, state in message["states"].items():
+                self.notify(deviceName, "snapshot", state)
+        elif kind == "state":
+            self.notify(message["device"], "state", message["delta"])
+        elif kind == "progress":
+            progress = {k: v for k, v in message.items() if k not in ("type", "device")}
+            self.notify(message["device"], "progress", progress)
+
+    def handleAlert(self, alert):
+        if alert.startswith(controlPrefix):
+            control = alert[len(controlPrefix) : len(controlPrefix) + 1] == "1"
+            if control != self.control:
+                logger.warning("Node %s %s control", self.url, "gave" if control else "took away")
+            self.control = control
+
+    def notify(self, deviceName, kind, body):
+        for callback in self.watchers.get(deviceName, ()):
+            try:
+                callback(kind, body)
+            except Exception:
+                logger.exception("Handling %s from %s failed", kind, self.url)
+
+    async def request(self, deviceName, cmd, params=(), timeout=None):
+        """
+        Run a command on the node and wait for its reply.
+
+        :param timeout: Seconds to wait for the reply, by default ``requestTimeout``.
+        :return: The reply frame and the round trip in seconds.
+        :raises RemoteError: If the node refuses or fails the command, or does not
+            answer in time.
+        """
+        if timeout is None:
+            timeout = self.requestTimeout
+        await self.connect()
+        if not self.control:
+            raise RemoteError(self.url, "the node has not given this gateway control")
+        self.nextId += 1
+        requestId = self.nextId
+        future = asyncio.get_running_loop().create_future()
+        self.pending[requestId] = future
+        start = time.monotonic()
+        try:
+            await self.websocket.send(
+                protocol.toJson(
+                    {"id": requestId, "device": deviceName, "cmd": cmd, "params": list(params)}
+                )
+            )
+            reply = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise RemoteError(self.url, f"no reply to {deviceName}/{cmd} within {timeout}s")
+        finally:
+            self.pending.pop(requestId, None)
+        seconds = time.monotonic() - start
+        if reply["type"] == "error":
+            raise RemoteError(self.url, f"{reply['error']}: {reply['message']}")
+        if reply["type"] == "overloaded":
+            raise RemoteError(self.url, f"overloaded ({reply['reason']})")
+        return reply, seconds
+
+
+# url -> NodeConnection, so every remote device on a node shares one connection.
+nodes = {}
+
+
+def connectionFor(url):
+    if url not in nodes:
+        nodes[url] = NodeConnection(url)
+    return nodes[url]
@@ -0,0 +1,90 @@
+"""
+Run several experiments in one process.
+
+Every experiment hosted here shares the process's event loop, its pigpio
+connection and its VISA manager (see the top of Controllers.py), so a Pi with
+two benches needs one server process instead of two. Each experiment is served
+on its own port, or several share a port and are told apart by a path prefix::
+
+    ws://pi:8675/          -> the experiment added with path None on 8675
+    ws://pi:8676/gamma/    -> the experiment added with path "/gamma" on 8676
+    ws://pi:8676/beta/spectate?protocol=json
+
+Build every experiment with ``loop=host.loop`` and ``configureLogging=False``.
+"""
+
+import asyncio
+import logging
+
+import websockets
+
+logger = logging.getLogger(__name__)
+
+
+class ExperimentHost(object):
+    def __init__(self, loop=None):
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+        self.loop = loop
+        self.experiments = []
+        # port -> {path prefix, "" for the whole port: experiment}
+        self.routes = {}
+        self.servers = []
+
+    def add(self, experiment, port=None, path=None):
+        """
+        :param port: Port to serve the experiment on, defaults to experiment.port.
+        :param path: Path prefix such as ``"/gamma"`` when sharing a port, None for
+            the whole port.
+        """
+        if experiment.loop is not self.loop:
+            raise ValueError(f"{experiment.name} was not built on the host's loop")
+        port = experiment.port if port is None else port
+        prefix = "/" + path.strip("/") if path else ""
+        routes = self.routes.setdefault(port, {})
+        if prefix in routes:
+            raise ValueError(f"Port {port} already serves {routes[prefix].name} at '{prefix}/'")
+        routes[prefix] = experiment
+        self.experiments.append(experiment)
+
+    def route(self, port, path):
+        """Find the experiment for a connection. Returns (experiment, path within it)."""
+        routes = self.routes.get(port, {})
+        for prefix in sorted(routes, key=len, reverse=True):
+            rest = path[len(prefix):]
+            if path.startswith(prefix) and (rest == "" or rest[0] in "/?"):
+                if not rest.startswith("/"):
+                    rest = "/" + rest
+                return routes[prefix], rest
+        return None, path
+
+    def connectionHandler(self, port):
+        # websockets only passes the path to handlers that take two arguments.
+        async def handleConnection(websocket, path):
+            experiment, rest = self.route(port, path)
+            if experiment is None:
+                await websocket.close(1008, "No lab at this path")
+                return
+            await experiment.handleConnection(websocket, rest)
+
+        return handleConnection
+
+    async def start(self):
+        for port, routes in self.routes.items():
+            host = next(iter(routes.values())).host
+            server = await websockets.serve(self.connectionHandler(port), host, port)
+            self.servers.append(server)
+            for prefix, experiment in routes.items():
+                logger.info("Serving %s at ws://%s:%s%s/", experiment.name, host, port, prefix)
+        for experiment in self.experiments:
+            await experiment.startServices()
+
+    def run(self):
+        self.loop.run_until_complete(self.start())
+        try:
+            self.loop.run_forever()
+        finally:
+            for experiment in self.experiments:
+                experiment.closeJournal()
+                experiment.tracer.close()
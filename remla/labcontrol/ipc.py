@@ -0,0 +1,160 @@
+"""
+The local control socket, for the ``remla`` CLI and admin scripts on the Pi.
+
+Clients connect to a Unix socket and send newline-delimited JSON requests. Any
+number of clients can be connected and each may have many requests in flight;
+replies carry the request's ``id`` and may come back out of order.
+
+Device commands and batches use the same frames as JSON websocket clients and
+go through the same dispatch, lock groups and executors::
+
+    {"id": 1, "device": "stepper", "cmd": "move", "params": ["100"]}
+    {"id": 1, "type": "reply", "result": "stepper/position/100"}
+
+They do not need control of the lab; whoever can open the socket is trusted.
+Server requests are told apart by ``type``::
+
+    {"id": 2, "type": "queues"}          lock group queue depths
+    {"id": 3, "type": "admission"}       admission limits and rejections
+    {"id": 4, "type": "metrics"}         Prometheus text
+    {"id": 5, "type": "trace", "last": 200}
+    {"id": 6, "type": "message", "message": "boot"}   alert the active client
+
+A line that is a bare word, e.g. ``queues`` or ``trace 200``, is answered the way
+the old threaded listener did: the raw result, after which the server closes
+the connection once the client has finished sending.
+"""
+
+import asyncio
+import json
+import logging
+import os
+from itertools import count
+
+from remla.labcontrol import protocol
+
+logger = logging.getLogger(__name__)
+
+defaultIpcPath = "/tmp/remla_cmd.sock"
+
+
+class IpcConnection(object):
+    """Just enough of a websocket for Experiment to send replies to."""
+
+    def __init__(self, writer, connectionId):
+        self.writer = writer
+        self.id = connectionId
+        self.remote_address = connectionId
+
+    async def send(self, data):
+        if self.writer.is_closing():
+            return
+        self.writer.write(data.encode() + b"\n")
+        await self.writer.drain()
+
+    async def sendRaw(self, data):
+        if self.writer.is_closing():
+            return
+        self.writer.write(data.encode())
+        await self.writer.drain()
+
+
+class IpcServer(object):
+    def __init__(self, experiment, path=defaultIpcPath):
+        self.experiment = experiment
+        self.path = path
+        self.server = None
+        self.connectionIds = count(1)
+        # type -> handler(message) returning a JSON-serialisable result
+        self.handlers = {
+            "queues": lambda message: experiment.queueDepths(),
+            "admission": lambda message: experiment.admission.stats(),
+            "metrics": lambda message: experiment.metrics.render(),
+            "trace": self.traceRecords,
+            "message": self.forwardMessage,
+        }
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self.handle, self.path)
+        logger.info("IPC listener started at %s", self.path)
+        return self.server
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def handle(self, reader, writer):
+        connection = IpcConnection(writer, f"ipc-{next(self.connectionIds)}")
+        tasks = set()
+        try:
+            while line := await reader.readline():
+                task = asyncio.create_task(self.handleLine(line.decode().strip(), connection))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            # The client may shut down its side right after sending; still answer.
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        except ConnectionError:
+            logger.info("IPC client %s went away", connection.id)
+        finally:
+            writer.close()
+
+    async def handleLine(self, line, connection):
+        if not line:
+            return
+        if not protocol.isStructured(line):
+            await self.handleLegacy(line, connection)
+            return
+        requestId = None
+        try:
+            message = protocol.parseStructured(line)
+            requestId = message.get("id")
+            handler = self.handlers.get(message.get("type"))
+            if handler is None:
+                # Device commands and batches, exactly as from a JSON websocket client.
+                await self.experiment.processStructuredCommand(line, connection)
+                return
+            result = handler(message)
+            await connection.send(protocol.encodeReply(requestId, "reply", result))
+        except Exception as e:
+            logger.exception("IPC request %s failed: %s", requestId, e)
+            await connection.send(protocol.encodeError(requestId, e))
+
+    async def handleLegacy(self, line, connection):
+        word, *args = line.split()
+        if word == "trace":
+            last = int(args[0]) if args else None
+            records = self.experiment.tracer.last(last)
+            await connection.sendRaw("".join(json.dumps(record) + "\n" for record in records))
+        elif word == "metrics":
+            await connection.sendRaw(self.experiment.metrics.render())
+        elif word in ("queues", "admission"):
+            await connection.sendRaw(json.dumps(self.handlers[word]({})))
+        elif word in ("boot", "contact"):
+            self.forwardMessage({"message": word})
+        else:
+            logger.warning("Unknown IPC request %r", line)
+
+    def traceRecords(self, message):
+        """The latest trace records, at most ``last`` of them when it is given."""
+        last = message.get("last")
+        return self.experiment.tracer.last(int(last) if last is not None else None)
+
+    def forwardMessage(self, message):
+        """Alert the active client, e.g. that the Pi is about to reboot. True if there was one."""
+        text = message.get("message")
+        activeClient = self.experiment.activeClient
+        if activeClient is None:
+            logger.info("No active client to send %s message.", text)
+            return False
+        asyncio.get_running_loop().create_task(
+            self.experiment.sendAlert(activeClient, f"Experiment/message/{text}")
+        )
+        logger.info("Sent %s message to active client.", text)
+        return True
@@ -0,0 +1,149 @@
+"""
+Write-behind journal of controller state, so a lab can pick up where it left
+off after a crash or power cut instead of homing every motor.
+
+Changes are appended to ``<path>`` as JSON lines, one ``{"device", "state"}``
+entry per change, where ``state`` holds the changed top-level keys of a dict
+state or the whole state otherwise. Entries are buffered on the event loop and
+written and fsynced together every ``syncInterval`` seconds by a dedicated
+thread. Every ``compactEvery`` entries the merged state is written to
+``<path>.snapshot`` through a temporary file and ``os.replace`` and the journal
+starts over. Replaying an entry twice gives the same state, so a crash between
+the two steps loses nothing; a torn last line is ignored.
+"""
+
+import asyncio
+import copy
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+def applyDelta(states, deviceName, delta):
+    current = states.get(deviceName)
+    if isinstance(current, dict) and isinstance(delta, dict):
+        current.update(delta)
+    else:
+        states[deviceName] = copy.deepcopy(delta)
+
+
+def fsyncDirectory(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class StateJournal(object):
+    def __init__(self, path, syncInterval=1.0, compactEvery=1000, loop=None):
+        """
+        :param path: Journal file; the snapshot is written next to it.
+        :param syncInterval: Seconds to gather entries before writing and fsyncing them.
+        :param compactEvery: Entries to write before folding them into the snapshot.
+        :param loop: The event loop record is called on, by default the running one.
+        """
+        self.path = Path(path)
+        self.loop = loop
+        self.snapshotPath = self.path.with_name(self.path.name + ".snapshot")
+        self.syncInterval = syncInterval
+        self.compactEvery = compactEvery
+        # deviceName -> latest state, as it will be after every pending entry is written.
+        self.states = {}
+        self.pending = []
+        self.written = 0
+        self.flushHandle = None
+        self.file = None
+        # One thread, so writes and compactions happen in the order they were queued.
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal")
+
+    def load(self):
+        """Read the snapshot and replay the journal. Returns {deviceName: state}."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        states = {}
+        if self.snapshotPath.exists():
+            with open(self.snapshotPath) as f:
+                states = json.load(f)
+        replayed = 0
+        if self.path.exists():
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Only the last line can be torn, by a crash mid-write.
+                        logger.warning("Ignoring a torn entry at the end of %s", self.path)
+                        break
+                    applyDelta(states, entry["device"], entry["state"])
+                    replayed += 1
+        self.states = states
+        logger.info("Loaded state of %d device(s), replayed %d entries", len(states), replayed)
+        # Start from a clean journal so replay stays short.
+        self.compact(copy.deepcopy(states))
+        return copy.deepcopy(states)
+
+    def record(self, deviceName, delta):
+        """Queue a state change. Called on the event loop."""
+        applyDelta(self.states, deviceName, delta)
+        self.pending.append(json.dumps({"device": deviceName, "state": delta}))
+        if self.flushHandle is None:
+            self.flushHandle = self.eventLoop().call_later(self.syncInterval, self.flush)
+
+    def flush(self):
+        """Hand the queued entries to the journal thread. Returns its future."""
+        self.flushHandle = None
+        lines, self.pending = self.pending, []
+        self.written += len(lines)
+        snapshot = None
+        if self.written >= self.compactEvery:
+            snapshot = copy.deepcopy(self.states)
+            self.written = 0
+        return self.eventLoop().run_in_executor(self.executor, self.writeEntries, lines, snapshot)
+
+    def eventLoop(self):
+        return self.loop if self.loop is not None else asyncio.get_running_loop()
+
+    def writeEntries(self, lines, snapshot=None):
+        if lines:
+            if self.file is None:
+                self.file = open(self.path, "a")
+            self.file.write("\n".join(lines) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        if snapshot is not None:
+            self.compact(snapshot)
+
+    def compact(self, snapshot):
+        """Atomically replace the snapshot with the given states and empty the journal."""
+        temporary = self.snapshotPath.with_name(self.snapshotPath.name + ".tmp")
+        with open(temporary, "w") as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.snapshotPath)
+        fsyncDirectory(self.snapshotPath.parent)
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.path, "w")
+
+    def close(self, states=None):
+        """
+        Write everything out and compact, from any thread once the loop has stopped.
+
+        :param states: Final {deviceName: state} to fold in first, e.g. after a reset.
+        """
+        if self.flushHandle is not None:
+            self.flushHandle.cancel()
+            self.flushHandle = None
+        for deviceName, state in (states or {}).items():
+            applyDelta(self.states, deviceName, state)
+        self.pending = []
+        self.executor.submit(self.compact, copy.deepcopy(self.states)).result()
+        self.executor.shutdown()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,182 @@
+"""
+Logging for the lab server that never blocks command handling.
+
+Every logger writes to an in-memory queue through a QueueHandler; a single
+QueueListener thread does the actual writing to disk (and to the terminal when
+the server runs in the foreground), so a slow SD card cannot stall the event
+loop or an executor thread.
+
+Log with %-style arguments, ``logger.debug("moved %s steps", steps)``, so the
+message is only built when its level is enabled. Per-command chatter is logged
+at DEBUG and only kept with ``logging: {debug: true}`` in the lab YAML.
+
+The log file is rotated when it reaches a size or an age, whichever comes
+first, and old files are gzipped and deleted once the archives exceed a total
+budget. Rotation and compression also happen on the listener thread. The
+defaults can be changed in ``settings.yml``::
+
+    logging:
+      maxBytes: 5000000          # rotate at this size
+      maxAge: 86400              # or after this many seconds
+      retentionBytes: 50000000   # gzipped archives kept in total
+      format: compact            # compact, verbose or a logging format string
+"""
+
+import atexit
+import glob
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import sys
+import time
+
+formats = {
+    "compact": "%(asctime)s %(levelname).1s %(name)s: %(message)s",
+    "verbose": "%(levelname)s - %(asctime)s - %(threadName)s - %(name)s.%(funcName)s - %(message)s",
+}
+consoleFormat = "%(levelname)s %(name)s: %(message)s"
+
+# The running pipeline, replaced whenever setupLogging is called again.
+activeListener = None
+activeHandler = None
+
+
+class CompressedRotatingFileHandler(logging.handlers.BaseRotatingHandler):
+    """
+    Rotates on size or age and gzips each rotated file to
+    ``<name>.<YYYYmmdd-HHMMSS>.gz``, deleting the oldest archives once together
+    they are larger than retentionBytes.
+    """
+
+    def __init__(
+        self, filename, maxBytes=5_000_000, maxAge=86400, retentionBytes=50_000_000, clock=time.time
+    ):
+        """
+        :param maxBytes: Rotate before the file grows past this size, None for no limit.
+        :param maxAge: Rotate once the file has been written to for this many
+            seconds, None for no limit.
+        :param retentionBytes: Total size of the archives to keep.
+        :param clock: Wall clock in seconds, replaceable for tests.
+        """
+        super().__init__(filename, "a", encoding="utf-8")
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.retentionBytes = retentionBytes
+        self.clock = clock
+        self.opened = clock()
+
+    def shouldRollover(self, record):
+        if self.stream is None:
+            self.stream = self._open()
+        size = self.stream.tell()
+        if size == 0:
+            return False
+        if self.maxBytes and size + len(self.format(record)) + 1 > self.maxBytes:
+            return True
+        return bool(self.maxAge) and self.clock() - self.opened >= self.maxAge
+
+    def archiveName(self):
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.clock()))
+        name = f"{self.baseFilename}.{stamp}.gz"
+        suffix = 1
+        while os.path.exists(name):
+            name = f"{self.baseFilename}.{stamp}-{suffix}.gz"
+            suffix += 1
+        return name
+
+    def archives(self):
+        """Existing archives, oldest first."""
+        return sorted(glob.glob(glob.escape(self.baseFilename) + ".*.gz"), key=os.path.getmtime)
+
+    def doRollover(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        archive = self.archiveName()
+        partial = archive + ".part"
+        with open(self.baseFilename, "rb") as source, gzip.open(partial, "wb") as target:
+            shutil.copyfileobj(source, target)
+        os.replace(partial, archive)
+        os.remove(self.baseFilename)
+        self.stream = self._open()
+        self.opened = self.clock()
+        self.prune()
+
+    def prune(self):
+        archives = self.archives()
+        total = sum(os.path.getsize(path) for path in archives)
+        while archives and total > self.retentionBytes:
+            oldest = archives.pop(0)
+            total -= os.path.getsize(oldest)
+            os.remove(oldest)
+
+
+def setupLogging(
+    logPath=None,
+    debug=False,
+    console=None,
+    maxBytes=5_000_000,
+    maxAge=86400,
+    retentionBytes=50_000_000,
+    format="compact",
+):
+    """
+    Route all logging through a queue to a rotating file and optionally the terminal.
+
+    :param logPath: File to write records to, None for no file.
+    :param debug: Keep DEBUG records, i.e. log every command.
+    :param console: Also write to stdout. Defaults to whether stdout is a
+        terminal, so records are not duplicated into a service's output file.
+    :param maxBytes: See CompressedRotatingFileHandler.
+    :param maxAge: See CompressedRotatingFileHandler.
+    :param retentionBytes: See CompressedRotatingFileHandler.
+    :param format: ``"compact"``, ``"verbose"`` or a logging format string.
+    :return: The started QueueListener.
+    """
+    global activeListener, activeHandler
+    stopLogging()
+    if console is None:
+        console = sys.stdout.isatty()
+
+    handlers = []
+    if logPath is not None:
+        fileHandler = CompressedRotatingFileHandler(logPath, maxBytes, maxAge, retentionBytes)
+        fileHandler.setFormatter(logging.Formatter(formats.get(format, format)))
+        handlers.append(fileHandler)
+    if console:
+        consoleHandler = logging.StreamHandler(sys.stdout)
+        consoleHandler.setFormatter(logging.Formatter(consoleFormat))
+        handlers.append(consoleHandler)
+
+    logQueue = queue.SimpleQueue()
+    activeHandler = logging.handlers.QueueHandler(logQueue)
+    root = logging.getLogger()
+    root.addHandler(activeHandler)
+    root.setLevel(logging.DEBUG if debug else logging.INFO)
+    # websockets logs every frame at DEBUG, which would drown out our own records.
+    logging.getLogger("websockets").setLevel(logging.INFO)
+
+    activeListener = logging.handlers.QueueListener(
+        logQueue, *handlers, respect_handler_level=True
+    )
+    activeListener.start()
+    return activeListener
+
+
+def stopLogging():
+    """Write out anything still queued and detach the pipeline. Safe to call twice."""
+    global activeListener, activeHandler
+    if activeHandler is not None:
+        logging.getLogger().removeHandler(activeHandler)
+        activeHandler = None
+    if activeListener is not None:
+        activeListener.stop()
+        for handler in activeListener.handlers:
+            handler.close()
+        activeListener = None
+
+
+atexit.register(stopLogging)
@@ -0,0 +1,334 @@
+"""
+In-process metrics for the Experiment server, rendered in the Prometheus text
+exposition format.
+
+Everything here is updated from the event loop thread only, so there is no
+locking. Timestamps taken on executor threads are carried back to the loop in a
+CommandTiming and observed there.
+
+Each command is split into phases, recorded in ``remla_command_seconds``:
+
+* ``queue``: frame received until the command asks for its lock group
+  (parsing, validation, waiting for the device to finish resetting)
+* ``lock``: waiting for the lock group
+* ``executor``: waiting for a worker thread in the group's pool
+* ``hardware``: the controller method itself
+* ``send``: writing the reply to the client
+"""
+
+import math
+import time
+from collections import defaultdict
+
+from remla.labcontrol.events import CommandFinished, StateDelta
+
+# Seconds. Covers sub-millisecond GPIO writes up to minute-long absorber moves.
+defaultBuckets = (
+    0.0001,
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1.0,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+phases = ("queue", "lock", "executor", "hardware", "send")
+
+
+def formatLabels(labelNames, labelValues, extra=()):
+    pairs = list(zip(labelNames, labelValues)) + list(extra)
+    if not pairs:
+        return ""
+    body = ",".join(
+        '{0}="{1}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in pairs
+    )
+    return "{" + body + "}"
+
+
+def formatValue(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    metricType = "untyped"
+
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+
+    def labelValues(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelNames)
+
+    def samples(self):
+        """Yield (suffix, labelValues, extraLabels, value) tuples."""
+        return ()
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.metricType}",
+        ]
+        for suffix, labelValues, extra, value in self.samples():
+            labels = formatLabels(self.labelNames, labelValues, extra)
+            lines.append(f"{self.name}{suffix}{labels} {formatValue(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    metricType = "counter"
+
+    def __init__(self, name, help, labelNames=()):
+        super().__init__(name, help, labelNames)
+        self.values = defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        self.values[self.labelValues(labels)] += amount
+
+    def get(self, **labels):
+        return self.values.get(self.labelValues(labels), 0)
+
+    def samples(self):
+        for labelValues, value in sorted(self.values.items()):
+            yield "", labelValues, (), value
+
+
+class Gauge(Metric):
+    metricType = "gauge"
+
+    def __init__(self, name, help, labelNames=(), function=None):
+        """
+        :param function: Optional callable returning {labelValues tuple: value},
+            read every time the gauge is rendered instead of stored values.
+        """
+        super().__init__(name, help, labelNames)
+        self.values = {}
+        self.function = function
+
+    def set(self, value, **labels):
+        self.values[self.labelValues(labels)] = value
+
+    def samples(self):
+        values = self.function() if self.function is not None else self.values
+        for labelValues, value in sorted(values.items()):
+            yield "", labelValues, (), value
+
+
+class Histogram(Metric):
+    metricType = "histogram"
+
+    def __init__(self, name, help, labelNames=(), buckets=defaultBuckets):
+        super().__init__(name, help, labelNames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # labelValues -> [per-bucket counts, sum, count]
+        self.series = {}
+
+    def observe(self, value, **labels):
+        key = self.labelValues(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+        counts = series[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def count(self, **labels):
+        series = self.series.get(self.labelValues(labels))
+        return series[2] if series else 0
+
+    def samples(self):
+        for labelValues, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucketCount in zip(self.buckets, counts):
+                cumulative += bucketCount
+                yield "_bucket", labelValues, (("le", formatValue(bound)),), cumulative
+            yield "_sum", labelValues, (), total
+            yield "_count", labelValues, (), count
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+class CommandTiming(object):
+    """Monotonic timestamps for the phases of one command, None if never reached."""
+
+    def __init__(self, received=None):
+        self.received = received if received is not None else time.monotonic()
+        # Wall clock time of receipt, for tying a trace record to other logs.
+        self.wallTime = time.time() - (time.monotonic() - self.received)
+        self.parsed = None
+        self.lockRequested = None
+        self.lockAcquired = None
+        self.submitted = None
+        self.hardwareStart = None
+        self.hardwareEnd = None
+        self.sendStart = None
+        self.sent = None
+
+    def phases(self):
+        """Duration of every phase that completed, in seconds."""
+        durations = {}
+        spans = (
+            ("queue", self.received, self.lockRequested),
+            ("lock", self.lockRequested, self.lockAcquired),
+            ("executor", self.submitted, self.hardwareStart),
+            ("hardware", self.hardwareStart, self.hardwareEnd),
+            ("send", self.sendStart, self.sent),
+        )
+        for phase, start, end in spans:
+            if start is not None and end is not None:
+                durations[phase] = end - start
+        return durations
+
+
+def stepTimings(experiment):
+    """(deviceName, report) for every stepper that has moved, see steptiming.py."""
+    for name, device in experiment.devices.items():
+        timing = getattr(device, "stepTiming", None)
+        if timing is not None:
+            yield name, timing
+
+
+class ExperimentMetrics(object):
+    """The metrics an Experiment keeps about its commands, pools and clients."""
+
+    def __init__(self, experiment):
+        self.registry = Registry()
+        register = self.registry.register
+        self.commandSeconds = register(
+            Histogram(
+                "remla_command_seconds",
+                "Time spent in each phase of a command.",
+                ("device", "command", "phase"),
+            )
+        )
+        self.commands = register(
+            Counter(
+                "remla_commands_total",
+                "Commands handled, by outcome.",
+                ("device", "command", "outcome"),
+            )
+        )
+        self.sentBytes = register(
+            Counter("remla_sent_bytes_total", "Bytes written to websocket clients.", ("kind",))
+        )
+        self.hopSeconds = register(
+            Histogram(
+                "remla_hop_seconds",
+                "Round trip from this gateway to a remote node and back.",
+                ("node",),
+            )
+        )
+        self.stateChanges = register(
+            Counter("remla_state_changes_total", "Published device state changes.", ("device",))
+        )
+        register(
+            Gauge(
+                "remla_queue_depth",
+                "Commands queued or running in each pool.",
+                ("pool",),
+                lambda: {
+                    (pool,): depth["queued"]
+                    for pool, depth in experiment.queueDepths().items()
+                },
+            )
+        )
+        register(
+            Gauge(
+                "remla_pool_workers",
+                "Worker threads in each pool.",
+                ("pool",),
+                lambda: {
+                    (pool,): depth["workers"]
+                    for pool, depth in experiment.queueDepths().items()
+                },
+            )
+        )
+        register(
+            Gauge(
+                "remla_clients",
+                "Connected websocket clients by role.",
+                ("role",),
+                lambda: {
+                    ("controller",): int(experiment.activeClient is not None),
+                    ("waiting",): max(0, len(experiment.controlQueue) - 1),
+                    ("spectator",): len(experiment.clients) - len(experiment.controlQueue),
+                },
+            )
+        )
+        register(
+            Gauge(
+                "remla_admission_rejected",
+                "Commands rejected by admission control since startup.",
+                ("reason",),
+                lambda: {
+                    (reason,): count
+                    for reason, count in experiment.admission.stats()["rejected"].items()
+                },
+            )
+        )
+
+        register(
+            Gauge(
+                "remla_step_rate",
+                "Requested and achieved step rate of each stepper's last move, steps/s.",
+                ("device", "rate"),
+                lambda: {
+                    (name, rate): timing[f"{rate}Rate"]
+                    for name, timing in stepTimings(experiment)
+                    for rate in ("requested", "achieved")
+                    if timing[f"{rate}Rate"] is not None
+                },
+            )
+        )
+        register(
+            Gauge(
+                "remla_step_jitter_seconds",
+                "Standard deviation of the step interval in each stepper's last move.",
+                ("device",),
+                lambda: {(name,): timing["jitter"] for name, timing in stepTimings(experiment)},
+            )
+        )
+
+    def subscribe(self, events):
+        """Follow an events.EventBus."""
+        events.subscribe(CommandFinished, self.onCommandFinished)
+        events.subscribe(StateDelta, self.onStateDelta)
+
+    def onCommandFinished(self, event):
+        request = event.request
+        self.observeCommand(request.deviceName, request.cmd, request.timing, event.outcome)
+
+    def onStateDelta(self, event):
+        self.stateChanges.inc(device=event.deviceName)
+
+    def observeCommand(self, deviceName, cmd, timing, outcome):
+        for phase, seconds in timing.phases().items():
+            self.commandSeconds.observe(seconds, device=deviceName, command=cmd, phase=phase)
+        self.commands.inc(device=deviceName, command=cmd, outcome=outcome)
+
+    def render(self):
+        return self.registry.render()
@@ -0,0 +1,181 @@
+"""
+Wire formats understood by the Experiment websocket server.
+
+Two framings are accepted on every connection:
+
+* The original slash format, ``device/cmd/param1,param2``. Replies are untagged
+  ``MESSAGE: ...`` and ``ALERT: ...`` strings.
+* JSON frames, ``{"id": 7, "device": "stepper", "cmd": "move", "params": [100]}``.
+  Replies echo the client's ``id`` so many commands can be in flight at once:
+  ``{"id": 7, "type": "message", "result": ...}`` or
+  ``{"id": 7, "type": "error", "error": "ArgumentNumberError", "message": ...}``.
+
+Besides its own commands every device takes ``stop``, which cancels its queued
+and running commands. A gateway (see gateway.py) may also send ``reset``, which
+puts a device back in its starting state; it declares itself when it settles the
+protocol, ``{"protocol": "json", "gateway": true}``. ``reset`` is also accepted
+on the local control socket, and refused from every other client.
+
+Several commands can be sent as one atomic batch,
+``{"id": 8, "type": "batch", "commands": [{"device": ..., "cmd": ..., "params": [...]}, ...]}``.
+They run in order with every lock group they touch held for the whole batch, and
+the reply lists one entry per command that ran:
+``{"id": 8, "type": "batch", "total": 3, "results": [{"device": ..., "cmd": ...,
+"type": "message", "result": ...}, ...]}``. The batch stops at the first error,
+which is the last entry.
+
+Commands over a client's in-flight or rate limit are not queued. JSON requests
+get ``{"id": 7, "type": "overloaded", "reason": "inFlight"}`` (or ``"rate"``),
+text frames get ``ALERT: Experiment/overloaded/<reason>``.
+
+A client opts into JSON for unsolicited messages (control status, alerts) by
+sending ``{"protocol": "json"}`` once; the server answers with a ``hello`` frame.
+
+Shortly after commands run the server broadcasts what changed in each device's
+state to all connected clients, ``{"type": "state", "device": ..., "delta": {...}}``.
+Changes are batched and sent at most every ``broadcastInterval`` seconds. New
+connections get ``{"type": "snapshot", "states": {...}}``. Text clients get the
+same JSON behind a ``STATE: `` prefix. Long stepper moves also broadcast
+``{"type": "progress", "device": ..., "position": ..., "target": ...}`` a few
+times a second (``PROGRESS: `` for text clients). Observers that connect to
+``/spectate`` (``/spectate?protocol=json`` for JSON) only receive these
+broadcasts; anything they send is ignored.
+"""
+
+import json
+
+TEXT = "text"
+JSON = "json"
+protocols = (TEXT, JSON)
+BATCH = "batch"
+
+
+class ProtocolError(Exception):
+    def __init__(self, message, requestId=None):
+        self.message = message
+        self.requestId = requestId
+
+    def __str__(self):
+        return "ProtocolError, {0}".format(self.message)
+
+
+class Request(object):
+    def __init__(self, deviceName, cmd, params, requestId=None, structured=False):
+        self.deviceName = deviceName
+        self.cmd = cmd
+        self.params = params
+        self.requestId = requestId
+        # True when the request arrived as a JSON frame and wants a JSON reply.
+        self.structured = structured
+        # metrics.CommandTiming, filled in as the request moves through the server.
+        self.timing = None
+
+    def __repr__(self):
+        return f"Request({self.deviceName}/{self.cmd}/{self.params}, id={self.requestId})"
+
+
+def isStructured(frame):
+    return isinstance(frame, (bytes, str)) and frame.lstrip()[:1] in ("{", b"{")
+
+
+def parseText(frame: str) -> Request:
+    deviceName, cmd, params = frame.strip().split("/")
+    return Request(deviceName, cmd, params.split(","))
+
+
+def parseStructured(frame) -> dict:
+    try:
+        message = json.loads(frame)
+    except ValueError as e:
+        raise ProtocolError(f"Invalid JSON frame: {e}")
+    if not isinstance(message, dict):
+        raise ProtocolError("JSON frames must be objects")
+    return message
+
+
+def requestFromMessage(message: dict) -> Request:
+    requestId = message.get("id")
+    try:
+        deviceName = message["device"]
+        cmd = message["cmd"]
+    except KeyError as e:
+        raise ProtocolError(f"Missing field {e}", requestId)
+    params = message.get("params", [])
+    if not isinstance(params, list):
+        params = [params]
+    return Request(deviceName, cmd, params, requestId, structured=True)
+
+
+def batchFromMessage(message: dict) -> list:
+    requestId = message.get("id")
+    commands = message.get("commands")
+    if not isinstance(commands, list) or not commands:
+        raise ProtocolError("Batch frames need a non-empty commands list", requestId)
+    requests = []
+    for command in commands:
+        if not isinstance(command, dict):
+            raise ProtocolError("Batch commands must be objects", requestId)
+        requests.append(requestFromMessage({**command, "id": requestId}))
+    return requests
+
+
+def toJson(message: dict) -> str:
+    return json.dumps(message, default=str)
+
+
+def encodeHello(protocol, control):
+    return toJson({"type": "hello", "protocol": protocol, "control": control})
+
+
+def encodeState(deviceName, delta):
+    return toJson({"type": "state", "device": deviceName, "delta": delta})
+
+
+def encodeProgress(deviceName, progress):
+    return toJson({"type": "progress", "device": deviceName, **progress})
+
+
+def encodeSnapshot(states):
+    return toJson({"type": "snapshot", "states": states})
+
+
+def encodeReply(requestId, responseType, result):
+    return toJson({"id": requestId, "type": responseType.lower(), "result": result})
+
+
+def batchResult(request, responseType, result):
+    return {
+        "device": request.deviceName,
+        "cmd": request.cmd,
+        "type": responseType.lower(),
+        "result": result,
+    }
+
+
+def batchError(request, error):
+    return {
+        "device": request.deviceName,
+        "cmd": request.cmd,
+        "type": "error",
+        "error": error.__class__.__name__,
+        "message": str(error),
+    }
+
+
+def encodeBatchReply(requestId, results, total):
+    return toJson({"id": requestId, "type": BATCH, "total": total, "results": results})
+
+
+def encodeOverload(requestId, reason):
+    return toJson({"id": requestId, "type": "overloaded", "reason": reason})
+
+
+def encodeError(requestId, error):
+    return toJson(
+        {
+            "id": requestId,
+            "type": "error",
+            "error": error.__class__.__name__,
+            "message": str(error),
+        }
+    )
@@ -0,0 +1,75 @@
+"""
+A tiny read-only HTTP server for local tools such as a Prometheus scraper.
+
+Only ``GET`` is supported and every response closes the connection. Routes map
+a path to a handler that takes the parsed query string and returns
+``(contentType, body)``. Bind it to localhost; there is no authentication.
+"""
+
+import asyncio
+import logging
+from urllib.parse import parse_qs, urlsplit
+
+logger = logging.getLogger(__name__)
+
+reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed"}
+
+
+class StatusServer(object):
+    def __init__(self, routes, timeout=5.0):
+        """
+        :param routes: Mapping of path, e.g. ``"/metrics"``, to handler(query).
+        :param timeout: Seconds to wait for the request head before giving up.
+        """
+        self.routes = routes
+        self.timeout = timeout
+        self.server = None
+
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        logger.info("Status server listening on http://%s:%s", host, port)
+        return self.server
+
+    @property
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    async def readRequest(self, reader):
+        requestLine = await asyncio.wait_for(reader.readline(), self.timeout)
+        # Headers are not needed; read past them to the blank line.
+        while True:
+            line = await asyncio.wait_for(reader.readline(), self.timeout)
+            if line in (b"\r\n", b"\n", b""):
+                break
+        method, target, _ = requestLine.decode("latin-1").split(" ", 2)
+        return method, urlsplit(target)
+
+    async def handle(self, reader, writer):
+        contentType, body = "text/plain; charset=utf-8", ""
+        try:
+            method, url = await self.readRequest(reader)
+            handler = self.routes.get(url.path)
+            if method != "GET":
+                status = 405
+            elif handler is None:
+                status = 404
+            else:
+                status = 200
+                contentType, body = handler(parse_qs(url.query))
+        except (ValueError, asyncio.TimeoutError):
+            status = 400
+        except Exception:
+            logger.exception("Status request failed")
+            raise
+        payload = body.encode()
+        head = (
+            f"HTTP/1.1 {status} {reasons[status]}\r\n"
+            f"Content-Type: {contentType}\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            "Connection: close\r\n\r\n"
+        )
+        try:
+            writer.write(head.encode("latin-1") + payload)
+            await writer.drain()
+        finally:
+            writer.close()
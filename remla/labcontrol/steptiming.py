@@ -0,0 +1,70 @@
+"""
+Step timing for stepper moves driven from Python.
+
+Sleeping for the step delay after every step lets the bus write, the GIL and
+the sleep's own overshoot pile up, so a long move runs well below its rate.
+StepScheduler instead waits for absolute deadlines, ``start + n * interval`` on
+the monotonic clock, so a late step is made up on the next ones instead of
+pushing back every step after it.
+
+Catching up means running steps back to back, which a motor can only follow for
+so long. Once a move falls more than ``maxLag`` steps behind, for example while
+the Pi is busy with something else, the schedule restarts from the current step
+instead.
+"""
+
+import math
+import time
+
+
+class StepScheduler(object):
+    def __init__(self, interval, maxLag=2, clock=time.monotonic, sleep=time.sleep):
+        """
+        :param interval: Seconds from one step to the next, the controller's delay.
+        :param maxLag: Steps the move may fall behind before the schedule restarts.
+        :param clock: Monotonic clock in seconds, replaceable for tests.
+        :param sleep: Sleep function, replaceable for tests.
+        """
+        self.interval = interval
+        self.maxLag = maxLag
+        self.clock = clock
+        self.sleep = sleep
+        self.start = self.anchor = self.last = clock()
+        self.steps = 0
+        # Steps since the schedule was last restarted.
+        self.scheduled = 0
+        self.resyncs = 0
+        # Running mean and sum of squared deviations of the step intervals.
+        self.mean = 0.0
+        self.squares = 0.0
+
+    def wait(self):
+        """Call after every step. Returns once the next step is due."""
+        self.steps += 1
+        self.scheduled += 1
+        now = self.clock()
+        if self.interval > 0:
+            deadline = self.anchor + self.scheduled * self.interval
+            if now < deadline:
+                self.sleep(deadline - now)
+                now = self.clock()
+            elif now - deadline > self.maxLag * self.interval:
+                self.anchor, self.scheduled = now, 0
+                self.resyncs += 1
+        period = now - self.last
+        self.last = now
+        delta = period - self.mean
+        self.mean += delta / self.steps
+        self.squares += delta * (period - self.mean)
+
+    def report(self):
+        """Requested and achieved step rate (steps/s) and jitter (s) of the move so far."""
+        elapsed = self.last - self.start
+        return {
+            "steps": self.steps,
+            "requestedRate": round(1 / self.interval, 1) if self.interval > 0 else None,
+            "achievedRate": round(self.steps / elapsed, 1) if elapsed > 0 else None,
+            # Standard deviation of the time from one step to the next.
+            "jitter": math.sqrt(self.squares / self.steps) if self.steps else 0.0,
+            "resyncs": self.resyncs,
+        }
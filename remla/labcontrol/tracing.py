@@ -0,0 +1,121 @@
+"""
+Per-command trace records.
+
+Where metrics aggregate, a trace keeps one record per command so a slow outlier
+can be tied to the exact command, parameters and client behind it. Records are
+kept in a ring buffer and handed to any number of sinks, e.g. a JSON-lines file::
+
+    trace:
+      capacity: 1000                      # records kept in memory
+      file: /var/log/remla/trace.jsonl    # optional
+
+Offsets in a record are seconds since the frame was received.
+"""
+
+import json
+import logging
+import queue
+import threading
+from collections import deque
+from itertools import count, islice
+
+logger = logging.getLogger(__name__)
+
+
+def offset(timing, stamp):
+    if stamp is None:
+        return None
+    return round(stamp - timing.received, 6)
+
+
+def traceRecord(traceId, request, timing, outcome, client=None):
+    """Build the record for one finished command from its metrics.CommandTiming."""
+    return {
+        "id": traceId,
+        "time": round(timing.wallTime, 6),
+        "client": client,
+        "device": request.deviceName,
+        "command": request.cmd,
+        "params": request.params,
+        "requestId": request.requestId,
+        "outcome": outcome,
+        "parsed": offset(timing, timing.parsed),
+        "lockRequested": offset(timing, timing.lockRequested),
+        "lockAcquired": offset(timing, timing.lockAcquired),
+        "hardwareStart": offset(timing, timing.hardwareStart),
+        "hardwareEnd": offset(timing, timing.hardwareEnd),
+        "sent": offset(timing, timing.sent),
+    }
+
+
+class JsonLinesSink(object):
+    """
+    Appends every record to a file, one JSON object per line. A thread of its own
+    does the writing, so a slow SD card never holds up the event loop.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Opened here so a bad path fails at startup rather than on the thread.
+        self.file = open(path, "a")
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.writeRecords, name="remla-trace", daemon=True)
+        self.thread.start()
+
+    def __call__(self, record):
+        self.queue.put(record)
+
+    def writeRecords(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            try:
+                self.file.write(json.dumps(record) + "\n")
+                # Flush once the backlog is written, not after every line.
+                if self.queue.empty():
+                    self.file.flush()
+            except Exception:
+                logger.exception("Writing trace record to %s failed", self.path)
+        self.file.close()
+
+    def close(self):
+        """Write out the records still queued and close the file."""
+        self.queue.put(None)
+        self.thread.join()
+
+
+class Tracer(object):
+    def __init__(self, capacity=1000, sinks=()):
+        """
+        :param capacity: Most recent records kept in memory.
+        :param sinks: Callables that receive every record as a dict.
+        """
+        self.records = deque(maxlen=capacity)
+        self.sinks = list(sinks)
+        self.ids = count(1)
+
+    def addSink(self, sink):
+        self.sinks.append(sink)
+
+    def record(self, request, timing, outcome, client=None):
+        record = traceRecord(next(self.ids), request, timing, outcome, client)
+        self.records.append(record)
+        for sink in self.sinks:
+            try:
+                sink(record)
+            except Exception:
+                # A full disk must not take command handling down with it.
+                logger.exception("Trace sink %s failed", sink)
+        return record
+
+    def last(self, n=None):
+        """The n most recent records, oldest first."""
+        if n is None or n >= len(self.records):
+            return list(self.records)
+        return list(islice(self.records, len(self.records) - n, None))
+
+    def close(self):
+        for sink in self.sinks:
+            if hasattr(sink, "close"):
+                sink.close()
@@ -1,5 +1,6 @@
 import asyncio
 import datetime
+import json
 import os
 import re
 import shutil
@@ -7,7 +8,7 @@ import signal
 import socket
 import subprocess
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 
 import typer
 import websockets
@@ -20,6 +21,9 @@ from typing_extensions import Annotated
 from remla import i2ccmd, setupcmd
 from remla.labcontrol.Controllers import *
 from remla.labcontrol.Experiment import Experiment
+from remla.labcontrol.host import ExperimentHost
+from remla.labcontrol.ipc import defaultIpcPath
+from remla.labcontrol.logsetup import setupLogging
 from remla.settings import *
 from remla.systemHelpers import *
 from remla.typerHelpers import *
@@ -528,59 +532,143 @@ def run(
             raise typer.Abort()
 
         remlaSettings = yaml.load(remlaSettingsPath)
-        currentLabSettingsPath = remoteLabsDirectory / remlaSettings["currentLab"]
-
-        if not currentLabSettingsPath or not currentLabSettingsPath.exists():
-            alert(
-                f"Lab settings file does not exist or no current lab configured at {currentLabSettingsPath}. Please check your settings.yml."
+        currentLab = remlaSettings["currentLab"]
+        if isinstance(currentLab, str):
+            experiment, _ = buildLab(remoteLabsDirectory / currentLab, remlaSettings, admin)
+            success("Experiment setup complete.")
+            try:
+                experiment.startServer()
+            finally:
+                # Stopping raises SystemExit out of the loop; keep the last positions
+                # and the trace records still waiting to be written.
+                experiment.closeJournal()
+                experiment.tracer.close()
+            return
+
+        # A list of labs runs them all in this process, sharing one event loop and
+        # one connection to the hardware.
+        host = ExperimentHost()
+        loggingConfig = dict(remlaSettings.get("logging", {}))
+        logsDirectory.mkdir(parents=True, exist_ok=True)
+        setupLogging(
+            logsDirectory / "remla.log", debug=loggingConfig.pop("debug", False), **loggingConfig
+        )
+        for index, labFile in enumerate(currentLab):
+            name = Path(labFile).stem
+            experiment, labSettings = buildLab(
+                remoteLabsDirectory / labFile,
+                remlaSettings,
+                admin,
+                name=name,
+                # The first lab answers the CLI; the others get their own socket.
+                ipcPath=defaultIpcPath if index == 0 else f"/tmp/remla_cmd-{name}.sock",
+                loop=host.loop,
+                configureLogging=False,
             )
-            raise typer.Abort()
+            try:
+                host.add(experiment, path=labSettings.get("path"))
+            except ValueError as e:
+                alert(str(e))
+                raise typer.Abort()
+        success(f"Hosting {len(host.experiments)} experiments.")
+        host.run()
 
-        labSettings = yaml.load(currentLabSettingsPath)
-        if "devices" not in labSettings:
-            alert(
-                f"Device list not found in the lab settings file located at {currentLabSettingsPath}. Please update the file to include your list of devices."
-            )
-            raise typer.Abort()
 
-        # Initialize devices from the lab settings
-        devices = createDevicesFromYml(labSettings["devices"])
-        print("Using devices:", labSettings["devices"])
-        # Create and setup the experiment
-        if admin:
-            experiment = Experiment("RemoteLabs", admin=True)
-        else:
-            experiment = Experiment("RemoteLabs")
+def buildLab(currentLabSettingsPath, remlaSettings, admin=False, name="RemoteLabs", **options):
+    """
+    Build an Experiment, its devices and its lock groups from a lab YAML file.
+
+    :param options: Passed on to Experiment, e.g. a shared loop. Settings in the
+        lab file take precedence for ``port`` and ``ipcPath``.
+    :return: The experiment and the lab's settings.
+    """
+    if not currentLabSettingsPath or not currentLabSettingsPath.exists():
+        alert(
+            f"Lab settings file does not exist or no current lab configured at {currentLabSettingsPath}. Please check your settings.yml."
+        )
+        raise typer.Abort()
 
-        for device in devices.values():
-            experiment.addDevice(device)
+    labSettings = yaml.load(currentLabSettingsPath)
+    if "devices" not in labSettings:
+        alert(
+            f"Device list not found in the lab settings file located at {currentLabSettingsPath}. Please update the file to include your list of devices."
+        )
+        raise typer.Abort()
+
+    # Initialize devices from the lab settings
+    devices = createDevicesFromYml(labSettings["devices"])
+    print("Using devices:", labSettings["devices"])
+    # Create and setup the experiment
+    executorsConfig = labSettings.get("executors", {})
+    controlConfig = labSettings.get("control", {})
+    metricsConfig = labSettings.get("metrics", {})
+    traceConfig = labSettings.get("trace", {})
+    journalConfig = labSettings.get("journal", {})
+    # Rotation is set per install in settings.yml; a lab may turn on debug.
+    loggingConfig = {**remlaSettings.get("logging", {}), **labSettings.get("logging", {})}
+    if "port" in labSettings:
+        options["port"] = labSettings["port"]
+    if "ipcPath" in labSettings:
+        options["ipcPath"] = labSettings["ipcPath"]
+    experiment = Experiment(
+        name,
+        admin=admin,
+        lockWorkers=executorsConfig.get("lockWorkers", 1),
+        gpioWorkers=executorsConfig.get("gpioWorkers", 2),
+        broadcastState=labSettings.get("broadcastState", True),
+        broadcastInterval=labSettings.get("broadcastInterval", 0.05),
+        progressRate=labSettings.get("progressRate", 10),
+        admission=labSettings.get("admission"),
+        leaseSeconds=controlConfig.get("leaseSeconds"),
+        idleSeconds=controlConfig.get("idleSeconds"),
+        statusHost=metricsConfig.get("host", "127.0.0.1"),
+        statusPort=metricsConfig.get("port"),
+        traceCapacity=traceConfig.get("capacity", 1000),
+        traceFile=traceConfig.get("file"),
+        debug=loggingConfig.pop("debug", False),
+        logSettings=loggingConfig,
+        # `journal: false` turns it off.
+        journal=None
+        if journalConfig is False
+        else {"path": str(stateDirectory / f"{name}.journal"), **journalConfig},
+        **options,
+    )
 
-        #### Now set up the locks.
-        locksConfig = labSettings.get("locks", {})
+    for device in devices.values():
+        experiment.addDevice(device)
 
-        for lockGroup, deviceNames in locksConfig.items():
-            try:
-                # Convert device names to device objects
-                deviceObjects = [
-                    devices[name] for name in deviceNames if name in devices
-                ]
-
-                # In case some devices listed in YAML are not initialized or missing
-                if len(deviceObjects) != len(deviceNames):
-                    missingDevices = set(deviceNames) - set(devices.keys())
-                    alert(
-                        f"Lock group '{lockGroup}' refers to undefined devices: {missingDevices}"
-                    )
-                    raise typer.Abort()
+    #### Now set up the locks.
+    locksConfig = labSettings.get("locks", {})
 
-                # Apply the lock to the group of device objects
-                experiment.addLockGroup(lockGroup, deviceObjects)
-            except KeyError as e:
-                alert(f"Device name error in lock configuration: {str(e)}")
+    for lockGroup, lockConfig in locksConfig.items():
+        # A lock group is either a list of device names or a mapping with
+        # `devices` and an optional `workers` pool size.
+        if isinstance(lockConfig, dict):
+            deviceNames = lockConfig.get("devices", [])
+            workers = lockConfig.get("workers")
+        else:
+            deviceNames = lockConfig
+            workers = None
+        try:
+            # Convert device names to device objects
+            deviceObjects = [
+                devices[name] for name in deviceNames if name in devices
+            ]
+
+            # In case some devices listed in YAML are not initialized or missing
+            if len(deviceObjects) != len(deviceNames):
+                missingDevices = set(deviceNames) - set(devices.keys())
+                alert(
+                    f"Lock group '{lockGroup}' refers to undefined devices: {missingDevices}"
+                )
                 raise typer.Abort()
-        # Placeholder for further experiment execution logic
-        success("Experiment setup complete.")
-        experiment.startServer()
+
+            # Apply the lock to the group of device objects
+            experiment.addLockGroup(lockGroup, deviceObjects, workers=workers)
+        except KeyError as e:
+            alert(f"Device name error in lock configuration: {str(e)}")
+            raise typer.Abort()
+    return experiment, labSettings
 
 
 @app.command()
@@ -726,14 +814,23 @@ def testws():
     asyncio.get_event_loop().run_until_complete(start_server)
     asyncio.get_event_loop().run_forever()
 
+def ipcRequest(message: dict):
+    """Send one request to the running server's control socket and return the reply."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(defaultIpcPath)
+        sock.sendall((json.dumps({"id": 1, **message}) + "\n").encode())
+        with sock.makefile("r") as replies:
+            reply = json.loads(replies.readline())
+    if reply.get("type") == "error":
+        raise RuntimeError(reply["message"])
+    return reply
+
+
 @app.command()
 def boot():
     """Send 'boot' command to the running remla server via IPC."""
-    ipc_path = "/tmp/remla_cmd.sock"
     try:
-        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
-            sock.connect(ipc_path)
-            sock.sendall(b"boot")
+        ipcRequest({"type": "message", "message": "boot"})
         print("Boot command sent to server.")
     except Exception as e:
         print(f"Failed to send boot command: {e}")
@@ -741,16 +838,77 @@ def boot():
 @app.command()
 def contact():
     """Send 'contact' command to the running remla server via IPC."""
-    ipc_path = "/tmp/remla_cmd.sock"
     try:
-        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
-            sock.connect(ipc_path)
-            sock.sendall(b"contact")
+        ipcRequest({"type": "message", "message": "contact"})
         print("Contact command sent to server.")
     except Exception as e:
         print(f"Failed to send contact command: {e}")
 
 
+@app.command()
+def send(
+    device: str,
+    command: str,
+    params: Optional[List[str]] = typer.Argument(None, help="Parameters for the command."),
+):
+    """Run a device command on the running server, e.g. `remla send stepper move 100`."""
+    try:
+        reply = ipcRequest({"device": device, "cmd": command, "params": params or []})
+    except Exception as e:
+        print(f"Failed to run {device}/{command}: {e}")
+        raise typer.Abort()
+    typer.echo(f"{reply['type']}: {reply['result']}")
+
+
+@app.command()
+def queues():
+    """Show how many commands are queued in each lock group of the running server."""
+    try:
+        depths = ipcRequest({"type": "queues"})["result"]
+    except Exception as e:
+        print(f"Failed to read queue depths: {e}")
+        raise typer.Abort()
+    for group, depth in depths.items():
+        typer.echo(f"{group}: {depth['queued']} queued, {depth['workers']} workers")
+
+
+@app.command()
+def metrics():
+    """Print the running server's metrics in Prometheus text format."""
+    try:
+        text = ipcRequest({"type": "metrics"})["result"]
+    except Exception as e:
+        print(f"Failed to read metrics: {e}")
+        raise typer.Abort()
+    typer.echo(text, nl=False)
+
+
+@app.command()
+def trace(last: int = typer.Option(200, help="How many of the most recent commands to show.")):
+    """Print trace records for the most recent commands, one JSON object per line."""
+    try:
+        records = ipcRequest({"type": "trace", "last": last})["result"]
+    except Exception as e:
+        print(f"Failed to read traces: {e}")
+        raise typer.Abort()
+    for record in records:
+        typer.echo(json.dumps(record))
+
+
+@app.command()
+def admission():
+    """Show the admission limits of the running server and how many commands they rejected."""
+    try:
+        stats = ipcRequest({"type": "admission"})["result"]
+    except Exception as e:
+        print(f"Failed to read admission stats: {e}")
+        raise typer.Abort()
+    typer.echo(
+        f"maxInFlight: {stats['maxInFlight']}, rate: {stats['rate']}/s, burst: {stats['burst']}"
+    )
+    for reason, count in stats["rejected"].items():
+        typer.echo(f"rejected ({reason}): {count}")
+
 
 if __name__ == "__main__":
     app()
@@ -18,6 +18,7 @@ mediamtxBinaryLocation = Path("/usr/local/bin")
 baseDir = Path(__file__).parent
 settingsDirectory = Path(typer.get_app_dir(APP_NAME))
 logsDirectory = settingsDirectory / "logs"
+stateDirectory = settingsDirectory / "state"
 homeDirectory = Path.home()
 remoteLabsDirectory = homeDirectory / 'remla'
 setupDirectory = baseDir / "setup"
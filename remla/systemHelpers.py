@@ -216,8 +216,8 @@ ExecStart={executablePath} run {"-w" if echo else ""} -f
 ExecStartPre=/bin/sleep 5
 Restart=always
 Environment="PATH={binPath}:/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin"
-StandardOutput=append:/var/log/remla.log
-StandardError=append:/var/log/remla.log
+StandardOutput=journal
+StandardError=journal
 
 
 [Install]
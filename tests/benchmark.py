@@ -0,0 +1,288 @@
+"""
+End-to-end load benchmark for the Experiment websocket server.
+
+A real ``Experiment`` is built from ``benchmark_lab.yml`` with
+``createDevicesFromYml`` and served on an ephemeral localhost port. The
+hardware libraries are replaced by the fakes in ``tests/fakes.py`` so this
+runs on any Linux box.
+
+The first client to connect holds control and drives the
+``processCommand -> runDeviceMethod -> sendMessage`` path. Every other client
+waits for control and its commands exercise the "no control" rejection path.
+Each client keeps one command in flight and times send -> reply. With
+``--pipeline N`` the controller switches to the JSON protocol and keeps N
+requests in flight, matching replies by request id. ``--spectators N`` adds N
+idle observers on ``/spectate`` that only receive broadcasts.
+
+Run it directly for a report::
+
+    python -m tests.benchmark --clients 8 --commands 2000 --pipeline 16
+    python -m tests.benchmark --clients 1 --spectators 500
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from tests import fakes
+
+fakes.install()
+os.environ.setdefault("XDG_CONFIG_HOME", tempfile.mkdtemp(prefix="remla-bench-"))
+
+import websockets  # noqa: E402
+
+from remla.labcontrol.Experiment import Experiment  # noqa: E402
+from remla.yaml import createDevicesFromYml, yaml  # noqa: E402
+
+benchmarkLab = Path(__file__).parent / "benchmark_lab.yml"
+
+commandMix = [
+    "stepper/move/5",
+    "stepper/move/-5",
+    "pololu/move/50",
+    "pololu/move/-50",
+    "screen/on/",
+    "screen/off/",
+    "led/on/",
+    "led/off/",
+    "lamp/power/50",
+    "servo/goto/30",
+    "multimeter/press/SYST:KEY 1",
+]
+
+
+def buildExperiment(labPath=benchmarkLab, name="Benchmark", **options):
+    """Build an Experiment the same way ``remla run`` does, passing options through."""
+    labSettings = yaml.load(labPath)
+    devices = createDevicesFromYml(labSettings["devices"])
+    experiment = Experiment(name, host="127.0.0.1", port=0, **options)
+    for device in devices.values():
+        experiment.addDevice(device)
+    for lockGroup, deviceNames in labSettings.get("locks", {}).items():
+        experiment.addLockGroup(lockGroup, [devices[name] for name in deviceNames])
+    return experiment
+
+
+class ServerThread:
+    """Runs an Experiment's event loop and websocket server on a background thread."""
+
+    def __init__(self, experiment):
+        self.experiment = experiment
+        self.port = None
+        self.server = None
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        loop = self.experiment.loop
+        asyncio.set_event_loop(loop)
+        self.server = loop.run_until_complete(
+            websockets.serve(self.experiment.handleConnection, self.experiment.host, 0)
+        )
+        self.port = self.server.sockets[0].getsockname()[1]
+        self._ready.set()
+        loop.run_forever()
+        self.server.close()
+        loop.run_until_complete(self.server.wait_closed())
+        # Let anything still running, such as a reset after a handoff, wind down.
+        pending = asyncio.all_tasks(loop)
+        for task in pending:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+
+    def __enter__(self):
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def __exit__(self, *exc):
+        self.experiment.loop.call_soon_threadsafe(self.experiment.loop.stop)
+        self._thread.join()
+        self.experiment.shutdownExecutors()
+
+    @property
+    def uri(self):
+        return f"ws://{self.experiment.host}:{self.port}"
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return float("nan")
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+broadcastTypes = ("state", "snapshot", "progress")
+
+
+async def recvReply(websocket):
+    """Receive the next reply, skipping state and progress broadcasts."""
+    while True:
+        frame = await websocket.recv()
+        if frame.startswith(("STATE: ", "PROGRESS: ")):
+            continue
+        if frame.startswith("{") and json.loads(frame).get("type") in broadcastTypes:
+            continue
+        return frame
+
+
+async def driveClient(websocket, commands, count):
+    latencies = []
+    for i in range(count):
+        command = commands[i % len(commands)]
+        start = time.perf_counter()
+        await websocket.send(command)
+        await recvReply(websocket)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def drivePipelined(websocket, commands, count, depth):
+    await websocket.send(json.dumps({"protocol": "json"}))
+    await recvReply(websocket)  # hello
+    sentAt = {}
+    latencies = []
+    window = asyncio.Semaphore(depth)
+
+    async def receive():
+        for _ in range(count):
+            reply = json.loads(await recvReply(websocket))
+            latencies.append(time.perf_counter() - sentAt.pop(reply["id"]))
+            window.release()
+
+    receiver = asyncio.create_task(receive())
+    for i in range(count):
+        await window.acquire()
+        deviceName, cmd, params = commands[i % len(commands)].split("/")
+        request = {"id": i, "device": deviceName, "cmd": cmd, "params": params.split(",")}
+        sentAt[i] = time.perf_counter()
+        await websocket.send(json.dumps(request))
+    await receiver
+    return latencies
+
+
+async def drain(websocket):
+    with contextlib.suppress(websockets.ConnectionClosed):
+        async for _ in websocket:
+            pass
+
+
+async def runClients(uri, clients, commands, count, pipeline=None, spectators=0):
+    sockets = []
+    observers = []
+    try:
+        # Connect one at a time so the first socket deterministically holds control.
+        for _ in range(clients):
+            websocket = await websockets.connect(uri)
+            await recvReply(websocket)  # controlStatus alert
+            if sockets:
+                await recvReply(websocket)  # queue position
+            sockets.append(websocket)
+        for _ in range(spectators):
+            observers.append(await websockets.connect(f"{uri}/spectate"))
+        draining = [asyncio.create_task(drain(websocket)) for websocket in observers]
+
+        start = time.perf_counter()
+        if pipeline:
+            controller = drivePipelined(sockets[0], commands, count, pipeline)
+        else:
+            controller = driveClient(sockets[0], commands, count)
+        results = await asyncio.gather(
+            controller,
+            *(driveClient(websocket, commands, count) for websocket in sockets[1:]),
+        )
+        elapsed = time.perf_counter() - start
+    finally:
+        for websocket in sockets + observers:
+            await websocket.close()
+    await asyncio.gather(*draining)
+    return results, elapsed
+
+
+def summarize(latencies, elapsed):
+    return {
+        "commands": len(latencies),
+        "seconds": elapsed,
+        "commandsPerSecond": len(latencies) / elapsed if elapsed else float("nan"),
+        "p50": percentile(latencies, 0.50),
+        "p99": percentile(latencies, 0.99),
+    }
+
+
+def runBenchmark(
+    clients=4,
+    commands=500,
+    labPath=benchmarkLab,
+    commandList=commandMix,
+    pipeline=None,
+    spectators=0,
+):
+    """
+    Serve a simulated lab and drive it with ``clients`` concurrent websocket clients.
+
+    :param clients: Number of connected clients; the first one holds control.
+    :param commands: Commands sent by each client.
+    :param pipeline: If set, the controller uses JSON framing with this many
+        requests in flight.
+    :param spectators: Idle observers connected to ``/spectate``.
+    :return: ``{"controller": {...}, "spectators": {...}}`` with commands/sec and
+        p50/p99 latency in seconds.
+    """
+    experiment = buildExperiment(labPath)
+    # Answer every rejected command so the waiting clients can time them.
+    experiment.noticeInterval = 0
+    with ServerThread(experiment) as server:
+        results, elapsed = asyncio.run(
+            runClients(server.uri, clients, commandList, commands, pipeline, spectators)
+        )
+
+    report = {"controller": summarize(results[0], elapsed)}
+    spectatorLatencies = [latency for result in results[1:] for latency in result]
+    if spectatorLatencies:
+        report["spectators"] = summarize(spectatorLatencies, elapsed)
+    return report
+
+
+def formatReport(report):
+    lines = []
+    for role, stats in report.items():
+        lines.append(
+            f"{role:>10}: {stats['commands']} commands in {stats['seconds']:.2f} s"
+            f" -> {stats['commandsPerSecond']:.1f} cmd/s,"
+            f" p50 {stats['p50'] * 1e3:.2f} ms, p99 {stats['p99'] * 1e3:.2f} ms"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--commands", type=int, default=500)
+    parser.add_argument("--lab", type=Path, default=benchmarkLab)
+    parser.add_argument("--pipeline", type=int, default=None)
+    parser.add_argument("--spectators", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    # The server prints on every command; keep that out of the report.
+    with contextlib.redirect_stdout(io.StringIO()):
+        report = runBenchmark(
+            args.clients,
+            args.commands,
+            args.lab,
+            pipeline=args.pipeline,
+            spectators=args.spectators,
+        )
+    print(formatReport(report))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
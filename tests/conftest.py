@@ -0,0 +1,10 @@
+import os
+import tempfile
+
+from tests import fakes
+
+# Controllers talks to GPIO, pigpio, I2C and VISA at import time, and
+# Experiment writes its log under the user's config directory. Both have to be
+# redirected before anything imports remla.
+fakes.install()
+os.environ.setdefault("XDG_CONFIG_HOME", tempfile.mkdtemp(prefix="remla-tests-"))
@@ -0,0 +1,299 @@
+"""
+In-process stand-ins for the Raspberry Pi hardware libraries used by
+``remla.labcontrol.Controllers``.
+
+The real ``RPi.GPIO``, ``pigpio``, ``adafruit_motorkit`` and ``pyvisa`` modules
+either refuse to import off a Pi or try to talk to daemons and serial ports.
+``install()`` puts these fakes into ``sys.modules`` so the controllers and the
+Experiment server can run unchanged on a plain Linux box.
+"""
+
+import sys
+import types
+
+# Simulated hardware latency in seconds. Zero by default so the benchmark
+# measures the server and not the fakes; bump these to model a slow bus.
+latency = {"onestep": 0.0, "visa": 0.0}
+
+
+def _sleep(key):
+    if latency[key]:
+        import time
+
+        time.sleep(latency[key])
+
+
+def _makeGpio():
+    gpio = types.ModuleType("RPi.GPIO")
+    gpio.BCM = 11
+    gpio.BOARD = 10
+    gpio.OUT = 0
+    gpio.IN = 1
+    gpio.LOW = 0
+    gpio.HIGH = 1
+    gpio.PUD_OFF = 20
+    gpio.PUD_DOWN = 21
+    gpio.PUD_UP = 22
+    gpio.RISING = 31
+    gpio.FALLING = 32
+    gpio.BOTH = 33
+    gpio.pins = {}
+
+    def setmode(mode):
+        gpio.mode = mode
+
+    def setwarnings(flag):
+        pass
+
+    def setup(channels, direction, pull_up_down=None, initial=None):
+        if not isinstance(channels, (list, tuple)):
+            channels = [channels]
+        for channel in channels:
+            gpio.pins.setdefault(channel, gpio.LOW)
+
+    def output(channels, values):
+        if not isinstance(channels, (list, tuple)):
+            channels = [channels]
+            values = [values]
+        elif not isinstance(values, (list, tuple)):
+            values = [values] * len(channels)
+        for channel, value in zip(channels, values):
+            gpio.pins[channel] = value
+
+    def input(channel):
+        return gpio.pins.get(channel, gpio.LOW)
+
+    def cleanup(*args):
+        gpio.pins.clear()
+
+    class PWM:
+        def __init__(self, channel, frequency):
+            self.channel = channel
+            self.frequency = frequency
+            self.dutyCycle = 0
+
+        def start(self, dutyCycle):
+            self.dutyCycle = dutyCycle
+
+        def ChangeDutyCycle(self, dutyCycle):
+            self.dutyCycle = dutyCycle
+
+        def ChangeFrequency(self, frequency):
+            self.frequency = frequency
+
+        def stop(self):
+            pass
+
+    gpio.setmode = setmode
+    gpio.setwarnings = setwarnings
+    gpio.setup = setup
+    gpio.output = output
+    gpio.input = input
+    gpio.cleanup = cleanup
+    gpio.PWM = PWM
+    return gpio
+
+
+def _makePigpio():
+    pigpio = types.ModuleType("pigpio")
+    pigpio.INPUT = 0
+    pigpio.OUTPUT = 1
+    pigpio.PUD_OFF = 0
+    pigpio.PUD_DOWN = 1
+    pigpio.PUD_UP = 2
+    pigpio.RISING_EDGE = 0
+    pigpio.FALLING_EDGE = 1
+    pigpio.EITHER_EDGE = 2
+
+    class pulse:
+        def __init__(self, gpio_on, gpio_off, delay):
+            self.gpio_on = gpio_on
+            self.gpio_off = gpio_off
+            self.delay = delay
+
+    class _callback:
+        def __init__(self, gpio, edge, func):
+            self.gpio = gpio
+            self.edge = edge
+            self.func = func
+
+        def cancel(self):
+            pass
+
+    class pi:
+        def __init__(self, host="localhost", port=8888):
+            self.connected = True
+            self.levels = {}
+            self.waves = []
+            self.chains = []
+
+        def set_mode(self, gpio, mode):
+            pass
+
+        def set_pull_up_down(self, gpio, pud):
+            pass
+
+        def set_glitch_filter(self, gpio, steady):
+            pass
+
+        def write(self, gpio, level):
+            self.levels[gpio] = int(level)
+
+        def read(self, gpio):
+            return self.levels.get(gpio, 0)
+
+        def set_PWM_frequency(self, gpio, frequency):
+            return frequency
+
+        def set_PWM_dutycycle(self, gpio, dutycycle):
+            self.levels[gpio] = dutycycle
+
+        def set_servo_pulsewidth(self, gpio, pulsewidth):
+            self.levels[gpio] = pulsewidth
+
+        def callback(self, gpio, edge=0, func=None):
+            return _callback(gpio, edge, func)
+
+        def wave_clear(self):
+            self.waves = []
+
+        def wave_add_generic(self, pulses):
+            self.waves.append(pulses)
+            return len(pulses)
+
+        def wave_create(self):
+            return len(self.waves) - 1
+
+        def wave_chain(self, data):
+            self.chains.append(data)
+
+        def wave_tx_busy(self):
+            return 0
+
+        def wave_tx_stop(self):
+            pass
+
+        def stop(self):
+            self.connected = False
+
+    pigpio.pulse = pulse
+    pigpio.pi = pi
+    return pigpio
+
+
+def _makeAdafruit():
+    stepperModule = types.ModuleType("adafruit_motor.stepper")
+    stepperModule.FORWARD = 1
+    stepperModule.BACKWARD = 2
+    stepperModule.SINGLE = 1
+    stepperModule.DOUBLE = 2
+    stepperModule.INTERLEAVE = 3
+    stepperModule.MICROSTEP = 4
+
+    class StepperMotor:
+        def __init__(self):
+            self.position = 0
+            self.released = True
+
+        def onestep(self, *, direction=stepperModule.FORWARD, style=stepperModule.SINGLE):
+            _sleep("onestep")
+            self.released = False
+            self.position += 1 if direction == stepperModule.FORWARD else -1
+            return self.position
+
+        def release(self):
+            self.released = True
+
+    class DCMotor:
+        def __init__(self):
+            self.throttle = None
+
+    stepperModule.StepperMotor = StepperMotor
+
+    motorModule = types.ModuleType("adafruit_motor")
+    motorModule.stepper = stepperModule
+
+    motorkitModule = types.ModuleType("adafruit_motorkit")
+
+    class MotorKit:
+        def __init__(self, address=0x60, i2c=None, steppers_microsteps=16, pwm_frequency=1600.0):
+            self._motors = [DCMotor() for _ in range(4)]
+            self._steppers = [StepperMotor() for _ in range(2)]
+
+        motor1 = property(lambda self: self._motors[0])
+        motor2 = property(lambda self: self._motors[1])
+        motor3 = property(lambda self: self._motors[2])
+        motor4 = property(lambda self: self._motors[3])
+        stepper1 = property(lambda self: self._steppers[0])
+        stepper2 = property(lambda self: self._steppers[1])
+
+    motorkitModule.MotorKit = MotorKit
+    return motorModule, stepperModule, motorkitModule
+
+
+def _makeVisa():
+    visa = types.ModuleType("pyvisa")
+
+    class Resource:
+        def __init__(self, name, **kwargs):
+            self.name = name
+            self.read_termination = "\n"
+            self.write_termination = "\n"
+            self.written = []
+
+        def write(self, message):
+            _sleep("visa")
+            self.written.append(message)
+            return len(message)
+
+        def read(self):
+            _sleep("visa")
+            return "+0.000000E+00"
+
+        def query(self, message):
+            self.write(message)
+            return self.read()
+
+        def close(self):
+            pass
+
+    class ResourceManager:
+        def __init__(self, backend=""):
+            self.backend = backend
+
+        def open_resource(self, name, **kwargs):
+            return Resource(name, **kwargs)
+
+        def list_resources(self):
+            return ()
+
+    visa.ResourceManager = ResourceManager
+    return visa
+
+
+def install():
+    """Register the fake hardware modules. Safe to call more than once."""
+    if getattr(sys.modules.get("pigpio"), "__remlaFake__", False):
+        return
+
+    gpio = _makeGpio()
+    rpi = types.ModuleType("RPi")
+    rpi.GPIO = gpio
+    pigpio = _makePigpio()
+    motorModule, stepperModule, motorkitModule = _makeAdafruit()
+    visa = _makeVisa()
+
+    for module in (gpio, rpi, pigpio, motorModule, stepperModule, motorkitModule, visa):
+        module.__remlaFake__ = True
+
+    sys.modules.update(
+        {
+            "RPi": rpi,
+            "RPi.GPIO": gpio,
+            "pigpio": pigpio,
+            "adafruit_motor": motorModule,
+            "adafruit_motor.stepper": stepperModule,
+            "adafruit_motorkit": motorkitModule,
+            "pyvisa": visa,
+        }
+    )
@@ -0,0 +1,39 @@
+"""
+Serve the benchmark lab as a remla node in a process of its own, so gateway
+tests can run several nodes on one machine::
+
+    python -m tests.node --name left
+
+Prints ``PORT <port>`` once it is listening on localhost, then serves until it
+is killed.
+"""
+
+import argparse
+import contextlib
+import io
+import sys
+
+import websockets
+
+from tests.benchmark import buildExperiment
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--name", default="node")
+    parser.add_argument("--port", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    # Controllers print as they are built; keep stdout for the port line.
+    with contextlib.redirect_stdout(io.StringIO()):
+        experiment = buildExperiment(name=args.name, configureLogging=False)
+    loop = experiment.loop
+    server = loop.run_until_complete(
+        websockets.serve(experiment.handleConnection, "127.0.0.1", args.port)
+    )
+    print("PORT", server.sockets[0].getsockname()[1], flush=True)
+    loop.run_forever()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,37 @@
+from remla.labcontrol.admission import Admission, ClientGate, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket_allows_a_burst_then_refills_at_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=10, burst=3, clock=clock)
+    assert [bucket.take() for _ in range(4)] == [True, True, True, False]
+    clock.now = 0.1
+    assert bucket.take()
+    assert not bucket.take()
+    clock.now = 10
+    assert bucket.tokens <= 3 and bucket.take()
+
+
+def test_gates_bound_in_flight_commands():
+    gate = ClientGate(maxInFlight=2)
+    assert gate.admit() is None
+    assert gate.admit() is None
+    assert gate.admit() == "inFlight"
+    gate.release()
+    assert gate.admit() is None
+
+
+def test_rate_limited_gates_report_the_reason():
+    admission = Admission(maxInFlight=None, rate=1, burst=1)
+    gate = admission.gate()
+    assert gate.admit() is None
+    assert gate.admit() == "rate"
+    assert gate.inFlight == 1
@@ -0,0 +1,190 @@
+import asyncio
+import json
+
+import pytest
+import websockets
+
+from remla.labcontrol.admission import Admission
+from tests import fakes
+from tests.benchmark import ServerThread, buildExperiment, recvReply, runBenchmark
+
+
+def test_benchmark_serves_every_command():
+    report = runBenchmark(clients=3, commands=40)
+
+    controller = report["controller"]
+    assert controller["commands"] == 40
+    assert controller["commandsPerSecond"] > 0
+    assert controller["p50"] <= controller["p99"]
+
+    spectators = report["spectators"]
+    assert spectators["commands"] == 80
+
+
+def test_benchmark_pipelined_json():
+    report = runBenchmark(clients=1, commands=60, pipeline=8)
+
+    assert report["controller"]["commands"] == 60
+    assert "spectators" not in report
+
+
+def test_spectators_receive_state_deltas():
+    async def scenario(uri):
+        async with websockets.connect(uri) as controller, websockets.connect(uri) as spectator:
+            await controller.recv()  # controlStatus
+            snapshot = await controller.recv()
+            assert json.loads(snapshot[len("STATE: "):])["type"] == "snapshot"
+            await spectator.recv()  # controlStatus
+            await spectator.recv()  # queue position
+            await spectator.recv()  # snapshot
+            await controller.send("stepper/move/7")
+            await recvReply(controller)
+            while True:
+                frame = await spectator.recv()
+                if not frame.startswith("PROGRESS: "):
+                    return frame
+
+    with ServerThread(buildExperiment()) as server:
+        frame = asyncio.run(scenario(server.uri))
+
+    assert frame.startswith("STATE: ")
+    assert json.loads(frame[len("STATE: "):]) == {
+        "type": "state",
+        "device": "stepper",
+        "delta": {"position": 7},
+    }
+
+
+def test_long_moves_stream_progress(monkeypatch):
+    monkeypatch.setitem(fakes.latency, "onestep", 0.01)
+    experiment = buildExperiment()
+    experiment.progressInterval = 0.05
+
+    async def scenario(uri):
+        async with websockets.connect(uri) as controller:
+            await controller.recv()  # controlStatus
+            await controller.recv()  # snapshot
+            await controller.send('{"protocol": "json"}')
+            frames = []
+            await controller.send('{"id": 1, "device": "stepper", "cmd": "move", "params": [40]}')
+            while True:
+                frame = json.loads(await controller.recv())
+                frames.append(frame)
+                if frame.get("id") == 1:
+                    return frames
+
+    with ServerThread(experiment) as server:
+        frames = asyncio.run(scenario(server.uri))
+
+    progress = [frame for frame in frames if frame["type"] == "progress"]
+    assert len(progress) >= 3
+    assert all(frame["target"] == 40 for frame in progress)
+    positions = [frame["position"] for frame in progress]
+    assert positions == sorted(positions) and 0 < positions[-1] <= 40
+
+
+def test_clients_over_their_in_flight_limit_are_told_so(monkeypatch):
+    monkeypatch.setitem(fakes.latency, "onestep", 0.01)
+    experiment = buildExperiment()
+    experiment.admission = Admission(maxInFlight=2)
+
+    async def scenario(uri):
+        async with websockets.connect(uri) as controller:
+            await controller.recv()  # controlStatus
+            await controller.recv()  # snapshot
+            await controller.send('{"protocol": "json"}')
+            await recvReply(controller)  # hello
+            for i in range(5):
+                request = {"id": i, "device": "stepper", "cmd": "move", "params": [5]}
+                await controller.send(json.dumps(request))
+            return [json.loads(await recvReply(controller)) for _ in range(5)]
+
+    with ServerThread(experiment) as server:
+        replies = asyncio.run(scenario(server.uri))
+
+    overloaded = [reply for reply in replies if reply["type"] == "overloaded"]
+    assert sorted(reply["id"] for reply in overloaded) == [2, 3, 4]
+    assert all(reply["reason"] == "inFlight" for reply in overloaded)
+    assert experiment.admission.stats()["rejected"] == {"inFlight": 3, "rate": 0}
+
+
+def test_spectators_never_take_control_and_waiting_clients_are_not_spammed():
+    experiment = buildExperiment()
+
+    async def scenario(uri):
+        async with websockets.connect(f"{uri}/spectate?protocol=json") as spectator:
+            snapshot = json.loads(await spectator.recv())
+            await spectator.send("stepper/move/5")  # ignored, never parsed
+            async with websockets.connect(uri) as controller:
+                assert "controlStatus/1" in await controller.recv()
+                async with websockets.connect(uri) as waiting:
+                    assert "controlStatus/0" in await waiting.recv()
+                    assert await waiting.recv() == "ALERT: Experiment/queue/1"
+                    for _ in range(3):
+                        await waiting.send("led/on/")
+                    notice = await recvReply(waiting)
+                    with pytest.raises(asyncio.TimeoutError):
+                        await asyncio.wait_for(recvReply(waiting), 0.2)
+                    await controller.send("stepper/move/7")
+                    delta = json.loads(await spectator.recv())
+                    while delta["type"] == "progress":
+                        delta = json.loads(await spectator.recv())
+        return snapshot, notice, delta
+
+    with ServerThread(experiment) as server:
+        snapshot, notice, delta = asyncio.run(scenario(server.uri))
+
+    assert snapshot["type"] == "snapshot"
+    assert notice.endswith("You do not have control to send commands.")
+    assert delta["type"] == "state"
+    assert experiment.activeClient is None and not experiment.clients
+
+
+def test_hundreds_of_idle_spectators_are_cheap():
+    report = runBenchmark(clients=1, commands=100, spectators=200)
+    assert report["controller"]["commands"] == 100
+
+
+def test_leases_hand_control_to_the_next_client_in_line():
+    experiment = buildExperiment()
+    experiment.leaseSeconds = 0.3
+    experiment.leaseCheckInterval = 0.05
+
+    async def scenario(uri):
+        async with websockets.connect(uri) as first, websockets.connect(uri) as second:
+            assert "controlStatus/1" in await recvReply(first)
+            assert "controlStatus/0" in await recvReply(second)
+            position = await recvReply(second)
+            granted = await asyncio.wait_for(recvReply(second), 2)
+            expired = await recvReply(first)
+            requeued = await recvReply(first)
+        return position, granted, expired, requeued
+
+    with ServerThread(experiment) as server:
+        position, granted, expired, requeued = asyncio.run(scenario(server.uri))
+
+    assert position in ("ALERT: Experiment/queue/1,0", "ALERT: Experiment/queue/1,1")
+    assert granted.startswith("ALERT: Experiment/controlStatus/1,It is your turn")
+    assert expired == "ALERT: Experiment/controlStatus/0,Your time with the lab equipment is up."
+    assert requeued.startswith("ALERT: Experiment/queue/1,")
+
+
+def test_idle_clients_lose_control_only_when_someone_is_waiting():
+    experiment = buildExperiment()
+    experiment.idleSeconds = 0.2
+    experiment.leaseCheckInterval = 0.05
+
+    async def scenario(uri):
+        async with websockets.connect(uri) as first:
+            await recvReply(first)
+            await asyncio.sleep(0.4)
+            assert experiment.activeClient is not None
+            async with websockets.connect(uri) as second:
+                await recvReply(second)  # controlStatus
+                assert await recvReply(second) == "ALERT: Experiment/queue/1"
+                return await asyncio.wait_for(recvReply(second), 2)
+
+    with ServerThread(experiment) as server:
+        granted = asyncio.run(scenario(server.uri))
+
+    assert "controlStatus/1" in granted
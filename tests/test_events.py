@@ -0,0 +1,31 @@
+import asyncio
+import threading
+
+from remla.labcontrol.events import EventBus, StateChanged
+
+
+def test_events_from_other_threads_are_delivered_on_the_loop():
+    loop = asyncio.new_event_loop()
+    bus = EventBus(loop)
+    delivered = []
+
+    def broken(event):
+        raise RuntimeError("subscriber bug")
+
+    bus.subscribe(StateChanged, broken)
+    bus.subscribe(StateChanged, lambda event: delivered.append((event, threading.current_thread())))
+
+    async def scenario():
+        thread = threading.Thread(target=bus.publish, args=(StateChanged("motor", "limit"),))
+        thread.start()
+        thread.join()
+        while not delivered:
+            await asyncio.sleep(0.01)
+
+    try:
+        loop.run_until_complete(scenario())
+    finally:
+        loop.close()
+    (event, thread), = delivered
+    assert (event.deviceName, event.reason) == ("motor", "limit")
+    assert thread is threading.main_thread()
@@ -0,0 +1,571 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+from remla.labcontrol import Controllers
+from remla.labcontrol.Controllers import ArgumentNumberError, BaseController, CommandError
+from remla.labcontrol.events import StateDelta
+from remla.labcontrol.Experiment import NoDeviceError, stateDelta
+from tests import fakes
+from tests.benchmark import buildExperiment
+
+
+class RecordingSocket:
+    """Just enough of a websocket for Experiment to send replies to."""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, data):
+        self.sent.append(data)
+
+
+@pytest.fixture
+def experiment():
+    experiment = buildExperiment()
+    yield experiment
+    experiment.shutdownExecutors()
+    experiment.loop.close()
+
+
+def run(experiment, coro):
+    return experiment.loop.run_until_complete(coro)
+
+
+def test_each_lock_group_has_its_own_pool(experiment):
+    depths = experiment.queueDepths()
+    assert set(depths) == {"gpio", "stepperLock", "pololuLock", "gpioLock", "meterLock"}
+    assert depths["stepperLock"] == {"queued": 0, "workers": 1}
+    assert experiment.poolFor("led") == "gpio"
+    assert experiment.poolFor("stepper") == "stepperLock"
+
+
+def test_busy_group_does_not_block_other_groups(experiment, monkeypatch):
+    monkeypatch.setitem(fakes.latency, "onestep", 0.01)
+    socket = RecordingSocket()
+
+    async def scenario():
+        move = asyncio.create_task(
+            experiment.runDeviceMethod("stepper", "move", ["50"], socket)
+        )
+        await asyncio.sleep(0.05)
+        assert experiment.queueDepths()["stepperLock"]["queued"] == 1
+        start = time.perf_counter()
+        await experiment.runDeviceMethod("multimeter", "press", ["SYST:KEY 1"], socket)
+        elapsed = time.perf_counter() - start
+        await move
+        return elapsed
+
+    assert run(experiment, scenario()) < 0.2
+    assert experiment.queueDepths()["stepperLock"]["queued"] == 0
+
+
+def test_queued_continuous_commands_coalesce(experiment):
+    sockets = [RecordingSocket() for _ in range(3)]
+
+    async def scenario():
+        async with experiment.lockGroups["gpioLock"]:
+            tasks = [
+                asyncio.create_task(
+                    experiment.runDeviceMethod("servo", "goto", [angle], socket)
+                )
+                for angle, socket in zip(["10", "20", "30"], sockets)
+            ]
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+
+    run(experiment, scenario())
+    assert sockets[0].sent == ["ALERT: servo/goto/superseded"]
+    assert sockets[1].sent == ["ALERT: servo/goto/superseded"]
+    assert len(sockets[2].sent) == 1
+    assert experiment.devices["servo"].state["angle"] == 30.0
+    assert experiment.pendingCommands == {}
+
+
+def test_a_cancelled_coalescing_command_frees_its_slot(experiment):
+    socket = RecordingSocket()
+
+    async def scenario():
+        async with experiment.lockGroups["gpioLock"]:
+            task = asyncio.create_task(experiment.runDeviceMethod("servo", "goto", ["10"], socket))
+            await asyncio.sleep(0)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            assert experiment.pendingCommands == {}
+        await experiment.runDeviceMethod("servo", "goto", ["20"], socket)
+
+    run(experiment, scenario())
+    # The next command had nothing stale to supersede.
+    assert len(socket.sent) == 1 and "superseded" not in socket.sent[0]
+    assert experiment.devices["servo"].state["angle"] == 20.0
+
+
+def test_json_requests_get_tagged_replies_and_errors(experiment):
+    socket = RecordingSocket()
+
+    async def scenario():
+        await experiment.processCommand(
+            '{"id": 1, "device": "stepper", "cmd": "move", "params": [5]}', socket
+        )
+        await experiment.processCommand(
+            '{"id": 2, "device": "stepper", "cmd": "move", "params": [1, 2]}', socket
+        )
+        await experiment.processCommand('{"id": 3, "device": "nope", "cmd": "on"}', socket)
+
+    run(experiment, scenario())
+    replies = [json.loads(frame) for frame in socket.sent]
+    assert replies[0] == {"id": 1, "type": "message", "result": "stepper/position/5"}
+    assert replies[1]["id"] == 2 and replies[1]["error"] == "ArgumentNumberError"
+    assert replies[2]["id"] == 3 and replies[2]["error"] == "NoDeviceError"
+
+
+def test_state_delta_only_holds_changed_keys():
+    assert stateDelta({"a": 1, "b": 2}, {"a": 1, "b": 3}) == (True, {"b": 3})
+    assert stateDelta({"a": 1}, {"a": 1}) == (False, {})
+    assert stateDelta({"a": 1, "b": 2}, {"a": 1}) == (True, {"b": None})
+    assert stateDelta("off", "on") == (True, "on")
+
+
+def test_stop_cancels_running_and_queued_commands(experiment, monkeypatch):
+    monkeypatch.setitem(fakes.latency, "onestep", 0.01)
+    socket = RecordingSocket()
+    stepper = experiment.devices["stepper"]
+
+    async def scenario():
+        running = asyncio.create_task(
+            experiment.runDeviceMethod("stepper", "move", ["500"], socket)
+        )
+        queued = asyncio.create_task(
+            experiment.runDeviceMethod("stepper", "move", ["500"], socket)
+        )
+        await asyncio.sleep(0.1)
+        start = time.perf_counter()
+        await experiment.processCommand("stepper/stop/", socket)
+        await asyncio.gather(running, queued)
+        return time.perf_counter() - start
+
+    assert run(experiment, scenario()) < 0.1
+    assert socket.sent[0] == "MESSAGE: stepper/stopped/2"
+    assert socket.sent[1] == f"ALERT: stepper/cancelled/{stepper.currentPosition}"
+    assert socket.sent[2] == "ALERT: stepper/move/cancelled"
+    assert 0 < stepper.currentPosition < 500
+    assert not experiment.commandTokens["stepper"]
+
+
+def test_bad_commands_are_rejected_before_queueing(experiment):
+    socket = RecordingSocket()
+    assert ("stepper", "move") in experiment.dispatchTable
+    assert ("stepper", "release") not in experiment.dispatchTable
+
+    with pytest.raises(CommandError):
+        run(experiment, experiment.runDeviceMethod("stepper", "release", [""], socket))
+    with pytest.raises(ArgumentNumberError):
+        run(experiment, experiment.runDeviceMethod("stepper", "move", ["1", "2"], socket))
+    with pytest.raises(NoDeviceError):
+        run(experiment, experiment.runDeviceMethod("laser", "on", [""], socket))
+    assert experiment.queueDepths()["stepperLock"]["queued"] == 0
+    assert socket.sent == []
+
+
+def test_zero_arity_commands_accept_an_empty_slash_param(experiment):
+    socket = RecordingSocket()
+    run(experiment, experiment.runDeviceMethod("servo", "disable", [""], socket))
+    assert socket.sent == ["MESSAGE: {'running': False, 'angle': 0}"]
+
+
+def test_nonblocking_commands_skip_the_executor(experiment):
+    socket = RecordingSocket()
+    assert experiment.dispatchTable[("led", "on")].inline
+    assert not experiment.dispatchTable[("stepper", "move")].inline
+    # With the pools gone, only inline commands can still run.
+    experiment.shutdownExecutors()
+
+    run(experiment, experiment.runDeviceMethod("led", "on", [""], socket))
+    run(experiment, experiment.runDeviceMethod("servo", "goto", ["30"], socket))
+    assert Controllers.gpio.pins[20] == 1
+    assert socket.sent[0] == "MESSAGE: led ran on"
+    assert len(socket.sent) == 2
+    with pytest.raises(RuntimeError):
+        run(experiment, experiment.runDeviceMethod("stepper", "move", ["5"], socket))
+
+
+def test_batches_run_atomically_and_reply_once(experiment, monkeypatch):
+    monkeypatch.setitem(fakes.latency, "onestep", 0.001)
+    socket = RecordingSocket()
+    batch = {
+        "id": 4,
+        "type": "batch",
+        "commands": [
+            {"device": "screen", "cmd": "on"},
+            {"device": "stepper", "cmd": "move", "params": [20]},
+            {"device": "stepper", "cmd": "goto", "params": ["ref"]},
+        ],
+    }
+
+    async def scenario():
+        running = asyncio.create_task(experiment.processCommand(json.dumps(batch), socket))
+        await asyncio.sleep(0.005)
+        # A lone command on a locked device waits for the whole batch.
+        await experiment.runDeviceMethod("stepper", "move", ["-200"], socket)
+        await running
+
+    run(experiment, scenario())
+    reply = json.loads(socket.sent[0])
+    assert reply["id"] == 4 and reply["type"] == "batch" and reply["total"] == 3
+    assert [entry["cmd"] for entry in reply["results"]] == ["on", "move", "goto"]
+    assert reply["results"][2]["result"] == "stepper/position/200"
+    assert socket.sent[1] == "MESSAGE: stepper/position/0"
+
+
+def test_batches_stop_at_the_first_error(experiment):
+    socket = RecordingSocket()
+    batch = {
+        "id": 5,
+        "type": "batch",
+        "commands": [
+            {"device": "led", "cmd": "on"},
+            {"device": "stepper", "cmd": "goto", "params": ["nowhere"]},
+            {"device": "led", "cmd": "off"},
+        ],
+    }
+    run(experiment, experiment.processCommand(json.dumps(batch), socket))
+    reply = json.loads(socket.sent[0])
+    assert [entry["type"] for entry in reply["results"]] == ["message", "error"]
+    assert Controllers.gpio.pins[20] == 1
+    assert experiment.queueDepths()["stepperLock"]["queued"] == 0
+
+
+def test_reset_runs_in_the_background_and_only_blocks_its_devices(experiment, monkeypatch):
+    socket = RecordingSocket()
+    experiment.activeClient = socket
+    run(experiment, experiment.runDeviceMethod("stepper", "move", ["30"], socket))
+    monkeypatch.setitem(fakes.latency, "onestep", 0.01)
+
+    async def scenario():
+        reset = experiment.resetExperiment(socket)
+        start = time.perf_counter()
+        await experiment.runDeviceMethod("led", "on", [""], socket)
+        ledTime = time.perf_counter() - start
+        await experiment.runDeviceMethod("stepper", "move", ["2"], socket)
+        stepperTime = time.perf_counter() - start
+        await reset
+        return ledTime, stepperTime
+
+    ledTime, stepperTime = run(experiment, scenario())
+    assert ledTime < 0.1 < stepperTime
+    assert socket.sent[-3] == "MESSAGE: led ran on"
+    assert set(socket.sent[-2:]) == {"MESSAGE: stepper/position/2", "ALERT: Experiment/ready"}
+
+
+class Rig(BaseController):
+    """A device that drives the stepper, like an AbsorberController."""
+
+    deviceType = "controller"
+
+    def __init__(self, name, stepper, log):
+        super().__init__(name)
+        self.stepper = stepper
+        self.log = log
+
+    def reset(self):
+        time.sleep(0.05)
+        self.log.append(self.name)
+
+
+def test_devices_reset_before_the_devices_they_drive(experiment, monkeypatch):
+    log = []
+    stepper = experiment.devices["stepper"]
+    monkeypatch.setattr(stepper, "reset", lambda: log.append("stepper"))
+    rig = Rig("rig", stepper, log)
+    experiment.addDevice(rig)
+    experiment.addLockGroup("rigLock", [rig])
+
+    assert experiment.resetOrder().index("rig") < experiment.resetOrder().index("stepper")
+    rig.state = {"moved": True}
+    stepper.state = {"position": 5}
+
+    async def scenario():
+        await experiment.resetExperiment()
+
+    run(experiment, scenario())
+    assert log == ["rig", "stepper"]
+
+
+def test_only_gateways_may_reset_devices(experiment):
+    client, gateway = RecordingSocket(), RecordingSocket()
+    experiment.gateways.add(gateway)
+    reset = '{"id": 1, "device": "stepper", "cmd": "reset"}'
+
+    async def scenario():
+        await experiment.processCommand("stepper/move/4", client)
+        await experiment.processCommand(reset, client)
+        position = experiment.devices["stepper"].currentPosition
+        await experiment.processCommand(reset, gateway)
+        return position
+
+    assert run(experiment, scenario()) == 4
+    assert json.loads(client.sent[-1])["error"] == "CommandError"
+    assert json.loads(gateway.sent[-1])["result"] == "stepper/reset"
+    assert experiment.devices["stepper"].currentPosition == 0
+
+
+def test_reset_skips_devices_that_are_back_in_their_clean_state(experiment, monkeypatch):
+    socket = RecordingSocket()
+    resets = []
+    for name in ("stepper", "led", "lamp"):
+        device = experiment.devices[name]
+
+        def reset(name=name, original=device.reset):
+            resets.append(name)
+            original()
+
+        monkeypatch.setattr(device, "reset", reset)
+
+    async def scenario():
+        await experiment.runDeviceMethod("stepper", "move", ["10"], socket)
+        await experiment.runDeviceMethod("stepper", "move", ["-10"], socket)
+        await experiment.runDeviceMethod("led", "on", [""], socket)
+        await experiment.resetExperiment()
+
+    assert not experiment.devices["stepper"].isDirty()
+    run(experiment, scenario())
+    assert resets == ["led"]
+    assert not experiment.devices["led"].isDirty()
+
+
+def test_commands_record_phase_latencies(experiment):
+    socket = RecordingSocket()
+
+    async def scenario():
+        await experiment.processCommand("stepper/move/3", socket)
+        await experiment.processCommand("led/on/", socket)
+        await experiment.statusServer.start("127.0.0.1", 0)
+        reader, writer = await asyncio.open_connection("127.0.0.1", experiment.statusServer.port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+        experiment.statusServer.server.close()
+        return response.decode()
+
+    response = run(experiment, scenario())
+    seconds = experiment.metrics.commandSeconds
+    for phase in ("queue", "lock", "executor", "hardware", "send"):
+        assert seconds.count(device="stepper", command="move", phase=phase) == 1
+    # Inline commands never wait for a worker thread.
+    assert seconds.count(device="led", command="on", phase="executor") == 0
+    assert seconds.count(device="led", command="on", phase="hardware") == 1
+    assert experiment.metrics.commands.get(device="led", command="on", outcome="ok") == 1
+    assert experiment.metrics.sentBytes.get(kind="reply") > 0
+    assert response.startswith("HTTP/1.1 200 OK")
+    assert 'remla_commands_total{device="stepper",command="move",outcome="ok"} 1.0' in response
+    assert 'remla_queue_depth{pool="stepperLock"} 0' in response
+
+
+def test_commands_leave_a_trace_record(experiment):
+    socket = RecordingSocket()
+
+    async def scenario():
+        await experiment.processCommand('{"id": 4, "device": "stepper", "cmd": "move", "params": ["2"]}', socket)
+        await experiment.processCommand(
+            '{"id": 5, "type": "batch", "commands": ['
+            '{"device": "led", "cmd": "on"}, {"device": "stepper", "cmd": "move", "params": ["1"]}]}',
+            socket,
+        )
+
+    run(experiment, scenario())
+    records = experiment.tracer.last()
+    assert [(record["device"], record["requestId"]) for record in records] == [
+        ("stepper", 4),
+        ("led", 5),
+        ("stepper", 5),
+    ]
+    for record in records:
+        assert record["outcome"] == "ok"
+        assert 0 <= record["parsed"] <= record["lockAcquired"] <= record["hardwareStart"]
+        assert record["hardwareStart"] <= record["hardwareEnd"] <= record["sent"]
+    contentType, body = experiment.traceRoute({"last": ["1"]})
+    assert json.loads(body)[0]["params"] == ["1"]
+
+
+def test_rejected_commands_leave_a_trace_record(experiment):
+    socket = RecordingSocket()
+
+    async def scenario():
+        await experiment.processCommand('{"id": 1, "device": "nope", "cmd": "on"}', socket)
+        await experiment.processCommand('{"id": 2, "device": "stepper", "cmd": "release"}', socket)
+        await experiment.processCommand('{"id": 3, "device": "stepper", "cmd": "move", "params": [1, 2]}', socket)
+        await experiment.sendOverload(socket, '{"id": 4, "device": "led", "cmd": "on"}', "queue full")
+
+    run(experiment, scenario())
+    records = experiment.tracer.last()
+    assert [(record["requestId"], record["outcome"]) for record in records] == [
+        (1, "error"),
+        (2, "error"),
+        (3, "error"),
+        (4, "rejected"),
+    ]
+    commands = experiment.metrics.commands
+    assert commands.get(device="stepper", command="move", outcome="error") == 1
+    assert commands.get(device="led", command="on", outcome="rejected") == 1
+
+
+def test_positions_survive_a_restart(tmp_path):
+    journal = {"path": str(tmp_path / "lab.journal"), "syncInterval": 0.01}
+    experiment = buildExperiment(journal=journal)
+    socket = RecordingSocket()
+
+    async def scenario():
+        await experiment.processCommand("stepper/move/12", socket)
+        await experiment.processCommand("led/on/", socket)
+        await asyncio.sleep(0.1)
+
+    try:
+        run(experiment, scenario())
+    finally:
+        experiment.shutdownExecutors()
+        experiment.loop.close()
+    # No clean shutdown: the restart sees only what was already synced.
+    restarted = buildExperiment(journal=journal)
+    try:
+        stepper = restarted.devices["stepper"]
+        assert stepper.currentPosition == 12
+        assert stepper.getState() == {"position": 12}
+        assert stepper.isDirty()
+        # GPIO pins do not keep their level across a restart, so led is not restored.
+        assert restarted.devices["led"].getState() == "off"
+    finally:
+        restarted.shutdownExecutors()
+        restarted.loop.close()
+
+
+def test_state_changed_outside_a_command_is_published(experiment):
+    deltas = []
+    experiment.events.subscribe(StateDelta, deltas.append)
+    experiment.events.unsubscribe(StateDelta, experiment.broadcastDelta)
+    led = experiment.devices["led"]
+
+    def limitHit():
+        led.state = "on"
+        led.stateChanged("limit")
+
+    async def scenario():
+        # Someone has to be listening for the state to be flushed.
+        experiment.clients["spectator"] = object()
+        threading.Thread(target=limitHit).start()
+        while not deltas:
+            await asyncio.sleep(0.01)
+
+    try:
+        run(experiment, scenario())
+    finally:
+        experiment.clients.clear()
+    assert (deltas[0].deviceName, deltas[0].delta) == ("led", "on")
+    assert experiment.metrics.stateChanges.get(device="led") == 1
+
+
+def test_snapshot_follows_changes_made_with_nobody_connected(experiment):
+    async def scenario():
+        await experiment.runDeviceMethod("led", "on", [""], RecordingSocket())
+        await asyncio.sleep(experiment.broadcastInterval * 2)
+        assert experiment.publishedStates["led"] == "on"
+        # The handoff reset runs once the last client has gone.
+        await experiment.resetExperiment()
+        await asyncio.sleep(experiment.broadcastInterval * 2)
+
+    run(experiment, scenario())
+    assert experiment.devices["led"].getState() == "off"
+    assert experiment.publishedStates["led"] == "off"
+
+
+def test_abort_only_stops_the_wave_its_own_device_sent(experiment, monkeypatch):
+    stopped = []
+    monkeypatch.setattr(Controllers.pi, "wave_tx_stop", lambda: stopped.append(True))
+    pololu = experiment.devices["pololu"]
+    # Stopping a device with nothing running must not kill another device's wave.
+    pololu.abort()
+    assert stopped == []
+    pololu.sendingWave = True
+    pololu.abort()
+    assert stopped == [True]
+    # StepperSimple drives rpistepper, not pigpio waves.
+    assert Controllers.StepperSimple.abort is BaseController.abort
+
+
+def test_s42c_sends_and_stops_waves_on_its_own_pigpio_handle():
+    foreign = Controllers.pigpio.pi("pi2.local")
+    stopped = []
+    foreign.wave_tx_stop = lambda: stopped.append(True)
+    with pytest.warns(RuntimeWarning):
+        motor = Controllers.S42CStepperMotor("s42c", 4, 17, 27, (None, None), _pi=foreign)
+    motor.move(10)
+    assert len(foreign.chains) == 1
+    motor.sendingWave = True
+    motor.abort()
+    assert stopped == [True]
+
+
+def test_a_reset_that_leaves_state_changed_keeps_the_device_dirty(experiment, monkeypatch):
+    led = experiment.devices["led"]
+    # Like a reset that switches the hardware off but forgets to update state.
+    monkeypatch.setattr(led, "reset", lambda: None)
+
+    async def scenario():
+        await experiment.runDeviceMethod("led", "on", [""], RecordingSocket())
+        await experiment.resetExperiment()
+
+    run(experiment, scenario())
+    # The starting state is not moved to whatever state the reset left behind.
+    assert led.cleanState == "off"
+    assert led.isDirty()
+
+
+def test_a_device_is_clean_again_after_a_press_and_a_reset(experiment):
+    mux = Controllers.Multiplexer("mux", [5, 6, 13], 19, defaultChannel=2, delay=0)
+    experiment.addDevice(mux)
+
+    run(experiment, mux.press(5))
+    assert mux.isDirty()
+    mux.reset()
+    assert mux.state == {"channel": 2}
+    assert not mux.isDirty()
+
+
+def test_the_new_client_gets_control_after_the_reset_is_set_up(experiment, monkeypatch):
+    leaving, waiting = RecordingSocket(), RecordingSocket()
+    leaving.id, waiting.id = "leaving", "waiting"
+    experiment.controlQueue["waiting"] = waiting
+    experiment.activeClient = leaving
+    seen = {}
+
+    async def sendAlert(websocket, alertMsg):
+        if alertMsg.startswith("Experiment/controlStatus/1"):
+            seen["resetPending"] = "led" in experiment.resetEvents
+
+    monkeypatch.setattr(experiment, "sendAlert", sendAlert)
+
+    async def scenario():
+        await experiment.handOff("You have control.")
+        await experiment.resetTask
+
+    run(experiment, scenario())
+    assert seen == {"resetPending": True}
+    assert experiment.activeClient is waiting
+
+
+def test_a_failed_lease_watcher_is_logged_and_cleared(experiment, caplog):
+    async def watchLeases():
+        raise RuntimeError("watcher broke")
+
+    async def scenario():
+        experiment.leaseTask = asyncio.ensure_future(watchLeases())
+        experiment.leaseTask.add_done_callback(experiment.leaseWatcherDone)
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+
+    run(experiment, scenario())
+    assert experiment.leaseTask is None
+    assert "watcher broke" in caplog.text
@@ -0,0 +1,135 @@
+import asyncio
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+from remla.labcontrol.Controllers import RemoteDevice
+from remla.labcontrol.gateway import RemoteError
+from tests.benchmark import buildExperiment
+from tests.test_experiment import RecordingSocket, run
+
+
+def startNode(name):
+    process = subprocess.Popen(
+        [sys.executable, "-m", "tests.node", "--name", name],
+        cwd=Path(__file__).parent.parent,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    for line in process.stdout:
+        if line.startswith("PORT "):
+            return process, f"ws://127.0.0.1:{int(line.split()[1])}"
+    raise RuntimeError(f"Node {name} exited with {process.wait()}")
+
+
+@pytest.fixture
+def gateway():
+    processes, urls = zip(*(startNode(name) for name in ("left", "right")))
+    experiment = buildExperiment(name="gateway", configureLogging=False)
+    remotes = [
+        RemoteDevice("leftStepper", urls[0], {"move": 1, "goto": 1}, remoteName="stepper"),
+        RemoteDevice("rightStepper", urls[1], {"move": 1, "goto": 1}, remoteName="stepper"),
+        RemoteDevice("rightLed", urls[1], {"on": None, "off": None}, remoteName="led"),
+    ]
+    for device in remotes:
+        experiment.addDevice(device)
+    # One lock group spanning both nodes and a local device.
+    experiment.addLockGroup("bench", remotes + [experiment.devices["led"]])
+    yield experiment
+    for node in experiment.remoteNodes():
+        run(experiment, node.close())
+    experiment.shutdownExecutors()
+    experiment.loop.close()
+    for process in processes:
+        process.kill()
+        process.wait()
+
+
+def waitFor(experiment, condition, timeout=5.0):
+    async def poll():
+        deadline = time.monotonic() + timeout
+        while not condition():
+            assert time.monotonic() < deadline
+            await asyncio.sleep(0.01)
+
+    run(experiment, poll())
+
+
+def test_commands_are_forwarded_to_their_nodes(gateway):
+    socket = RecordingSocket()
+
+    async def scenario():
+        await asyncio.gather(
+            *(
+                gateway.processStructuredCommand(json.dumps(frame), socket)
+                for frame in (
+                    {"id": 1, "device": "leftStepper", "cmd": "move", "params": ["5"]},
+                    {"id": 2, "device": "rightStepper", "cmd": "move", "params": ["-7"]},
+                    {"id": 3, "device": "rightLed", "cmd": "on"},
+                    {"id": 4, "device": "leftStepper", "cmd": "fly", "params": []},
+                )
+            )
+        )
+
+    # Nothing has run yet once the nodes' snapshots are in, so nothing needs a reset.
+    for node in gateway.remoteNodes():
+        run(gateway, node.connect())
+    waitFor(gateway, lambda: gateway.devices["leftStepper"].mirrored)
+    assert not gateway.devices["leftStepper"].isDirty()
+
+    run(gateway, scenario())
+    replies = {reply["id"]: reply for reply in map(json.loads, socket.sent)}
+    assert [replies[i]["type"] for i in (1, 2, 3)] == ["message"] * 3
+    assert replies[4]["error"] == "CommandError"
+
+    # Remote state is mirrored from the nodes' broadcasts.
+    waitFor(gateway, lambda: gateway.devices["leftStepper"].getState().get("position") == 5)
+    waitFor(gateway, lambda: gateway.devices["rightStepper"].getState().get("position") == -7)
+    assert gateway.devices["rightLed"].getState() == "on"
+    assert gateway.devices["leftStepper"].isDirty()
+
+    node = gateway.devices["leftStepper"].node
+    assert gateway.metrics.hopSeconds.count(node=node.url) == 1
+    assert "remla_hop_seconds_count{node=" in gateway.metrics.render()
+
+
+def test_batches_span_nodes_and_remote_errors_come_back(gateway):
+    socket = RecordingSocket()
+    batch = {
+        "id": 9,
+        "type": "batch",
+        "commands": [
+            {"device": "leftStepper", "cmd": "move", "params": ["3"]},
+            {"device": "led", "cmd": "on"},
+            {"device": "rightStepper", "cmd": "goto", "params": ["nowhere"]},
+            {"device": "rightLed", "cmd": "on"},
+        ],
+    }
+    run(gateway, gateway.processStructuredCommand(json.dumps(batch), socket))
+    reply = json.loads(socket.sent[-1])
+    assert [result["device"] for result in reply["results"]] == [
+        "leftStepper",
+        "led",
+        "rightStepper",
+    ]
+    assert reply["results"][-1]["error"] == "RemoteError"
+
+    # Resetting the proxy resets the device on its node.
+    run(gateway, gateway.resetNow("leftStepper"))
+    waitFor(gateway, lambda: gateway.devices["leftStepper"].getState().get("position") == 0)
+
+
+def test_requests_fail_fast_without_control_of_the_node(gateway):
+    node = gateway.devices["leftStepper"].node
+
+    async def scenario():
+        await node.connect()
+        node.control = False
+        with pytest.raises(RemoteError):
+            await node.request("stepper", "move", ["1"])
+
+    run(gateway, scenario())
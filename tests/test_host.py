@@ -0,0 +1,74 @@
+import asyncio
+import json
+
+import pytest
+import websockets
+
+from remla.labcontrol.host import ExperimentHost
+from tests.benchmark import buildExperiment
+
+
+@pytest.fixture
+def host(tmp_path):
+    host = ExperimentHost(loop=asyncio.new_event_loop())
+    for name in ("gamma", "beta"):
+        experiment = buildExperiment(
+            name=name,
+            loop=host.loop,
+            configureLogging=False,
+            ipcPath=str(tmp_path / f"{name}.sock"),
+        )
+        host.add(experiment, port=0, path=name)
+    yield host
+    for experiment in host.experiments:
+        experiment.shutdownExecutors()
+    host.loop.close()
+
+
+def test_routes_by_path_prefix(host):
+    gamma, beta = host.experiments
+    assert host.route(0, "/gamma") == (gamma, "/")
+    assert host.route(0, "/gamma?x=1") == (gamma, "/?x=1")
+    assert host.route(0, "/beta/spectate?protocol=json") == (beta, "/spectate?protocol=json")
+    assert host.route(0, "/gammaray")[0] is None
+    assert host.route(1, "/gamma")[0] is None
+
+    with pytest.raises(ValueError):
+        host.add(gamma, port=0, path="/gamma/")
+    stranger = buildExperiment(name="stranger", configureLogging=False)
+    try:
+        with pytest.raises(ValueError):
+            host.add(stranger, port=0)
+    finally:
+        stranger.shutdownExecutors()
+        stranger.loop.close()
+
+
+def test_two_labs_share_one_port(host):
+    async def scenario():
+        await host.start()
+        port = host.servers[0].sockets[0].getsockname()[1]
+        replies = {}
+        for name in ("gamma", "beta"):
+            async with websockets.connect(f"ws://127.0.0.1:{port}/{name}") as ws:
+                await ws.send(json.dumps({"id": 1, "device": "led", "cmd": "on"}))
+                while name not in replies:
+                    frame = await ws.recv()
+                    if frame.startswith("{") and json.loads(frame).get("id") == 1:
+                        replies[name] = json.loads(frame)
+        async with websockets.connect(f"ws://127.0.0.1:{port}/nowhere") as ws:
+            with pytest.raises(websockets.ConnectionClosed):
+                await ws.recv()
+        for server in host.servers:
+            server.close()
+            await server.wait_closed()
+        for experiment in host.experiments:
+            await experiment.ipcServer.close()
+        # Disconnecting the controller starts a reset; let it finish.
+        pending = asyncio.all_tasks() - {asyncio.current_task()}
+        await asyncio.gather(*pending, return_exceptions=True)
+        return replies
+
+    replies = host.loop.run_until_complete(scenario())
+    assert set(replies) == {"gamma", "beta"}
+    assert all(reply["type"] != "error" for reply in replies.values())
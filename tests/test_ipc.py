@@ -0,0 +1,58 @@
+import asyncio
+import json
+
+import pytest
+
+from remla.labcontrol.ipc import IpcServer
+from tests.benchmark import buildExperiment
+
+
+@pytest.fixture
+def experiment():
+    experiment = buildExperiment()
+    yield experiment
+    experiment.shutdownExecutors()
+    experiment.loop.close()
+
+
+def test_many_requests_in_flight_over_one_connection(experiment, tmp_path):
+    server = IpcServer(experiment, str(tmp_path / "remla.sock"))
+
+    async def scenario():
+        await server.start()
+        reader, writer = await asyncio.open_unix_connection(server.path)
+        frames = [
+            {"id": 1, "device": "stepper", "cmd": "move", "params": ["5"]},
+            {"id": 2, "type": "queues"},
+            {"id": 3, "type": "batch", "commands": [{"device": "led", "cmd": "on"}]},
+            {"id": 4, "device": "nothing", "cmd": "on"},
+            {"id": 5, "type": "message", "message": "boot"},
+            {"id": 6, "type": "trace", "last": "1"},
+        ]
+        writer.write("".join(json.dumps(frame) + "\n" for frame in frames).encode())
+        await writer.drain()
+        replies = {}
+        while len(replies) < len(frames):
+            reply = json.loads(await reader.readline())
+            replies[reply["id"]] = reply
+        writer.close()
+
+        # Bare words are answered the old way, for scripts written against it.
+        reader, writer = await asyncio.open_unix_connection(server.path)
+        writer.write(b"queues")
+        writer.write_eof()
+        legacy = json.loads(await reader.read())
+        writer.close()
+        await server.close()
+        return replies, legacy
+
+    replies, legacy = experiment.loop.run_until_complete(scenario())
+    assert replies[1]["result"] == "stepper/position/5"
+    # The move was still running when the queues request was answered.
+    assert replies[2]["result"]["stepperLock"]["workers"] == 1
+    assert replies[3]["results"][0]["device"] == "led"
+    assert replies[4]["error"] == "NoDeviceError"
+    assert replies[5]["result"] is False
+    assert len(replies[6]["result"]) <= 1
+    assert experiment.devices["stepper"].currentPosition == 5
+    assert set(legacy) == set(replies[2]["result"])
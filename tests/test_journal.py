@@ -0,0 +1,53 @@
+import asyncio
+import json
+
+from remla.labcontrol.journal import StateJournal
+
+
+def record(journal, entries):
+    async def scenario():
+        for deviceName, delta in entries:
+            journal.record(deviceName, delta)
+        await journal.flush()
+
+    asyncio.run(scenario())
+
+
+def test_entries_are_replayed_on_load(tmp_path):
+    path = tmp_path / "lab.journal"
+    journal = StateJournal(path, syncInterval=60)
+    journal.load()
+    record(
+        journal,
+        [
+            ("stepper", {"position": 10}),
+            ("absorber", {"total": {"s0": "a", "s1": ""}}),
+            ("stepper", {"position": 25}),
+            ("led", "on"),
+        ],
+    )
+    assert len(path.read_text().splitlines()) == 4
+
+    # A power cut mid-write leaves a torn last line behind.
+    with open(path, "a") as f:
+        f.write('{"device": "stepper", "sta')
+    states = StateJournal(path).load()
+    assert states == {
+        "stepper": {"position": 25},
+        "absorber": {"total": {"s0": "a", "s1": ""}},
+        "led": "on",
+    }
+
+
+def test_compaction_folds_the_journal_into_the_snapshot(tmp_path):
+    path = tmp_path / "lab.journal"
+    journal = StateJournal(path, syncInterval=60, compactEvery=3)
+    journal.load()
+    record(journal, [("stepper", {"position": step}) for step in range(3)])
+    assert path.read_text() == ""
+    assert json.loads(journal.snapshotPath.read_text()) == {"stepper": {"position": 2}}
+    assert not journal.snapshotPath.with_name(journal.snapshotPath.name + ".tmp").exists()
+
+    record(journal, [("stepper", {"position": 7})])
+    journal.close({"outlet": {"1": "On"}})
+    assert StateJournal(path).load() == {"stepper": {"position": 7}, "outlet": {"1": "On"}}
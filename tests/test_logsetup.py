@@ -0,0 +1,72 @@
+import gzip
+import logging
+import os
+import threading
+
+from remla.labcontrol import logsetup
+
+
+def test_records_are_written_by_the_listener_thread(tmp_path):
+    path = tmp_path / "lab.log"
+    writers = []
+
+    class ThreadRecorder(logging.Handler):
+        def emit(self, record):
+            writers.append(threading.current_thread())
+
+    listener = logsetup.setupLogging(path, console=False)
+    listener.handlers += (ThreadRecorder(),)
+    try:
+        logging.getLogger("remla.test").info("moved %s steps", 12)
+        logging.getLogger("remla.test").debug("hidden %s", "chatter")
+    finally:
+        logsetup.stopLogging()
+    text = path.read_text()
+    assert "moved 12 steps" in text
+    assert "hidden" not in text
+    assert writers and threading.current_thread() not in writers
+
+
+def test_debug_gate_skips_formatting():
+    calls = []
+
+    class Expensive:
+        def __str__(self):
+            calls.append(1)
+            return "expensive"
+
+    logsetup.setupLogging(console=False)
+    try:
+        logging.getLogger("remla.test").debug("state %s", Expensive())
+    finally:
+        logsetup.stopLogging()
+    assert calls == []
+
+
+def test_rotates_by_size_and_age_and_keeps_a_retention_budget(tmp_path):
+    path = tmp_path / "lab.log"
+    now = [1_700_000_000.0]
+    handler = logsetup.CompressedRotatingFileHandler(
+        path, maxBytes=200, maxAge=60, retentionBytes=150, clock=lambda: now[0]
+    )
+    logger = logging.getLogger("remla.rotation")
+    logger.addHandler(handler)
+    logger.propagate = False
+    try:
+        for line in range(10):
+            logger.warning("line %d %s", line, "x" * 40)
+            now[0] += 1
+        assert path.stat().st_size <= 200
+        rotated = handler.archives()
+        assert rotated
+        with gzip.open(rotated[-1], "rt") as archive:
+            assert "line" in archive.read()
+        assert sum(os.path.getsize(p) for p in rotated) <= 150
+
+        # A quiet log still rotates once it is old enough.
+        now[0] += 61
+        logger.warning("after a minute")
+        assert path.read_text() == "after a minute\n"
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
@@ -0,0 +1,32 @@
+from remla.labcontrol.metrics import CommandTiming, Counter, Histogram, Registry
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram("latency_seconds", "Latency.", ("device",), buckets=(0.1, 1.0))
+    histogram.observe(0.05, device="led")
+    histogram.observe(0.5, device="led")
+    histogram.observe(5, device="led")
+    lines = histogram.render().splitlines()
+    assert lines[:2] == ["# HELP latency_seconds Latency.", "# TYPE latency_seconds histogram"]
+    assert 'latency_seconds_bucket{device="led",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{device="led",le="1.0"} 2' in lines
+    assert 'latency_seconds_bucket{device="led",le="+Inf"} 3' in lines
+    assert 'latency_seconds_count{device="led"} 3' in lines
+    assert histogram.count(device="led") == 3
+
+
+def test_counter_escapes_labels_and_registry_joins_metrics():
+    registry = Registry()
+    counter = registry.register(Counter("commands_total", "Commands.", ("command",)))
+    counter.inc(command='say "hi"')
+    counter.inc(2, command='say "hi"')
+    assert counter.get(command='say "hi"') == 3
+    assert 'commands_total{command="say \\"hi\\""} 3.0' in registry.render()
+    assert registry.render().endswith("\n")
+
+
+def test_timing_skips_phases_that_never_ran():
+    timing = CommandTiming(received=1.0)
+    timing.lockRequested, timing.lockAcquired = 1.5, 2.0
+    timing.hardwareStart, timing.hardwareEnd = 2.0, 2.25
+    assert timing.phases() == {"queue": 0.5, "lock": 0.5, "hardware": 0.25}
@@ -0,0 +1,52 @@
+import json
+
+import pytest
+
+from remla.labcontrol import protocol
+
+
+def test_text_frames_split_on_slashes_and_commas():
+    request = protocol.parseText("stepper/move/10,20\n")
+    assert (request.deviceName, request.cmd, request.params) == ("stepper", "move", ["10", "20"])
+    assert not request.structured
+
+
+def test_json_frames_keep_id_and_typed_params():
+    message = protocol.parseStructured('{"id": "a1", "device": "servo", "cmd": "goto", "params": 30}')
+    request = protocol.requestFromMessage(message)
+    assert request.requestId == "a1"
+    assert request.params == [30]
+    assert request.structured
+
+
+def test_bad_json_frames_raise_protocol_errors():
+    with pytest.raises(protocol.ProtocolError):
+        protocol.parseStructured("{not json")
+    with pytest.raises(protocol.ProtocolError) as info:
+        protocol.requestFromMessage({"id": 3, "device": "stepper"})
+    assert info.value.requestId == 3
+
+
+def test_errors_are_typed():
+    reply = json.loads(protocol.encodeError(5, ValueError("bad")))
+    assert reply == {"id": 5, "type": "error", "error": "ValueError", "message": "bad"}
+
+
+def test_batch_frames_become_ordered_requests():
+    requests = protocol.batchFromMessage(
+        {
+            "id": 9,
+            "type": "batch",
+            "commands": [
+                {"device": "screen", "cmd": "on"},
+                {"device": "stepper", "cmd": "goto", "params": ["ref"]},
+            ],
+        }
+    )
+    assert [(r.deviceName, r.cmd, r.params) for r in requests] == [
+        ("screen", "on", []),
+        ("stepper", "goto", ["ref"]),
+    ]
+    assert all(r.requestId == 9 for r in requests)
+    with pytest.raises(protocol.ProtocolError):
+        protocol.batchFromMessage({"id": 10, "type": "batch", "commands": []})
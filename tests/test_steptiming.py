@@ -0,0 +1,81 @@
+import pytest
+
+from remla.labcontrol.steptiming import StepScheduler
+from tests.benchmark import buildExperiment
+from tests.test_experiment import RecordingSocket, run
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def drive(schedule, clock, costs):
+    for cost in costs:
+        clock.now += cost  # the step itself: bus write, GIL, ...
+        schedule.wait()
+
+
+def test_step_overhead_does_not_slow_the_move():
+    clock = FakeClock()
+    schedule = StepScheduler(0.01, clock=clock, sleep=clock.sleep)
+    drive(schedule, clock, [0.003] * 100)
+    report = schedule.report()
+    assert clock.now == pytest.approx(1.0)
+    assert report["achievedRate"] == report["requestedRate"] == 100.0
+    assert report["jitter"] == pytest.approx(0.0, abs=1e-9)
+
+
+def test_late_steps_are_made_up_unless_far_behind():
+    clock = FakeClock()
+    schedule = StepScheduler(0.01, clock=clock, sleep=clock.sleep)
+    drive(schedule, clock, [0.001] * 10 + [0.015] + [0.001] * 9)
+    assert clock.now == pytest.approx(0.2)
+    assert schedule.report()["resyncs"] == 0
+    assert schedule.report()["jitter"] > 0
+
+    # A long stall restarts the schedule instead of bursting to catch up.
+    drive(schedule, clock, [0.05] + [0.001] * 9)
+    assert schedule.report()["resyncs"] == 1
+    assert clock.now == pytest.approx(0.2 + 0.05 + 0.09, abs=0.002)
+
+
+def test_moves_report_their_step_timing():
+    experiment = buildExperiment()
+    try:
+        run(experiment, experiment.runDeviceMethod("stepper", "move", ["5"], RecordingSocket()))
+        timing = experiment.devices["stepper"].stepTiming
+        assert timing["steps"] == 5
+        # The benchmark lab steps with no delay, so only the achieved rate is known.
+        assert timing["requestedRate"] is None
+        rendered = experiment.metrics.render()
+        assert 'remla_step_rate{device="stepper",rate="achieved"}' in rendered
+        assert 'remla_step_jitter_seconds{device="stepper"}' in rendered
+    finally:
+        experiment.shutdownExecutors()
+        experiment.loop.close()
+
+
+def test_only_troubled_moves_log_at_info(caplog):
+    experiment = buildExperiment()
+    stepper = experiment.devices["stepper"]
+    try:
+        with caplog.at_level("DEBUG", logger="remla.labcontrol.Controllers"):
+            clock = FakeClock()
+            smooth = StepScheduler(0.01, clock=clock, sleep=clock.sleep)
+            drive(smooth, clock, [0.001] * 10)
+            stepper.recordStepTiming(smooth)
+            stalled = StepScheduler(0.01, clock=clock, sleep=clock.sleep)
+            drive(stalled, clock, [0.001] * 5 + [0.05] + [0.001] * 4)
+            stepper.recordStepTiming(stalled)
+        levels = [r.levelname for r in caplog.records if "steps/s" in r.getMessage()]
+        assert levels == ["DEBUG", "INFO"]
+    finally:
+        experiment.shutdownExecutors()
+        experiment.loop.close()
@@ -0,0 +1,37 @@
+import json
+
+from remla.labcontrol.metrics import CommandTiming
+from remla.labcontrol.protocol import Request
+from remla.labcontrol.tracing import JsonLinesSink, Tracer
+
+
+def finishedTiming():
+    timing = CommandTiming(received=10.0)
+    timing.parsed = 10.001
+    timing.lockRequested, timing.lockAcquired = 10.001, 10.5
+    timing.hardwareStart, timing.hardwareEnd = 10.5, 18.5
+    timing.sendStart, timing.sent = 18.5, 18.501
+    return timing
+
+
+def test_ring_buffer_keeps_the_most_recent_records():
+    tracer = Tracer(capacity=3)
+    for step in range(5):
+        tracer.record(Request("stepper", "move", [str(step)]), finishedTiming(), "ok")
+    records = tracer.last()
+    assert [record["id"] for record in records] == [3, 4, 5]
+    assert [record["params"] for record in tracer.last(2)] == [["3"], ["4"]]
+    assert records[0]["hardwareEnd"] == 8.5
+    assert records[0]["sent"] == 8.501
+
+
+def test_records_go_to_a_json_lines_file(tmp_path):
+    path = tmp_path / "trace.jsonl"
+    tracer = Tracer(sinks=[JsonLinesSink(path)])
+    tracer.record(Request("absorber", "place", ["3"], requestId=7), finishedTiming(), "ok", "client-1")
+    tracer.close()
+    record = json.loads(path.read_text().splitlines()[0])
+    assert record["device"] == "absorber"
+    assert record["client"] == "client-1"
+    assert record["requestId"] == 7
+    assert record["lockAcquired"] == 0.5